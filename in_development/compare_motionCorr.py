@@ -25,15 +25,20 @@
 # In[1]:
 
 
-import tifffile as tiff
 import h5py
 import os
 import cv2 as cv
 import numpy as np
 import matplotlib.pyplot as plt
 import math
+import sys
+import functools
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+
+# metric functions shared with the pipeline live in sima_mc_wrapper
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '..', 'sima_mc_wrapper')))
+import motion_metrics
 
 
 # In[23]:
@@ -92,80 +97,80 @@ plt.legend(dat_type_names[1:]);
 # In[5]:
 
 
-# function to load tiff data and get data shape
-def read_shape_tiff(data_path):
-    
-    data = tiff.imread(data_path).astype('int16')
-    data_shape = data.shape
-
-    return data, data_shape
-
-def read_shape_h5(data_path):
-    
-    # open h5 to read, find data key, grab data, then close
-    h5 = h5py.File(data_path,'r')
-    data = np.squeeze(np.array( h5[h5.keys()[0]] )).astype('int16') # np.array loads all data into memory
-    h5.close()
-    
-    data_shape = data.shape
-    
-    return data, data_shape
+# open each dataset lazily: nothing is loaded here. The crop (to the smallest FOV among datasets), suite2p rescale and
+# int16 cast are applied per block of frames while the metrics are computed
+sources = OrderedDict()
 
+for key in dat_type_names:
 
-# In[6]:
-
-
-# loop through keys of dictionary, and load video data
-for key in dat_dict:
-
-    dat_dict[key]['raw_dat'], dat_dict[key]['dat_dim'] = read_shape_h5(dat_dict[key]['dir'])
-    
     # needed b/c suite2p divides intensity values by 2
-    if key == 'suite2p':
-        dat_dict[key]['raw_dat'] = dat_dict[key]['raw_dat'] * 2
-    
+    scale = 2 if key == 'suite2p' else 1
+    sources[key] = motion_metrics.LazyMovie(dat_dict[key]['dir'], scale=scale, dtype='int16')
+
+    with sources[key] as movie:
+        dat_dict[key]['dat_dim'] = movie.shape
     print("{} {}".format(key, dat_dict[key]['dat_dim']))
 
 
-# In[24]:
+# # Compute all metrics
+# 
+# Mean images, correlation to mean (CM), crispness, optical flow and KLT feature drift are computed for all datasets in
+# lockstep, one block of frames at a time (motion_metrics.compare_datasets). Datasets are cropped equally on each side
+# to the smallest FOV; some algorithms crop b/c there may be edge pixels that contain little information due to
+# shifting out of view, and cropping also removes suite2p edge artifacts
 
+# In[ ]:
 
-""" calculate minimum and max FOVs after motion correction to crop all data to similar dimensions (to facilitate correlation)
- some algorithms crop b/c may be some edge pixels that contain little information due to shifting out of view
-# use list comprehension to extract corresponding dimension from each key in the dict """
 
-# FIRST List comprehension
-min_ypix = np.min([dat_dict[key]['dat_dim'][1] for key in dat_dict])
-min_xpix = np.min([dat_dict[key]['dat_dim'][2] for key in dat_dict])
+# optical flow (Farneback) parameters
+pyr_scale=.5
+levels=3
+winsize=100
+iterations=15
+poly_n=5
+poly_sigma=1.2 / 5
+flags=0
+resize_fact_flow=.2 # frames are downsampled before computing the flow
+flow_field_stride=500 # keep the full flow field of every Nth frame (None to keep none)
 
 
-# # Plot mean images for each analysis dataset
+# In[ ]:
+
 
-# In[25]:
+# KLT tracking parameters: ShiTomasi corner detection (on the mean image) and lucas kanade optical flow
+feature_params = dict( max_corners = 10,
+                       quality_level = 0.3,
+                       min_distance = 7,
+                       block_size = 7 )
+lk_params = dict( win_size  = (15,15),
+                  max_level = 2,
+                  criteria = (cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 10, 0.03))
+klt_frame_stride = 10 # track every Nth frame
 
 
-# function to crop frames equally on each side; measure out from the center
-def crop_center(img,cropx,cropy):
-    z,y,x = img.shape
-    startx = x//2-(cropx//2) # // is floor division
-    starty = y//2-(cropy//2)    
-    return img[:,starty:starty+cropy,startx:startx+cropx]
+# In[ ]:
 
 
-# In[26]:
+# flow of each frame relative to the dataset's mean image, computed in a thread pool; only per-frame summary stats
+# (motion_metrics.FLOW_STATS) and a strided sample of flow fields are kept
+flow_metric = functools.partial(motion_metrics.FlowMetric, resize_fact=resize_fact_flow, pyr_scale=pyr_scale,
+                                levels=levels, winsize=winsize, iterations=iterations, poly_n=poly_n,
+                                poly_sigma=poly_sigma, flags=flags, field_stride=flow_field_stride)
 
+# features of the mean image tracked into the frames (headless; no drawing)
+klt_metric = functools.partial(motion_metrics.KLTDriftMetric, frame_stride=klt_frame_stride,
+                               **dict(feature_params, **lk_params))
 
-""" use function to crop videos; important for easier aligned comparison of mean imgs, 
-but also removing suite2p edge artifacts """
+frame_metrics = OrderedDict([('frame_corr', motion_metrics.correlation_metric),
+                             ('flow', flow_metric),
+                             ('klt_drift', klt_metric)])
+results = motion_metrics.compare_datasets(sources, block_size=100, frame_metrics=frame_metrics)
 
-for key in dat_dict: 
-    
-    # crop data
-    dat_dict[key]['raw_dat'] = crop_center(dat_dict[key]['raw_dat'],min_xpix,min_ypix)
+for key in results:
+    dat_dict[key].update(results[key])
 
-    # compute mean image    
-    dat_dict[key]['mean_img'] = np.mean(dat_dict[key]['raw_dat'], axis=0)
 
+# # Plot mean images for each analysis dataset
 
 # In[27]:
 
@@ -264,27 +269,8 @@ im5.set_clim(vmin=clims[0], vmax=clims[1]); im6.set_clim(vmin=clims[0], vmax=cli
 # In[14]:
 
 
-# function to compute frame-resolved correlation to reference mean image
-def corr2_all_frames(data,ref):
-    cor_all = np.empty([data.shape[0],])
-    
-    for iframe,frame in enumerate(data):
-        print 'frame {0}\r'.format(iframe),
-        # pearson corr used in NoRMCorre paper
-        cor_all[iframe] = np.corrcoef(np.ndarray.flatten(frame), np.ndarray.flatten(ref))[0,1] # 
-        
-    return cor_all
-
-
-# In[15]:
-
-
-for key in dat_dict: 
-    
-    print('Corr {} Data'.format(key))
-    
-    # we'll correlate each frame within a dataset to the mean image of that dataset
-    dat_dict[key]['frame_corr'] = corr2_all_frames(dat_dict[key]['raw_dat'],dat_dict[key]['mean_img'])
+# dat_dict[key]['frame_corr'] (computed above) is the correlation of each frame within a dataset to the mean image of
+# that dataset (pearson corr used in NoRMCorre paper)
 
 
 # In[16]:
@@ -397,120 +383,59 @@ plt.show()
 # In[20]:
 
 
-# calculate entry(pixel)-wise magnitude
-
-def calc_all_vect_mag(dy,dx):
-    
-    # initialize pixel-wise mag array
-    h_pix = dy.shape[0]
-    w_pix = dy.shape[1]
-    all_vect_mag = np.empty( [h_pix,w_pix] )
-    
-    # np.gradient gives x/y vector components; need to calculate composite magnitude for each pixel
-    # np.ndenumerate returns 2d index for each entry
-    for index, x in np.ndenumerate(dy):
-    
-        ycoord = index[0] 
-        xcoord = index[1]
-        
-        all_vect_mag[ycoord,xcoord] = (dx[ycoord,xcoord] ** 2 + dy[ycoord,xcoord] ** 2) ** 0.5
-    
-    return all_vect_mag
-
-
-# In[21]:
-
-
-for key in dat_dict: 
-    
-    # first calculate gradient (vector for each pixel)
-    img_in = np.asarray(np.flipud(dat_dict[key]['mean_img']))
-    dy, dx = np.gradient(img_in)
-
-    dat_dict[key]['grad_mag'] = calc_all_vect_mag(dy,dx)
-
-
-# In[22]:
-
-
-# calculate Frobenius norm 
-print 'raw Crispness: ' , np.linalg.norm(dat_dict['raw']['grad_mag'], ord = 'fro')
-print 'sima Crispness: ' , np.linalg.norm(dat_dict['sima']['grad_mag'], ord = 'fro')
-print 'suite2p Crispness: ' , np.linalg.norm(dat_dict['suite2p']['grad_mag'], ord = 'fro')
-print 'caiman Crispness: ' , np.linalg.norm(dat_dict['caiman']['grad_mag'], ord = 'fro')
+# dat_dict[key]['crispness'] (computed above) is the Frobenius norm of the entry(pixel)-wise gradient magnitude of the
+# mean image; flipping the image (as for the quiver plot) does not change it
 
+for key in dat_type_names: 
+    print('{} Crispness: {}'.format(key, dat_dict[key]['crispness']))
 
-# # Calculate Optical Flow
 
 # In[ ]:
 
 
-import cv2
-import logging
-
-
-# In[ ]:
+# crispness of the mean image of consecutive blocks of frames (100 frames, the block size used above), to see how
+# registration quality changes over the session
+crisp_block_size = 100
 
+fig, ax = plt.subplots(1, 1, figsize=(10,5))
 
-pyr_scale=.5
-levels=3
-winsize=100
-iterations=15
-poly_n=5
-poly_sigma=1.2 / 5
-flags=0
-play_flow=False
-resize_fact_flow=.2
-template=None
-
+for key in dat_type_names: 
 
-# In[ ]:
+    block_tvec = (np.arange(len(dat_dict[key]['block_crispness'])) + 0.5) * crisp_block_size / float(fps)
+    plt.plot(block_tvec, dat_dict[key]['block_crispness'], alpha = 0.7)
 
+plt.xlabel('Time [s]', fontsize=20)
+plt.ylabel('Crispness of block mean', fontsize=20)
+plt.legend(dat_type_names);
 
-key = 'suite2p'
-tmpl = dat_dict[key]['mean_img']
 
+# # Optical Flow
 
 # In[ ]:
 
 
-norms = []
-flows = []
-count = 0
-
-for fr in dat_dict[key]['raw_dat']:
-    if count % 100 == 0:
-        logging.debug(count)
-
-    count += 1
-    flow = cv2.calcOpticalFlowFarneback(
-        tmpl, fr, None, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags)
+# mean magnitude of the Farneback flow of each frame relative to the mean image (computed above), in pixels
+flow_mag_idx = motion_metrics.FLOW_STATS.index('mean_magnitude')
 
-    if play_flow:
-        pl.subplot(1, 3, 1)
-        pl.cla()
-        pl.imshow(fr, vmin=0, vmax=300, cmap='gray')
-        pl.title('movie')
-        pl.subplot(1, 3, 3)
-        pl.cla()
-        pl.imshow(flow[:, :, 1], vmin=vmin, vmax=vmax)
-        pl.title('y_flow')
+for key in dat_type_names: 
+    plt.plot(dat_dict[key]['flow'][:, flow_mag_idx], alpha = 0.7)
 
-        pl.subplot(1, 3, 2)
-        pl.cla()
-        pl.imshow(flow[:, :, 0], vmin=vmin, vmax=vmax)
-        pl.title('x_flow')
-        pl.pause(.05)
-
-    n = np.linalg.norm(flow)
-    flows.append(flow)
-    norms.append(n)
+plt.xlabel('Frame', fontsize=20)
+plt.ylabel('Mean flow magnitude [pixels]', fontsize=20)
+plt.legend(dat_type_names);
 
 
 # In[ ]:
 
 
-plt.plot(norms)
+# sampled flow fields (dat_dict[key]['flow_fields'], downsampled by resize_fact_flow) of the first sampled frame
+fig, axs = plt.subplots(1, len(dat_type_names), figsize=(15, 5))
+
+for idx, key in enumerate(dat_type_names): 
+    flow_field = dat_dict[key]['flow_fields'][0]
+    axs[idx].imshow(np.hypot(flow_field[..., 0], flow_field[..., 1]))
+    axs[idx].set_title('{} frame {}'.format(key, dat_dict[key]['flow_field_frames'][0]), fontsize = 20)
+    axs[idx].axis('off')
 
 
 # # Perform KLT Tracking with OpenCV
@@ -524,73 +449,14 @@ plt.plot(norms)
 # In[ ]:
 
 
-# grab reference frame
-ref_frame = raw_dat[0,:,:]
-this_frame = raw_dat[100,:,:]
-
-
-# In[ ]:
-
-
-# params for ShiTomasi corner detection
-feature_params = dict( maxCorners = 10,
-                       qualityLevel = 0.3,
-                       minDistance = 7,
-                       blockSize = 7 )
-# Parameters for lucas kanade optical flow
-lk_params = dict( winSize  = (15,15),
-                  maxLevel = 2,
-                  criteria = (cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 10, 0.03))
-
-
-# In[ ]:
-
-
-p0 = cv.goodFeaturesToTrack(ref_frame, mask = None, **feature_params)
-p0.shape
-
-
-# In[ ]:
-
-
-# Create some random colors
-color = np.random.randint(0,255,(100,3))
-# Create a mask image for drawing purposes
-mask = np.zeros_like(ref_frame)
-frame_idx = 1
-
-while(1):
-    
-    this_frame = raw_dat[frame_idx,:,:]
-    
-    # calculate optical flow
-    p1, st, err = cv.calcOpticalFlowPyrLK(ref_frame, this_frame, p0, None, **lk_params)
-    
-    # Select good points
-    good_new = p1[st==1]
-    good_old = p0[st==1]
-    
-    # draw the tracks
-    for i,(new,old) in enumerate(zip(good_new, good_old)):
-        a,b = new.ravel()
-        c,d = old.ravel()
-        mask = cv.line(mask, (a,b),(c,d), color[i].tolist(), 2)
-        frame = cv.circle(this_frame,(a,b),5,color[i].tolist(),-1)
-    img = cv.add(this_frame,mask)
-    cv.imshow('frame',img)
-    k = cv.waitKey(30) & 0xff
-    if k == 27 or frame_idx == raw_dat_dim[0]-1:
-        break
-    # Now update the previous frame and previous points
-    old_gray = this_frame.copy()
-    p0 = good_new.reshape(-1,1,2)
-    
-    frame_idx += 1
-
-
-
-# In[ ]:
-
-
+# median drift of the features of each dataset's mean image, tracked into every klt_frame_stride-th frame
+# (computed above); frames skipped by the stride are NaN
+drift_idx = motion_metrics.KLT_STATS.index('drift')
 
+for key in dat_type_names: 
+    klt_frames = np.flatnonzero(~np.isnan(dat_dict[key]['klt_drift'][:, drift_idx]))
+    plt.plot(klt_frames, dat_dict[key]['klt_drift'][klt_frames, drift_idx], alpha = 0.7)
 
+plt.xlabel('Frame', fontsize=20)
+plt.ylabel('Feature drift [pixels]', fontsize=20)
+plt.legend(dat_type_names);
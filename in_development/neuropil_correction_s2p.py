@@ -43,10 +43,14 @@ import sys
 from scipy import optimize
 from multiprocessing import Pool, cpu_count
 
-import rasterio.features
-import shapely.geometry
 import matplotlib.pyplot as plt
 
+# ROI and neuropil functions shared with the pipeline live in sima_mc_wrapper
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '..', 'sima_mc_wrapper')))
+import calculate_neuropil
+import neuropil_engine
+import suite2p_rois
+
 
 # In[6]:
 
@@ -75,131 +79,26 @@ list(hf)
 # embedded within: calculate_roi_centroids
 def load_rois_for_session(session_folder, package):
 
-
-    # load s2p meta data and load cells
-    suite2p_dat_dir = session_folder + '\\suite2p\\plane0\\'
-    stat = np.load( suite2p_dat_dir + 'stat.npy', allow_pickle=True)
-    ops = np.load( suite2p_dat_dir + 'ops.npy', allow_pickle=True).item()
-    iscell = np.load(suite2p_dat_dir + "iscell.npy", allow_pickle = True)
-    cell_ids = np.where( iscell[:,0] == 1 )[0]  # indices of detected cells across all ROIs from suite2p
-    num_cells_suite2p = len(cell_ids)
-
-    roi_polygons = []
-    for iROI in cell_ids:
-
-        # make binary ROI mask
-        roi_mask = np.zeros([ops['Ly'],ops['Lx']], dtype = 'float32')
-        roi_mask[stat[iROI]['ypix'], stat[iROI]['xpix']] = 1
-
-        shapes = rasterio.features.shapes(roi_mask)
-        polygons = [shapely.geometry.Polygon(shape[0]["coordinates"][0]) for shape in shapes if shape[1] == 1]
-
-        roi_polygons.append(polygons[0])
-        im_shape = (ops['Ly'],ops['Lx'])
+    # load s2p cells (iscell) straight from stat.npy pixel lists as sparse (num_cells, y*x) masks; centroids are the
+    # suite2p 'med' pixels in (x, y) order
+    suite2p_dat_dir = suite2p_rois.suite2p_plane_dir(session_folder)
+    roi_masks, roi_centroids, im_shape, cell_ids = suite2p_rois.load_suite2p_rois(suite2p_dat_dir)
             
-    return roi_polygons, im_shape #CZ roi_polygona
+    return roi_masks, roi_centroids, im_shape
 
 # 3RD FUNCTION IN ORDER
 def calculate_roi_centroids(session_folder):
    
-    stat = np.load( suite2p_dat_dir + 'stat.npy', allow_pickle=True)
-    ops = np.load( suite2p_dat_dir + 'ops.npy', allow_pickle=True).item()
-    stat[0]['med'] # ROI center; basically median for each dimension
+    roi_masks, roi_centroids, im_shape = load_rois_for_session(session_folder, 'suite2p')
     
-    return roi_centroids, im_shape, roi_polygons
+    return roi_centroids, im_shape, roi_masks
 
 
 # In[50]:
 
 
-# 4TH FUNCTION IN ORDER
-def calculate_roi_masks(roi_polygons, im_size):
-    masks = []
-    if len(im_size) == 2:
-        im_size = (1,) + im_size
-    roi_polygons = _reformat_polygons(roi_polygons)
-    for poly in roi_polygons:
-        mask = np.zeros(im_size, dtype=bool)
-        # assuming all points in the polygon share a z-coordinate
-        z = int(np.array(poly.exterior.coords)[0][2])
-        if z > im_size[0]:
-            warn('Polygon with zero-coordinate {} '.format(z) +
-                 'cropped using im_size = {}'.format(im_size))
-            continue
-        x_min, y_min, x_max, y_max = poly.bounds
-
-        # Shift all points by 0.5 to move coordinates to corner of pixel
-        shifted_poly = Polygon(np.array(poly.exterior.coords)[:, :2] - 0.5)
-
-        points = [Point(x, y) for x, y in
-                  product(np.arange(int(x_min), np.ceil(x_max)),
-                          np.arange(int(y_min), np.ceil(y_max)))]
-        points_in_poly = list(filter(shifted_poly.contains, points))
-        for point in points_in_poly:
-            xx, yy = point.xy
-            x = int(xx[0])
-            y = int(yy[0])
-            if 0 <= y < im_size[1] and 0 <= x < im_size[2]:
-                mask[z, y, x] = True
-        masks.append(mask[0,:,:])
-    return masks
-
-# 5TH FUNCTION
-def calculate_spatialweights_around_roi(indir, roi_masks, roi_centroids,
-                                        neuropil_radius, min_neuropil_radius, h5file):
-    
-    # roi_centroids has order (x,y). The index for any roi_masks is in row, col shape or y,x shape.
-    # So be careful to flip the order when you subtract from centroid
-    numrois = len(roi_masks)
-    allrois_mask = np.logical_not(np.sum(roi_masks, axis=0))
-    (im_ysize, im_xsize) = allrois_mask.shape
-    y_base = np.tile(np.array([range(1,im_ysize+1)]).transpose(), (1,im_xsize))
-    x_base = np.tile(np.array(range(1,im_xsize+1)), (im_ysize,1))
-    
-    # Set weights for a minimum radius around all ROIs to zero as not the whole ROI is drawn
-    deadzones_aroundrois = np.ones((im_ysize, im_xsize))
-    for roi in range(numrois):
-        x_diff = x_base-roi_centroids[roi][0]
-        y_diff = y_base-roi_centroids[roi][1]
-        dist_from_centroid = np.sqrt(x_diff**2 + y_diff**2)
-        temp = np.ones((im_ysize, im_xsize))
-        temp[dist_from_centroid<min_neuropil_radius] = 0
-        deadzones_aroundrois *= temp
-    
-    allrois_mask *= deadzones_aroundrois.astype(bool)
-    
-    # initialize H5 to save spatial weight info
-    h5 = h5py.File(os.path.join(indir, '%s_spatialweights_%d_%d.h5'%(os.path.splitext(h5file)[0],
-                                                                     min_neuropil_radius,
-                                                                     neuropil_radius)),
-                   'w', libver='latest')
-    
-    output_shape = (numrois, im_ysize, im_xsize)
-    h5['/'].create_dataset(
-        'spatialweights', output_shape, maxshape=output_shape,
-        chunks=(1, output_shape[1], output_shape[2]))
-    
-    h5['/'].create_dataset('deadzones_aroundrois',data = deadzones_aroundrois)
-    
-    # go through each roi and calculate spatial weight map for neuropils
-    for roi in range(numrois):
-        x_diff = x_base-roi_centroids[roi][0]
-        y_diff = y_base-roi_centroids[roi][1]
-        dist_from_centroid = np.sqrt(x_diff**2 + y_diff**2)
-        spatialweights = np.exp(-(x_diff**2 + y_diff**2)/neuropil_radius**2)
-        spatialweights *= im_ysize*im_xsize/np.sum(spatialweights)
-        
-        # Set weights for a minimum radius around the ROI to zero
-        #spatialweights[dist_from_centroid<min_neuropil_radius] = 0
-        # Set weights for pixels containing other ROIs to 0
-        spatialweights *= allrois_mask
-        """fig, ax = plt.subplots()
-        ax.imshow(spatialweights, cmap='gray')
-        raise Exception()"""
-        h5['/spatialweights'][roi, :, :] = spatialweights
-     
-    h5.close()
-    
+# 4TH FUNCTION IN ORDER: ROI masks and neuropil weights come from sima_mc_wrapper (neuropil_engine)
+
 def calculate_neuropil_coefficients_for_session(indir, signals, neuropil_signals,
                                                 neuropil_radius, min_neuropil_radius, beta_neuropil=None):
     
@@ -261,67 +160,31 @@ def save_neuropil_corrected_signals(indir, signals, neuropil_signals, beta_rois,
 def calculate_neuropil_signals(h5filepath, neuropil_radius, min_neuropil_radius,
                                masked=False):
     
-    dual_channel = False
-    
     savedir = os.path.dirname(h5filepath)
-    h5file = h5py.File(h5filepath,'r') #Read-only
     h5filename = os.path.basename(h5filepath)
+    fname = os.path.splitext(h5filename)[0]
     
-    simadir = os.path.splitext(h5filename)[0]+'_mc.sima'
-    
-    dataset = sima.ImagingDataset.load(os.path.join(savedir, simadir))
-    sequence = dataset.sequences[0]
-    frame_iter1 = iter(sequence)
-    
-    def fill_gaps(framenumber):  #adapted from SIMA source code  
-        first_obs = next(frame_iter1)
-        for frame in frame_iter1:
-            for frame_chan, fobs_chan in zip(frame, first_obs):
-                fobs_chan[np.isnan(fobs_chan)] = frame_chan[np.isnan(fobs_chan)]
-            if all(np.all(np.isfinite(chan)) for chan in first_obs):
-                break
-        most_recent = [x * np.nan for x in first_obs]
-        while True:
-            frame = np.array(sequence[framenumber])[0,:,:,:,:]
-            for fr_chan, mr_chan in zip(frame, most_recent):
-                mr_chan[np.isfinite(fr_chan)] = fr_chan[np.isfinite(fr_chan)]
-            temp=[np.nan_to_num(mr_ch) + np.isnan(mr_ch) * fo_ch
-                for mr_ch, fo_ch in zip(most_recent, first_obs)]
-            framenumber = yield np.array(temp)[0,:,:,0]
-
-
-    fill_gapscaller = fill_gaps(0)
-    fill_gapscaller.send(None)
+    roi_centroids, im_shape, roi_masks = calculate_roi_centroids(savedir)
     
-    roi_centroids, im_shape, roi_polygons = calculate_roi_centroids(savedir)
-    roi_masks = calculate_roi_masks(roi_polygons, im_shape)
-    
-    calculate_spatialweights_around_roi(savedir, roi_masks, roi_centroids,
-                                            neuropil_radius, min_neuropil_radius, h5filename)
+    # the sparse suite2p masks are used as they are (no polygon round-trip)
+    calculate_neuropil.calculate_spatialweights_around_roi(savedir, roi_masks, roi_centroids,
+                                                           neuropil_radius, min_neuropil_radius, fname,
+                                                           im_shape=im_shape)
     
     # load the spatial weights calculated from previous line
-    h5weights = h5py.File(os.path.join(savedir, '%s_spatialweights_%d_%d.h5'%(os.path.splitext(h5filename)[0],
-                                                                           min_neuropil_radius, neuropil_radius)), 'r')
-    
-    spatialweights = h5weights['/spatialweights']
-    
-    numframes = h5file['/imaging'].shape[0]
-    neuropil_signals = np.nan*np.ones((len(roi_masks), numframes))
+    with h5py.File(os.path.join(savedir, '%s_spatialweights_%d_%d.h5'%(fname, min_neuropil_radius, 
+                                                                       neuropil_radius)), 'r') as h5weights:
+        spatialweights = h5weights['/spatialweights'][()]
     
-    #pb = ProgressBar(numframes)
+    # stream the motion corrected movie in blocks of frames (gaps left by motion correction are filled) and take the
+    # weighted mean of every frame for all ROIs, one matrix product per block; see neuropil_engine
     start_time = time.time()
-    for frame in range(numframes):
-        
-        temp = fill_gapscaller.send(frame)[None,:,:] #this will fill gaps in rows by interpolation
-        neuropil_signals[:, frame] = np.einsum('ijk,ijk,ijk->i', spatialweights,
-                                               temp, np.isfinite(temp))#/np.sum(spatialweights, axis=(1,2))
-        # The einsum method above is way faster than multiplying array elements individually
-        # The above RHS basically implements a nanmean and averages over x and y pixels
-        
-        #pb.animate(frame+1)
-    neuropil_signals /= np.sum(spatialweights, axis=(1,2))[:,None]  
+    sequence = neuropil_engine.movie_from_sima(savedir, fname)
+    frame_blocks = neuropil_engine.iter_movie_blocks(sequence, fill_gaps=True)
+    neuropil_signals = neuropil_engine.weighted_traces(frame_blocks, spatialweights)[0] # first channel
+    print('Took %.1f seconds to analyze %s' % (time.time() - start_time, savedir))
     
-    np.save(os.path.join(savedir, '%s_neuropilsignals_%d_%d.npy'%(os.path.splitext(h5filename)[0],
+    np.save(os.path.join(savedir, '%s_neuropilsignals_%d_%d.npy'%(fname,
                                                            min_neuropil_radius,
                                                            neuropil_radius)),
         neuropil_signals)
@@ -347,17 +210,15 @@ def calculate_neuropil_signals_for_session(indir, h5filename, neuropil_radius=50
     signals = np.squeeze(np.load(os.path.join(indir, npyfile)))
     
     # calculate central coordinates of ROIs
-    roi_centroids, im_shape, roi_polygons = calculate_roi_centroids(savedir)
+    roi_centroids, im_shape, roi_masks = calculate_roi_centroids(savedir)
 
     dataset = sima.ImagingDataset.load(os.path.join(savedir, simadir))
     
-    # calculate ROI mask and corresponding pixel-avg time-series
-    roi_masks = calculate_roi_masks(roi_polygons, im_shape)
-    
     # dataset.time_averages is time-avg image?
     # multiply roi binary mask with mean image, sum across pixels, then divide by num pixels (mean)
-    # mean_roi_response is a vector of mean ROI fluorescence values
-    mean_roi_response = np.nansum(roi_masks*dataset.time_averages[:,:,:,0], axis=(1,2))/np.sum(roi_masks, axis=(1,2))
+    # mean_roi_response is a vector of mean ROI fluorescence values; one sparse product for all ROIs
+    mean_img = np.nan_to_num(dataset.time_averages[0,:,:,0]).ravel()
+    mean_roi_response = roi_masks.dot(mean_img)/roi_masks.getnnz(axis=1)
     
     # sima divides ROI time-series by the mean response; reverse this
     signals *= mean_roi_response[:,None]
@@ -5,11 +5,17 @@
 
 
 import os
+import sys
 import numpy as np
 import h5py
 import pandas as pd
 import pickle
 
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '..', 'sima_mc_wrapper')))
+import projections
+import roi_comparison
+import suite2p_rois
+
 import matplotlib.pyplot as plt
 plt.rcParams['text.usetex'] = False
 plt.rcParams['text.latex.unicode'] = False
@@ -37,13 +43,9 @@ list(hf)
 # In[54]:
 
 
-# load video data
-
-# open h5 to read, find data key, grab data, then close
-h5 = h5py.File(suite2p_h5_path,'r')
-suite2p_data = np.squeeze(np.array( h5[list(h5.keys())[0]] )).astype('int16') # np.array loads all data into memory
-h5.close()
-num_samples = int(suite2p_data.shape[0])
+# video data is streamed from the h5 files in blocks of frames during signal extraction (roi_comparison.roi_traces)
+with h5py.File(suite2p_h5_path,'r') as h5:
+    num_samples = int(h5[list(h5.keys())[0]].shape[0])
 
 
 # In[55]:
@@ -128,14 +130,10 @@ plt.title('Suite2p ROIs', fontsize = 20)
 # In[60]:
 
 
-# for suite2p, go through each ROI and take mean across pixels
-
-roi_signal_suite2p = np.empty([numROI_2Viz,num_samples])
-
-for idx,iROI in enumerate(cell_ids_analyze):
-
-    roi_signal_suite2p[idx,:] = np.mean(suite2p_data[:, stat[iROI]['ypix'], stat[iROI]['xpix']], 
-                         axis = 1)
+# for suite2p, mean across the pixels of each ROI; all ROIs are extracted together with one sparse matrix product per
+# block of frames
+suite2p_masks = suite2p_rois.sparse_masks_from_stat([stat[iROI] for iROI in cell_ids_analyze], (ops['Ly'], ops['Lx']))
+roi_signal_suite2p = roi_comparison.roi_traces(suite2p_h5_path, suite2p_masks)
 
 
 # In[61]:
@@ -147,12 +145,6 @@ roi_signal_suite2p.shape
 # In[ ]:
 
 
-get_ipython().run_line_magic('reset_selective', '-f suite2p_data')
-
-
-# In[ ]:
-
-
 plt.figure(figsize = (9,3))
 plt.plot(tvec,roi_signal_suite2p[0])
 plt.axis([0,500,-100,500])
@@ -188,25 +180,11 @@ plt.savefig(fig_save_dir + 'roi_ts.eps', format='eps')
 # In[26]:
 
 
-# load video data
-# open h5 to read, find data key, grab data, then close
-h5 = h5py.File(sima_h5_path,'r')
-sima_data = np.squeeze(np.array( h5[list(h5.keys())[0]] )).astype('int16') # np.array loads all data into memory
-h5.close()
-
-
-# In[59]:
-
-
-proj_manual = {'mean_img': np.mean(sima_data, axis = 0), 
-               'max_img': np.max(sima_data, axis = 0), 
-               'std_img': np.std(sima_data, axis = 0) }
-
-
-# In[28]:
-
-
-manual_data_dims = sima_data.shape
+# projections of the sima video, streamed from the h5 file
+with h5py.File(sima_h5_path,'r') as h5:
+    sima_data = h5[list(h5.keys())[0]]
+    proj_manual = projections.compute_projections(sima_data)
+    manual_data_dims = (sima_data.shape[0],) + proj_manual['mean_img'].shape
 
 
 # In[29]:
@@ -222,16 +200,15 @@ numROI_sima = sima_masks.shape[0]
 # In[30]:
 
 
-roi_signal_sima = np.empty([numROI_sima,manual_data_dims[0]])
+# calc signal mean across roi pixels, for all ROIs at once
+roi_signal_sima = roi_comparison.roi_traces(sima_h5_path, roi_comparison.sparse_masks(sima_masks == 1))
+
 zero_template_manual = np.zeros([manual_data_dims[1], manual_data_dims[2]])
 roi_label_loc_manual = []
 
 for iROI in range(numROI_sima):
     
-    # calc signal mean across roi pixels
     ypix_roi, xpix_roi = np.where(sima_masks[iROI,:,:] == 1)
-    roi_signal_sima[iROI,:] = np.mean(sima_data[:, ypix_roi, xpix_roi  ], 
-                         axis = 1)
     
     # make binary map of ROI pixels
     zero_template_manual[ ypix_roi, xpix_roi ] = 1*(iROI+1)
@@ -267,18 +244,13 @@ plt.title('Manual ROIs', fontsize = 20)
 # In[132]:
 
 
-# load csv with cell matching between manual and suite2p
-data = pd.read_csv( 'C:\\2pData\\Ivan\\cell_matching.csv', usecols=[0,1]) 
-manual_suite2p_cell_links = data[data["Suite2p"].notnull()]
+# match manual and suite2p cells by mask overlap (intersection over union); replaces the hand-made cell_matching.csv
+suite2p_ids, manual_ids, match_ious = roi_comparison.match_rois(suite2p_masks, sima_masks == 1, (ops['Ly'], ops['Lx']),
+                                                                min_iou = 0.2)
+manual_suite2p_cell_links = pd.DataFrame({'Manual': manual_ids, 'Suite2p': suite2p_ids, 'iou': match_ious})
 manual_suite2p_cell_links.head() # note that unmatched cells will not show up
 
 
-# In[133]:
-
-
-manual_suite2p_cell_links["signal_corr"] = ""
-
-
 # In[134]:
 
 
@@ -305,15 +277,10 @@ plt.legend(['suite2p', 'manual'], fontsize = 13);
 # In[135]:
 
 
-for index, row in manual_suite2p_cell_links.iterrows():
-
-    manual_roi_id = int(row['Manual'])
-    suite2p_roi_id = int(row['Suite2p'])
-    #print(manual_roi_id,suite2p_roi_id)
-    #print(np.corrcoef( roi_signal_suite2p[suite2p_roi_id,:], roi_signal_sima[manual_roi_id,:] )[0,1])
-    
-    manual_suite2p_cell_links.loc[index, 'signal_corr'] = np.corrcoef( roi_signal_suite2p[suite2p_roi_id,:], 
-                                            roi_signal_sima[manual_roi_id,:] )[0,1]
+# correlations of all matched pairs at once
+manual_suite2p_cell_links['signal_corr'] = roi_comparison.matched_correlations(
+    roi_signal_suite2p, roi_signal_sima,
+    manual_suite2p_cell_links['Suite2p'].astype(int), manual_suite2p_cell_links['Manual'].astype(int))
 
 
 # In[136]:
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+
+Benchmarks the SIMA wrapper functions on synthetic two-photon movies (see synthetic_data.py) and stores the timings
+as json baselines, so that speedups can be measured and regressions caught locally.
+
+Timed stages
+------------
+bidi_offset : bidi_offset_correction (mean image, offset estimation and correction of all frames)
+projections : sima_motion_bidi_correction.save_projections
+roi_masks : calculate_neuropil.calculate_roi_masks
+spatial_weights : calculate_neuropil.calculate_spatialweights_around_roi
+extraction : sima ImagingDataset.extract (what sima_extract_roi_sig.extract runs)
+neuropil_signals : calculate_neuropil.calculate_neuropil_signals
+motion_correction : sima HiddenMarkov2D row-wise correction; slow, so only run when requested
+
+How to use (command line):
+
+    python benchmark.py --frames 500 --rows 256 --cols 256 --save my_baseline
+    ... change code ...
+    python benchmark.py --frames 500 --rows 256 --cols 256 --compare my_baseline
+
+or from python: results = benchmark.run_benchmarks(num_frames=500); benchmark.save_baseline(results, 'my_baseline')
+
+Baselines are written to the benchmark_baselines folder next to this file. They are machine specific, so only
+compare baselines made on the same computer.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import h5py
+import matplotlib
+# sima and the wrapper modules import pyplot; the benchmarks only save figures, so they also run without a display
+matplotlib.use('Agg')
+import numpy as np
+import sima
+import sima.motion
+from sima.ROI import ROI, ROIList
+
+import bidi_offset_correction
+import calculate_neuropil
+import sima_motion_bidi_correction
+import synthetic_data
+
+baseline_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines')
+
+default_stages = ['bidi_offset', 'projections', 'roi_masks', 'spatial_weights', 'extraction', 'neuropil_signals']
+# stages whose cost scales with the number of frames; only these get a frames/sec entry
+frame_stages = ['bidi_offset', 'projections', 'extraction', 'neuropil_signals', 'motion_correction']
+
+
+def time_call(func, repeats=3):
+    # returns the individual wall times of repeated calls and the output of the last call
+    times = []
+    out = None
+    for _ in range(repeats):
+        start = time.time()
+        out = func()
+        times.append(time.time() - start)
+    return times, out
+
+
+def setup_session(work_dir, synth, fname='synth'):
+    """Writes the synthetic movie to h5 and builds the .sima folder and roi list the neuropil functions expect"""
+
+    h5_path = os.path.join(work_dir, fname + '_sima_mc.h5')
+    with h5py.File(h5_path, 'w') as h5:
+        h5.create_dataset('imaging', data=synth['movie'])
+
+    sequences = [sima.Sequence.create('HDF5', h5_path, 'tyx')]
+    dataset = sima.ImagingDataset(sequences, os.path.join(work_dir, fname + '_mc.sima'))
+
+    im_shape = (1,) + synth['movie'].shape[1:]
+    rois = ROIList([ROI(polygons=[polygon], im_shape=im_shape) for polygon in synth['roi_polygons']])
+    dataset.add_ROIs(rois, 'synthetic')
+
+    return dataset, rois
+
+
+def run_benchmarks(num_frames=500, num_rows=256, num_cols=256, num_rois=20, repeats=3, stages=None,
+                   work_dir=None, seed=0):
+    """
+    Returns
+    -------
+    results : OrderedDict
+        'config' (movie size and repeats), 'platform' (machine info) and 'results', which holds for every stage
+        the individual wall times, the best and mean time and the frame throughput of the best run
+    """
+
+    if stages is None:
+        stages = default_stages
+
+    cleanup = work_dir is None
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='nape_benchmark_')
+
+    synth = synthetic_data.make_synthetic_movie(num_frames=num_frames, num_rows=num_rows, num_cols=num_cols,
+                                                num_rois=num_rois, seed=seed)
+    movie = synth['movie']
+    fname = 'synth'
+    neuropil_radius, min_neuropil_radius = 50, 15
+
+    results = OrderedDict()
+    results['config'] = OrderedDict([('num_frames', num_frames), ('num_rows', num_rows), ('num_cols', num_cols),
+                                     ('num_rois', num_rois), ('repeats', repeats), ('seed', seed)])
+    results['platform'] = OrderedDict([('machine', platform.node()), ('processor', platform.processor()),
+                                       ('python', platform.python_version()), ('numpy', np.__version__),
+                                       ('date_time', time.strftime('%Y-%m-%d %H:%M:%S'))])
+    results['results'] = OrderedDict()
+
+    def bidi_offset():
+        bidi_obj = bidi_offset_correction.bidi_offset_correction(movie)
+        bidi_obj.compute_mean_image()
+        bidi_obj.determine_bidi_offset()
+        return bidi_obj.correct_bidi_frames()[1]
+
+    def projections():
+        sima_motion_bidi_correction.save_projections(work_dir, movie)
+
+    def roi_masks():
+        return calculate_neuropil.calculate_roi_masks(synth['roi_polygons'], movie.shape[1:])
+
+    masks = roi_masks()
+
+    def spatial_weights():
+        calculate_neuropil.calculate_spatialweights_around_roi(work_dir, masks, synth['roi_centroids'],
+                                                               neuropil_radius, min_neuropil_radius, fname)
+
+    try:
+        if 'extraction' in stages or 'neuropil_signals' in stages:
+            dataset, rois = setup_session(work_dir, synth, fname)
+
+        def extraction():
+            return dataset.extract(rois, label='synthetic')
+
+        def neuropil_signals():
+            calculate_neuropil.calculate_neuropil_signals(os.path.join(work_dir, fname), neuropil_radius,
+                                                          min_neuropil_radius)
+
+        def motion_correction():
+            mc_dir = os.path.join(work_dir, fname + '_hmm_mc.sima')
+            if os.path.exists(mc_dir):
+                shutil.rmtree(mc_dir)
+            mc_approach = sima.motion.HiddenMarkov2D(granularity='row', max_displacement=[30, 50], n_processes=1)
+            mc_approach.correct([sima.Sequence.create('ndarray', movie[:, None, :, :, None])], mc_dir)
+
+        stage_funcs = OrderedDict([('bidi_offset', bidi_offset), ('projections', projections),
+                                   ('roi_masks', roi_masks), ('spatial_weights', spatial_weights),
+                                   ('extraction', extraction), ('neuropil_signals', neuropil_signals),
+                                   ('motion_correction', motion_correction)])
+
+        # neuropil signals reads the rois from the extraction pickle and the weights written by spatial_weights
+        if 'neuropil_signals' in stages:
+            if 'extraction' not in stages:
+                extraction()
+            if 'spatial_weights' not in stages:
+                spatial_weights()
+
+        for stage_name in stages:
+            print('Benchmarking {}'.format(stage_name))
+            times, out = time_call(stage_funcs[stage_name], repeats)
+            record = OrderedDict()
+            record['times_sec'] = times
+            record['best_sec'] = min(times)
+            record['mean_sec'] = float(np.mean(times))
+            if stage_name in frame_stages and min(times) > 0:
+                record['frames_per_sec'] = num_frames / min(times)
+            if stage_name == 'bidi_offset':
+                record['offset_error'] = int(out - synth['bidi_offset'])
+            results['results'][stage_name] = record
+
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def baseline_path(name):
+    if os.path.splitext(name)[1] == '.json' or os.path.dirname(name):
+        return name
+    return os.path.join(baseline_dir, name + '.json')
+
+
+def save_baseline(results, name):
+    path = baseline_path(name)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    return path
+
+
+def load_baseline(name):
+    with open(baseline_path(name), 'r') as fp:
+        return json.load(fp, object_pairs_hook=OrderedDict)
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Prints the speedup of every stage relative to a baseline and returns the stages whose best time is slower than
+    the baseline by more than the tolerance fraction
+    """
+
+    if results['config'] != baseline['config']:
+        print('Warning: benchmark config differs from the baseline; timings may not be comparable')
+
+    regressions = []
+    print('{:<20}{:>14}{:>14}{:>10}'.format('stage', 'baseline [s]', 'current [s]', 'speedup'))
+    for stage_name, record in results['results'].items():
+        if stage_name not in baseline['results']:
+            continue
+        base_sec = baseline['results'][stage_name]['best_sec']
+        speedup = base_sec / record['best_sec'] if record['best_sec'] > 0 else float('inf')
+        flag = ''
+        if record['best_sec'] > base_sec * (1 + tolerance):
+            regressions.append(stage_name)
+            flag = '  REGRESSION'
+        print('{:<20}{:>14.4f}{:>14.4f}{:>9.2f}x{}'.format(stage_name, base_sec, record['best_sec'], speedup, flag))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the SIMA wrapper on synthetic movies')
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--rows', type=int, default=256)
+    parser.add_argument('--cols', type=int, default=256)
+    parser.add_argument('--rois', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', default=None,
+                        help='subset of: ' + ', '.join(default_stages + ['motion_correction']))
+    parser.add_argument('--save', default=None, help='name of the baseline to write')
+    parser.add_argument('--compare', default=None, help='name of the baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fractional slowdown relative to the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(num_frames=args.frames, num_rows=args.rows, num_cols=args.cols, num_rois=args.rois,
+                             repeats=args.repeats, stages=args.stages)
+    print(json.dumps(results['results'], indent=2))
+
+    if args.save:
+        print('Saved baseline to ' + save_baseline(results, args.save))
+
+    if args.compare:
+        regressions = compare_to_baseline(results, load_baseline(args.compare), args.tolerance)
+        if regressions:
+            raise SystemExit('Regressions in: ' + ', '.join(regressions))
@@ -112,4 +112,24 @@ class bidi_offset_correction:
                 data_corrected[idx, ::2, :] = frame_even
                 data_corrected[idx, 1::2, :] = pad_array
 
-        return data_corrected, self.bidi_offset
\ No newline at end of file
+        return data_corrected, self.bidi_offset
+
+
+def correct_bidi_rows(data, bidi_offset):
+    """
+    Shifts the odd rows of an image or a (samples, y_pixels, x_pixels) array by bidi_offset pixels like
+    correct_bidi_frames (to the right for positive offsets, with the edge column repeated), for all frames at once.
+    Returns a float32 copy, e.g. for motion estimation and online processing where the data is converted anyway.
+    """
+
+    out = np.array(data, dtype='float32')
+    if bidi_offset == 0:
+        return out
+    odd_rows = out[..., 1::2, :].copy()
+    if bidi_offset > 0:
+        out[..., 1::2, bidi_offset:] = odd_rows[..., :-bidi_offset]
+        out[..., 1::2, :bidi_offset] = odd_rows[..., :1]
+    else:
+        out[..., 1::2, :bidi_offset] = odd_rows[..., -bidi_offset:]
+        out[..., 1::2, bidi_offset:] = odd_rows[..., -1:]
+    return out
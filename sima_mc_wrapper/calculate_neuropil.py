@@ -10,8 +10,19 @@ from itertools import product
 import scipy.stats as stats
 import time
 import re
+import multiprocessing as mp
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from warnings import warn
+import stage_metrics
+import projections
+import neuropil_engine
+import sequence_io
+# ROI loading functions, kept importable from here
+from neuropil_engine import load_rois_for_session, calculate_roi_centroids, calculate_roi_masks, roi_planes_from_masks
 
 # important for text to be detecting when importing saved figures into illustrator
 matplotlib.rcParams['pdf.fonttype'] = 42
@@ -65,13 +76,15 @@ class ProgressBar:
         return str(self.prog_bar)
 
 
-def correct_sima_paths(h5filepath, savedir, simadir, dual_channel, masked=False):
+def correct_sima_paths(h5filepath, savedir, simadir, dual_channel, masked=False, displacement_sidecar=False):
     # This is a function that corrects the paths to datafiles in all files
     # within the .sima directory. It assumes that the original data file is
     # a .h5 file in the same directory as the .sima directory, and that
     # the name of this file is such that if its name is "data.h5", the
     # .sima directory has the name "data_mc.sima". So there should be an
     # "_mc.sima" at the end of the .sima directory
+    # Folders with the displacements in a sidecar file (fparams['displacement_sidecar']) have a small sequences.pkl;
+    # displacement_sidecar=True also moves the displacements of other folders out of it while correcting the paths
     if not os.path.isdir(os.path.join(savedir, simadir)):
         raise Exception('%s does not exist in %s' % (simadir, savedir))
     sequencesdict = pickle.load(open(os.path.join(savedir, simadir, 'sequences.pkl'), 'rb'))
@@ -88,6 +101,9 @@ def correct_sima_paths(h5filepath, savedir, simadir, dual_channel, masked=False)
     # print correctabspath, abspath
     if abspath != correctabspath:
         print('Paths not appropriate in the .sima directory. Correcting them..')
+        if displacement_sidecar:
+            # see sequence_io.move_displacements_to_sidecar
+            sequence_io._displacements_to_sidecar(sequencesdict, os.path.join(savedir, simadir))
         sequencesdict[0]['base']['base']['_abspath'] = correctabspath
         datasetdict['savedir'] = os.path.join(savedir, simadir)
         with open(os.path.join(savedir, simadir, 'sequences.pkl'), 'wb') as out1:
@@ -96,80 +112,17 @@ def correct_sima_paths(h5filepath, savedir, simadir, dual_channel, masked=False)
             pickle.dump(datasetdict, out2)
 
 
-def load_rois_for_session(session_folder, fname):
-
-    sima_folder = os.path.join(session_folder, fname + '_mc.sima')
-    with open(os.path.join(session_folder, sima_folder, 'signals_0.pkl'), 'rb') as temp:
-        a = pickle.load(temp)
-    numrois = len(a[sorted(a.keys())[-1]]['rois'])  # Load the latest extraction
-    im_shape = a[sorted(a.keys())[-1]]['rois'][0]['im_shape'][1:]
-    # roi_polygons = [a[sorted(a.keys())[-1]]['rois'][roi_id]['polygons'][0][:,:-1] for roi_id in range(numrois)] # no z coordinate
-    roi_polygons = [a[sorted(a.keys())[-1]]['rois'][roi_id]['polygons'][0] for roi_id in
-                    range(numrois)]  # with z coordinate
-
-    return roi_polygons, im_shape
-
-
-def calculate_roi_centroids(session_folder, fname):
-    roi_polygons, im_shape = load_rois_for_session(session_folder, fname)
-    roi_centroids = [Polygon(roi).centroid.coords[0] for roi in roi_polygons]
-    return roi_centroids, im_shape, roi_polygons
-
-
-def calculate_roi_masks(roi_polygons, im_size):
-    masks = []
-    if len(im_size) == 2:
-        im_size = (1,) + im_size
-    roi_polygons = _reformat_polygons(roi_polygons)
-    for poly in roi_polygons:
-        mask = np.zeros(im_size, dtype=bool)
-        # assuming all points in the polygon share a z-coordinate
-        z = int(np.array(poly.exterior.coords)[0][2])
-        if z > im_size[0]:
-            warn('Polygon with zero-coordinate {} '.format(z) +
-                 'cropped using im_size = {}'.format(im_size))
-            continue
-        x_min, y_min, x_max, y_max = poly.bounds
-
-        # Shift all points by 0.5 to move coordinates to corner of pixel
-        shifted_poly = Polygon(np.array(poly.exterior.coords)[:, :2] - 0.5)
-
-        points = [Point(x, y) for x, y in
-                  product(np.arange(int(x_min), np.ceil(x_max)),
-                          np.arange(int(y_min), np.ceil(y_max)))]
-        points_in_poly = list(filter(shifted_poly.contains, points))
-        for point in points_in_poly:
-            xx, yy = point.xy
-            x = int(xx[0])
-            y = int(yy[0])
-            if 0 <= y < im_size[1] and 0 <= x < im_size[2]:
-                mask[z, y, x] = True
-        masks.append(mask[0, :, :])
-
-    return masks
-
-
 def calculate_spatialweights_around_roi(indir, roi_masks, roi_centroids,
-                                        neuropil_radius, min_neuropil_radius, fname):
+                                        neuropil_radius, min_neuropil_radius, fname, im_shape=None):
     # roi_centroids has order (x,y). The index for any roi_masks is in row, col shape or y,x shape.
-    # So be careful to flip the order when you subtract from centroid
-    numrois = len(roi_masks)
-    allrois_mask = np.logical_not(np.sum(roi_masks, axis=0))
-    (im_ysize, im_xsize) = allrois_mask.shape
-    y_base = np.tile(np.array([range(1, im_ysize + 1)]).transpose(), (1, im_xsize))
-    x_base = np.tile(np.array(range(1, im_xsize + 1)), (im_ysize, 1))
-
-    # Set weights for a minimum radius around all ROIs to zero as not the whole ROI is drawn
-    deadzones_aroundrois = np.ones((im_ysize, im_xsize))
-    for roi in range(numrois):
-        x_diff = x_base - roi_centroids[roi][0]
-        y_diff = y_base - roi_centroids[roi][1]
-        dist_from_centroid = np.sqrt(x_diff ** 2 + y_diff ** 2)
-        temp = np.ones((im_ysize, im_xsize))
-        temp[dist_from_centroid < min_neuropil_radius] = 0
-        deadzones_aroundrois *= temp
-
-    allrois_mask *= deadzones_aroundrois.astype(bool)
+    # For multi-plane masks (num_rois, planes, y, x) the deadzones and the pixels excluded for containing ROIs are
+    # computed per plane, and each ROI's weights lie on its own plane (saved in the 'roi_planes' dataset)
+    # roi_masks can also be a scipy.sparse (num_rois, y * x) matrix of a single plane (e.g. from suite2p_rois), in
+    # which case im_shape (y, x) is needed. See neuropil_engine for the weights
+    roi_planes, deadzones_aroundrois, allrois_mask = neuropil_engine.neuropil_exclusion(roi_masks, roi_centroids,
+                                                                                         min_neuropil_radius, im_shape)
+    (num_planes, im_ysize, im_xsize) = deadzones_aroundrois.shape
+    numrois = len(roi_planes)
 
     h5 = h5py.File(os.path.join(indir, '%s_spatialweights_%d_%d.h5' % (fname,
                                                                        min_neuropil_radius,
@@ -181,29 +134,24 @@ def calculate_spatialweights_around_roi(indir, roi_masks, roi_centroids,
         'spatialweights', output_shape, maxshape=output_shape,
         chunks=(1, output_shape[1], output_shape[2]))
 
-    h5['/'].create_dataset('deadzones_aroundrois', data=deadzones_aroundrois) # CZ added; saves ROI deadzone maps
+    # CZ added; saves ROI deadzone maps ((y, x) for single-plane data, (planes, y, x) otherwise)
+    h5['/'].create_dataset('deadzones_aroundrois',
+                           data=deadzones_aroundrois[0] if num_planes == 1 else deadzones_aroundrois)
+    h5['/'].create_dataset('roi_planes', data=roi_planes)
 
     for roi in range(numrois):
-        x_diff = x_base - roi_centroids[roi][0]
-        y_diff = y_base - roi_centroids[roi][1]
-        dist_from_centroid = np.sqrt(x_diff ** 2 + y_diff ** 2)
-        spatialweights = np.exp(-(x_diff ** 2 + y_diff ** 2) / neuropil_radius ** 2)
-        spatialweights *= im_ysize * im_xsize / np.sum(spatialweights)
-
-        # Set weights for a minimum radius around the ROI to zero
-        # spatialweights[dist_from_centroid<min_neuropil_radius] = 0
-        # Set weights for pixels containing other ROIs to 0
-        spatialweights *= allrois_mask
-        """fig, ax = plt.subplots()
-        ax.imshow(spatialweights, cmap='gray')
-        raise Exception()"""
-        h5['/spatialweights'][roi, :, :] = spatialweights
+        # Set weights for pixels containing other ROIs (and the deadzones) to 0
+        h5['/spatialweights'][roi, :, :] = neuropil_engine.roi_spatialweights(roi_centroids[roi], neuropil_radius,
+                                                                               allrois_mask[roi_planes[roi]])
 
     h5.close()
 
 
 def calculate_neuropil_signals(fpath, neuropil_radius, min_neuropil_radius,
-                               masked=False):
+                               masked=False, metrics=None):
+
+    if metrics is None:
+        metrics = stage_metrics.StageMetrics()
 
     savedir = os.path.dirname(fpath)
     fname = os.path.basename(fpath)  # contains extension
@@ -216,56 +164,35 @@ def calculate_neuropil_signals(fpath, neuropil_radius, min_neuropil_radius,
     simadir = fname + '_mc.sima'
 
     #     correct_sima_paths(h5filepath, savedir, simadir, dual_channel, masked=masked)
-    dataset = sima.ImagingDataset.load(os.path.join(savedir, simadir))
-    sequence = dataset.sequences[0]
-    frame_iter1 = iter(sequence)
-
-    def fill_gaps(framenumber):  # adapted from SIMA source code
-        first_obs = next(frame_iter1)
-        for frame in frame_iter1:
-            for frame_chan, fobs_chan in zip(frame, first_obs):
-                fobs_chan[np.isnan(fobs_chan)] = frame_chan[np.isnan(fobs_chan)]
-            if all(np.all(np.isfinite(chan)) for chan in first_obs):
-                break
-        most_recent = [x * np.nan for x in first_obs]
-        while True:
-            frame = np.array(sequence[framenumber])[0, :, :, :, :]
-            for fr_chan, mr_chan in zip(frame, most_recent):
-                mr_chan[np.isfinite(fr_chan)] = fr_chan[np.isfinite(fr_chan)]
-            temp = [np.nan_to_num(mr_ch) + np.isnan(mr_ch) * fo_ch
-                    for mr_ch, fo_ch in zip(most_recent, first_obs)]
-            framenumber = yield np.array(temp)[0, :, :, 0]
-
-    fill_gapscaller = fill_gaps(0)
-    fill_gapscaller.send(None)
-
-    roi_centroids, im_shape, roi_polygons = calculate_roi_centroids(savedir, fname)
-    roi_masks = calculate_roi_masks(roi_polygons, im_shape)
-
-    calculate_spatialweights_around_roi(savedir, roi_masks, roi_centroids,
-                                        neuropil_radius, min_neuropil_radius, fname)
-
-    h5weights = h5py.File(os.path.join(savedir, '%s_spatialweights_%d_%d.h5' % (fname,
-                                                                                min_neuropil_radius, neuropil_radius)),
-                          'r')
-    spatialweights = h5weights['/spatialweights']
-
-    numframes = dataset._num_frames
-    neuropil_signals = np.nan * np.ones((len(roi_masks), numframes))
+    sequence = neuropil_engine.movie_from_sima(savedir, fname)
+
+    roi_masks, roi_centroids, im_shape = neuropil_engine.rois_from_sima(savedir, fname)
+
+    with metrics.stage('spatial_weights'):
+        calculate_spatialweights_around_roi(savedir, roi_masks, roi_centroids,
+                                            neuropil_radius, min_neuropil_radius, fname)
+
+    with h5py.File(os.path.join(savedir, '%s_spatialweights_%d_%d.h5' % (fname,
+                                                                         min_neuropil_radius, neuropil_radius)),
+                   'r') as h5weights:
+        # read once instead of on every frame
+        spatialweights = h5weights['/spatialweights'][()]
+        roi_planes = h5weights['/roi_planes'][()]
+
+    numframes = len(sequence)
 
     # pb = ProgressBar(numframes)
     start_time = time.time()
-    for frame in range(numframes):
-        # temp = np.array(dataset.sequences[0][frame])[:,0,:,:,0]
-        temp = fill_gapscaller.send(frame)[None, :, :]  # this will fill gaps in rows by interpolation
-        neuropil_signals[:, frame] = np.einsum('ijk,ijk,ijk->i', spatialweights,
-                                               temp, np.isfinite(temp))  # /np.sum(spatialweights, axis=(1,2))
-        # The einsum method above is way faster than multiplying array elements individually
-        # The above RHS basically implements a nanmean and averages over x and y pixels
-
-        # pb.animate(frame+1)
-    neuropil_signals /= np.sum(spatialweights, axis=(1, 2))[:, None]
+    with metrics.stage('neuropil_signals', numframes):
+        # one pass over the movie in blocks of frames; _fill_gaps fills the rows left empty by motion correction with
+        # the nearest observed data. Each block is one matrix product per plane for all ROIs and channels
+        frame_blocks = neuropil_engine.iter_movie_blocks(sequence, fill_gaps=True)
+        neuropil_signals = neuropil_engine.weighted_traces(frame_blocks, spatialweights, roi_planes)
     print 'Took %.1f seconds to analyze %s\n' % (time.time() - start_time, savedir)
+
+    # (num_rois, num_frames) for single-channel data, (channels, num_rois, num_frames) otherwise
+    if neuropil_signals.shape[0] == 1:
+        neuropil_signals = neuropil_signals[0]
     np.save(os.path.join(savedir, '%s_neuropilsignals_%d_%d.npy' % (fname,
                                                                     min_neuropil_radius,
                                                                     neuropil_radius)),
@@ -273,7 +200,7 @@ def calculate_neuropil_signals(fpath, neuropil_radius, min_neuropil_radius,
 
 
 def calculate_neuropil_signals_for_session(fpath, fparams,
-                                           masked=True):
+                                           masked=True, metrics=None):
     # define default params or from custom fparams
     if "neuropil_radius" not in fparams:
         neuropil_radius = 50
@@ -299,19 +226,21 @@ def calculate_neuropil_signals_for_session(fpath, fparams,
     # load extracted signals for ROIs
     signals = np.squeeze(np.load(os.path.join(indir, npyfile)))
 
-    # calculate mean fluorescence for each ROI
-    simadir = fname + '_mc.sima'
-    dataset = sima.ImagingDataset.load(os.path.join(savedir, simadir))
-    roi_centroids, im_shape, roi_polygons = calculate_roi_centroids(savedir, fname)
-    roi_masks = calculate_roi_masks(roi_polygons, im_shape)
-    mean_roi_response = np.nansum(roi_masks * dataset.time_averages[:, :, :, 0], axis=(1, 2)) / np.sum(roi_masks,
-                                                                                                       axis=(1, 2))
+    # calculate mean fluorescence for each ROI (and channel)
+    roi_masks, roi_centroids, im_shape = neuropil_engine.rois_from_sima(savedir, fname)
+    _, plane_masks = roi_planes_from_masks(roi_masks)
+    # projections are stored without singleton plane/channel dimensions; restore (planes, y, x, channels)
+    mean_img = projections.load_projection(savedir, fname, 'mean_img')
+    mean_img = np.nan_to_num(mean_img).reshape(plane_masks.shape[1:] + (-1,))
+    mean_roi_response = np.einsum('rpyx,pyxc->cr', plane_masks, mean_img) / np.sum(plane_masks, axis=(1, 2, 3))
+    if mean_roi_response.shape[0] == 1:
+        mean_roi_response = mean_roi_response[0]
     # Vijay: sima divides signals by mean response (?), so revert this
-    signals *= mean_roi_response[:, None]
+    signals *= mean_roi_response[..., None]
 
     # main npil signal calculation function
     calculate_neuropil_signals(os.path.join(indir, fname), neuropil_radius,
-                               min_neuropil_radius, masked=masked)
+                               min_neuropil_radius, masked=masked, metrics=metrics)
 
     # load npil signals
     neuropil_signals = np.squeeze(np.load(os.path.join(indir,
@@ -367,8 +296,9 @@ def calculate_neuropil_coefficients_for_session(indir, signals, neuropil_signals
 
         return beta_rois, skewness_rois
     else:
-        skewness_rois[:, 0] = stats.skew(signals, axis=1)
-        skewness_rois[:, 1] = stats.skew(signals - beta_neuropil * neuropil_signals, axis=1)
+        # signals are (rois, time) or (channels, rois, time); skewness is returned with the same leading dimensions
+        skewness_rois = np.stack([stats.skew(signals, axis=-1),
+                                  stats.skew(signals - beta_neuropil * neuropil_signals, axis=-1)], axis=-1)
 
         return beta_neuropil, skewness_rois
 
@@ -398,35 +328,183 @@ def CDFplot(x, ax, color=None, label='', linetype='-'):
     return ax
 
 
+class SessionResults(object):
+
+    """
+    Lazy, read-only view of the outputs of a processed session.
+
+    The session folder is listed once when the object is made; each output is only loaded the first time it is
+    accessed and is then cached. npy files are memory-mapped, so only the parts that are used get read from disk.
+    Outputs can be accessed as attributes or dictionary keys (same keys as the old load_analyzed_data dictionary):
+
+        masks, mean_img, h5weights, extract_signals, npil_sig, npil_corr_sig
+
+    Use as a context manager (or call close()) so the spatial weights h5 file is closed deterministically:
+
+        with SessionResults(indir, fname) as analyzed_data:
+            plot_ROI_masks(save_dir, analyzed_data['mean_img'], analyzed_data['masks'])
+
+    """
+
+    def __init__(self, indir, fname):
+        self.indir = indir
+        self.fbasename = os.path.splitext(fname)[0]
+
+        self._files = sorted(f for f in os.listdir(indir) if os.path.isfile(os.path.join(indir, f)))
+
+        self._loaders = {'masks': self._load_masks,
+                         'mean_img': self._load_mean_img,
+                         'h5weights': self._load_h5weights,
+                         'extract_signals': self._load_extract_signals,
+                         'npil_sig': self._load_npil_sig,
+                         'npil_corr_sig': self._load_npil_corr_sig}
+        self._cache = {}
+
+    def _find(self, names, pattern):
+        matches = [f for f in names if pattern in f and self.fbasename in f]
+        if not matches:
+            raise IOError('No file matching %s for %s in %s' % (pattern, self.fbasename, self.indir))
+        return os.path.join(self.indir, matches[0])
+
+    def _load_masks(self):
+        return np.load(self._find(self._files, '_sima_masks.npy'), mmap_mode='r')
+
+    def _load_mean_img(self):
+        # mean img of the motion-corrected data from the session's projection file
+        return projections.load_projection(self.indir, self.fbasename, 'mean_img')
+
+    def _load_h5weights(self):
+        return h5py.File(self._find(self._files, '_spatialweights_'), 'r')
+
+    def _load_extract_signals(self):
+        return np.squeeze(np.load(self._find(self._files, 'extractedsignals.npy'), mmap_mode='r'))
+
+    def _load_npil_sig(self):
+        return np.load(self._find(self._files, 'neuropilsignals'), mmap_mode='r')
+
+    def _load_npil_corr_sig(self):
+        return np.load(self._find(self._files, 'neuropil_corrected_signals'), mmap_mode='r')
+
+    def __getitem__(self, key):
+        if key not in self._loaders:
+            raise KeyError(key)
+        if key not in self._cache:
+            self._cache[key] = self._loaders[key]()
+        return self._cache[key]
+
+    def __getattr__(self, name):
+        # only called for attributes that don't exist otherwise, i.e. the lazily loaded outputs
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, key):
+        return key in self._loaders
+
+    def keys(self):
+        return sorted(self._loaders.keys())
+
+    def close(self):
+        if 'h5weights' in self._cache:
+            self._cache['h5weights'].close()
+        # dropping the memory maps releases the file handles
+        self._cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def load_analyzed_data(indir, fname):
+    # outputs are loaded on first access; see SessionResults
+    return SessionResults(indir, fname)
 
-    analyzed_data = {}
-    fbasename = os.path.splitext(fname)[0]
-
-    tempfiles = os.walk(indir).next()[2]  # os.walk grabs the folders [1] and files [2] in the specified directory
-    tempfolders = os.walk(indir).next()[1]
-
-    # load masks
-    mask_file = [f for f in tempfiles if '_sima_masks.npy' in f and fbasename in f][0]
-    analyzed_data['masks'] = np.load(os.path.join(indir, mask_file))
-    # load motion-corrected data (just the mean img)
-    sima_mc_file = [f for f in tempfolders if '_mc.sima' in f and fbasename in f][0]
-    dataset = sima.ImagingDataset.load(os.path.join(indir, sima_mc_file))
-    analyzed_data['mean_img'] = np.squeeze(dataset.time_averages[..., 0])
-    # load spatial weights
-    spatial_weight_file = [f for f in tempfiles if '_spatialweights_' in f and fbasename in f][0]
-    analyzed_data['h5weights'] = h5py.File(os.path.join(indir, spatial_weight_file), 'r')
-    # load extracted signals
-    extract_sig_file = [f for f in tempfiles if 'extractedsignals.npy' in f and fbasename in f][0]
-    analyzed_data['extract_signals'] = np.squeeze(np.load(os.path.join(indir, extract_sig_file)))
-    # load masks
-    npil_sig_file = [f for f in tempfiles if 'neuropilsignals' in f and fbasename in f][0]
-    analyzed_data['npil_sig'] = np.load(os.path.join(indir, npil_sig_file))
-    # load masks
-    npilcorr_sig_file = [f for f in tempfiles if 'neuropil_corrected_signals' in f and fbasename in f][0]
-    analyzed_data['npil_corr_sig'] = np.load(os.path.join(indir, npilcorr_sig_file))
-
-    return analyzed_data
+
+# QC figures are drawn with matplotlib's object-oriented api on Agg canvases (no pyplot state, no display needed).
+# Per-ROI figures are made once per worker and only their data is updated for each ROI.
+
+# font files matplotlib keeps open once it has drawn text
+_font_extensions = ('.ttf', '.otf', '.ttc', '.afm', '.pfb')
+# set once a figure of this module was made in this process; see _holds_font_files
+_made_figures = False
+
+
+def _new_figure(figsize):
+    global _made_figures
+    _made_figures = True
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _save_figure(fig, save_dir, fbasename, file_types=('png', 'pdf')):
+    for file_type in file_types:
+        fig.savefig(os.path.join(save_dir, '{}.{}'.format(fbasename, file_type)))
+
+
+def _chunk_indices(num_items, num_chunks):
+    return [chunk for chunk in np.array_split(np.arange(num_items), max(1, num_chunks)) if len(chunk)]
+
+
+def _holds_font_files():
+    # whether this process has font files open, i.e. has drawn text; without /proc (macOS) only the figures of this
+    # module are known
+    fd_dir = '/proc/self/fd'
+    if not os.path.isdir(fd_dir):
+        return _made_figures
+    for fd in os.listdir(fd_dir):
+        try:
+            path = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if path.lower().endswith(_font_extensions):
+            return True
+    return False
+
+
+def _render_pool(num_processes):
+    # forked workers would share the parent's open FreeType font files (and their read offsets), which garbles the
+    # glyphs when several processes render text at once. Python 3 starts fresh (spawned) workers; python 2 can only
+    # fork (except on windows), so there it returns None, i.e. render in this process, once this process drew text
+    if hasattr(mp, 'get_context'):
+        return mp.get_context('spawn').Pool(processes=num_processes)
+    if sys.platform != 'win32' and _holds_font_files():
+        return None
+    return mp.Pool(processes=num_processes)
+
+
+def _run_tasks(func, tasks, n_workers):
+    # renders in separate processes when possible; workers of the batch_process pool are daemonic and can't start
+    # their own pool, so there (and for n_workers=1, or see _render_pool) the tasks are rendered one after another
+    pool = None
+    if n_workers > 1 and len(tasks) > 1 and not mp.current_process().daemon:
+        pool = _render_pool(min(n_workers, len(tasks)))
+    if pool is not None:
+        try:
+            pool.map(func, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            func(task)
+
+
+def _iter_weights(weights_source, roi_indices):
+    # weights_source is either an array of spatial weights or (h5 path, dataset name), so workers can read
+    # their own rois from the h5 file instead of having them pickled over
+    if isinstance(weights_source, tuple):
+        with h5py.File(weights_source[0], 'r') as h5:
+            for iROI in roi_indices:
+                yield iROI, h5[weights_source[1]][iROI]
+    else:
+        for iROI, weight in zip(roi_indices, weights_source):
+            yield iROI, np.asarray(weight)
 
 
 def plot_ROI_masks(save_dir, mean_img, masks):
@@ -436,75 +514,187 @@ def plot_ROI_masks(save_dir, mean_img, masks):
     # plot each ROI's cell mask
     to_plot = np.sum(masks, axis=0)  # all ROIs
 
-    plt.figure(figsize=(10, 10))
-    plt.imshow(mean_img)
-    plt.clim(clims[0], clims[1])
-    plt.imshow(to_plot, cmap='gray', alpha=0.3)
+    fig = _new_figure((10, 10))
+    ax = fig.add_subplot(111)
+    ax.imshow(mean_img, vmin=clims[0], vmax=clims[1])
+    ax.imshow(to_plot, cmap='gray', alpha=0.3)
 
     for iROI, roi_mask in enumerate(masks):
         ypix_roi, xpix_roi = np.where(roi_mask == 1)
-        plt.text(np.min(xpix_roi), np.min(ypix_roi), str(iROI), fontsize=13, color='white')
+        ax.text(np.min(xpix_roi), np.min(ypix_roi), str(iROI), fontsize=13, color='white')
 
-    plt.title('ROI Cell Masks', fontsize=20)
-    plt.axis('off')
-    plt.savefig(os.path.join(save_dir, 'cell_masks.png'));
-    plt.savefig(os.path.join(save_dir, 'cell_masks.pdf'));
-    plt.close()
+    ax.set_title('ROI Cell Masks', fontsize=20)
+    ax.axis('off')
+    _save_figure(fig, save_dir, 'cell_masks')
 
 
 def plot_deadzones(save_dir, mean_img, deadzones):
 
-    plt.figure(figsize=(10, 10))
-    plt.imshow(mean_img)
-    plt.imshow(deadzones, cmap='gray', alpha=0.1)
-    plt.title('ROI Soma Deadzones', fontsize=20)
-    plt.tick_params(labelleft=False, labelbottom=False)
-    plt.savefig(os.path.join(save_dir, 'deadzone_masks.png'));
-    plt.savefig(os.path.join(save_dir, 'deadzone_masks.pdf'));
-    plt.close()
+    fig = _new_figure((10, 10))
+    ax = fig.add_subplot(111)
+    ax.imshow(mean_img)
+    ax.imshow(deadzones, cmap='gray', alpha=0.1)
+    ax.set_title('ROI Soma Deadzones', fontsize=20)
+    ax.tick_params(labelleft=False, labelbottom=False)
+    _save_figure(fig, save_dir, 'deadzone_masks')
+
+
+def _make_npil_weight_fig(mean_img):
+    fig = _new_figure((10, 10))
+    ax = fig.add_subplot(111)
+    ax.imshow(mean_img)
+    overlay = ax.imshow(np.zeros_like(mean_img), cmap='gray', alpha=0.5)
+    title = ax.set_title('', fontsize=20)
+    ax.axis('off')
+    return fig, overlay, title
+
+
+def _update_npil_weight_fig(fig_artists, iROI, weight):
+    fig, overlay, title = fig_artists
+    overlay.set_data(weight)
+    overlay.set_clim(np.min(weight), np.max(weight))
+    title.set_text('ROI {} Npil Spatial Weights'.format(iROI))
+    return fig
+
+
+def _render_npil_weights(task):
+    save_dir, mean_img, weights_source, roi_indices = task
+    fig_artists = _make_npil_weight_fig(mean_img)
+    for iROI, weight in _iter_weights(weights_source, roi_indices):
+        fig = _update_npil_weight_fig(fig_artists, iROI, weight)
+        _save_figure(fig, save_dir, 'roi_{}_npil_weight'.format(iROI))
+
+
+def _contact_sheet_grid(num_panels, panel_size):
+    num_cols = int(np.ceil(np.sqrt(num_panels)))
+    num_rows = int(np.ceil(num_panels / float(num_cols)))
+    fig = _new_figure((num_cols * panel_size[0], num_rows * panel_size[1]))
+    return fig, num_rows, num_cols
+
+
+def plot_npil_weights(save_dir, mean_img, spatial_weights, output='per_roi', n_workers=1):
+    """
+    Parameters
+    ----------
+    spatial_weights : h5py dataset or np array
+        (num_rois, y, x) neuropil weights; h5 datasets are read directly by the rendering workers
+    output : 'per_roi', 'multipage' or 'contact_sheet'
+        'per_roi' saves a png and pdf for every ROI; 'multipage' saves one pdf with a page per ROI;
+        'contact_sheet' saves one png with a small panel per ROI
+    n_workers : int
+        number of processes rendering the per_roi figures
+    """
+
+    num_rois = len(spatial_weights)
+
+    if output == 'per_roi':
+        if isinstance(spatial_weights, h5py.Dataset):
+            tasks = [(save_dir, mean_img, (spatial_weights.file.filename, spatial_weights.name), chunk)
+                     for chunk in _chunk_indices(num_rois, n_workers)]
+        else:
+            tasks = [(save_dir, mean_img, spatial_weights[chunk], chunk)
+                     for chunk in _chunk_indices(num_rois, n_workers)]
+        _run_tasks(_render_npil_weights, tasks, n_workers)
+
+    elif output == 'multipage':
+        fig_artists = _make_npil_weight_fig(mean_img)
+        with PdfPages(os.path.join(save_dir, 'npil_weights.pdf')) as pdf:
+            for iROI in range(num_rois):
+                pdf.savefig(_update_npil_weight_fig(fig_artists, iROI, spatial_weights[iROI]))
+
+    elif output == 'contact_sheet':
+        # downsample so each panel only draws about as many pixels as it displays
+        step = max(1, mean_img.shape[0] // 128)
+        fig, num_rows, num_cols = _contact_sheet_grid(num_rois, (2, 2))
+        for iROI in range(num_rois):
+            ax = fig.add_subplot(num_rows, num_cols, iROI + 1)
+            ax.imshow(mean_img[::step, ::step])
+            ax.imshow(spatial_weights[iROI][::step, ::step], cmap='gray', alpha=0.5)
+            ax.set_title('ROI {}'.format(iROI), fontsize=8)
+            ax.axis('off')
+        fig.tight_layout()
+        _save_figure(fig, save_dir, 'npil_weights_contact_sheet', file_types=('png',))
+
+    else:
+        raise ValueError('output must be per_roi, multipage or contact_sheet')
+
+
+def z_score(sig_in):
+    # z-score time series
+    return (sig_in - np.mean(sig_in)) / np.std(sig_in)
+
 
+def _make_corrected_sig_fig(tvec):
+    fig = _new_figure((15, 5))
+    ax = [fig.add_subplot(1, 2, 1), fig.add_subplot(1, 2, 2)]
+    line_sig, = ax[0].plot(tvec, np.zeros_like(tvec), alpha=0.8)
+    line_corr, = ax[0].plot(tvec, np.zeros_like(tvec), alpha=0.5)
+    ax[0].legend(['Extracted sig', 'Npil-corr Sig'], fontsize=15)
+    ax[0].set_xlabel('Time [s]', fontsize=15)
+    ax[0].set_ylabel('Normalized Fluorescence', fontsize=15)
+    ax[0].set_title('Normalized ROI Signal', fontsize=15)
 
-def plot_npil_weights(save_dir, mean_img, spatial_weights):
+    line_npil, = ax[1].plot(tvec, np.zeros_like(tvec), alpha=0.6)
+    ax[1].legend(['Neuropil Sig'], fontsize=15)
+    ax[1].set_xlabel('Time [s]', fontsize=15)
+    ax[1].set_ylabel('Fluorescence', fontsize=15)
+    ax[1].set_title('Raw Neuropil Signal', fontsize=15)
+    return fig, ax, (line_sig, line_corr, line_npil)
 
-    for iROI, ROI_npil_weight in enumerate(spatial_weights):
-        plt.figure(figsize=(10, 10))
-        plt.imshow(mean_img)
-        plt.imshow(ROI_npil_weight, cmap='gray', alpha=0.5)
-        plt.title('ROI {} Npil Spatial Weights'.format(iROI), fontsize=20)
-        plt.axis('off');
-        plt.savefig(os.path.join( save_dir, 'roi_{}_npil_weight.png'.format(iROI) ));
-        plt.savefig(os.path.join(save_dir, 'roi_{}_npil_weight.pdf'.format(iROI)));
-        plt.close()
 
+def _update_corrected_sig_fig(fig_artists, sig, corr_sig, npil_sig):
+    fig, ax, lines = fig_artists
+    for line, ydata in zip(lines, [z_score(sig), z_score(corr_sig), npil_sig]):
+        line.set_ydata(ydata)
+    for axis in ax:
+        axis.relim()
+        axis.autoscale_view()
+    return fig
 
-def plot_corrected_sigs(save_dir, extracted_signals, signals_npil_corr, npil_signals, fparams):
 
-    # function to z-score time series
-    z_score = lambda sig_in: (sig_in - np.mean(sig_in)) / np.std(sig_in)
+def _render_corrected_sigs(task):
+    save_dir, tvec, roi_indices, extracted_signals, signals_npil_corr, npil_signals = task
+    fig_artists = _make_corrected_sig_fig(tvec)
+    for iROI, sig, corr_sig, npil_sig in zip(roi_indices, extracted_signals, signals_npil_corr, npil_signals):
+        fig = _update_corrected_sig_fig(fig_artists, sig, corr_sig, npil_sig)
+        _save_figure(fig, save_dir, 'roi_{}_signal'.format(iROI))
+
+
+def plot_corrected_sigs(save_dir, extracted_signals, signals_npil_corr, npil_signals, fparams, output='per_roi',
+                        n_workers=1):
+    # output and n_workers: see plot_npil_weights
 
     if "fs" not in fparams:
         fs = 30
     else:
         fs = fparams['fs']
 
+    num_rois = extracted_signals.shape[0]
     num_samples = extracted_signals.shape[-1]
     tvec = np.linspace(0, num_samples / fs, num_samples)
 
     # plot the ROI pixel-avg signal, npil signal, and npil corrected ROI signal
-    for iROI, (sig, corr_sig, npil_sig) in enumerate(zip(extracted_signals, signals_npil_corr, npil_signals)):
-        fig, ax = plt.subplots(1, 2, figsize=(15, 5))
-        ax[0].plot(tvec, z_score(sig), alpha=0.8)
-        ax[0].plot(tvec, z_score(corr_sig), alpha=0.5)
-        ax[0].legend(['Extracted sig', 'Npil-corr Sig'], fontsize=15);
-        ax[0].set_xlabel('Time [s]', fontsize=15);
-        ax[0].set_ylabel('Normalized Fluorescence', fontsize=15);
-        ax[0].set_title('Normalized ROI Signal', fontsize=15);
-
-        ax[1].plot(tvec, npil_sig, alpha=0.6)
-        ax[1].legend(['Neuropil Sig'], fontsize=15);
-        ax[1].set_xlabel('Time [s]', fontsize=15);
-        ax[1].set_ylabel('Fluorescence', fontsize=15);
-        ax[1].set_title('Raw Neuropil Signal', fontsize=15);
-        fig.savefig(os.path.join( save_dir, 'roi_{}_signal.png'.format(iROI) ));
-        fig.savefig(os.path.join(save_dir, 'roi_{}_signal.pdf'.format(iROI)));
-        plt.close()
\ No newline at end of file
+    if output == 'per_roi':
+        tasks = [(save_dir, tvec, chunk, np.asarray(extracted_signals[chunk]), np.asarray(signals_npil_corr[chunk]),
+                  np.asarray(npil_signals[chunk])) for chunk in _chunk_indices(num_rois, n_workers)]
+        _run_tasks(_render_corrected_sigs, tasks, n_workers)
+
+    elif output == 'multipage':
+        fig_artists = _make_corrected_sig_fig(tvec)
+        with PdfPages(os.path.join(save_dir, 'corrected_signals.pdf')) as pdf:
+            for sig, corr_sig, npil_sig in zip(extracted_signals, signals_npil_corr, npil_signals):
+                pdf.savefig(_update_corrected_sig_fig(fig_artists, sig, corr_sig, npil_sig))
+
+    elif output == 'contact_sheet':
+        fig, num_rows, num_cols = _contact_sheet_grid(num_rois, (4, 1.5))
+        for iROI, (sig, corr_sig) in enumerate(zip(extracted_signals, signals_npil_corr)):
+            ax = fig.add_subplot(num_rows, num_cols, iROI + 1)
+            ax.plot(tvec, z_score(sig), alpha=0.8, linewidth=0.5)
+            ax.plot(tvec, z_score(corr_sig), alpha=0.5, linewidth=0.5)
+            ax.set_title('ROI {}'.format(iROI), fontsize=8)
+            ax.tick_params(labelsize=6)
+        fig.tight_layout()
+        _save_figure(fig, save_dir, 'corrected_signals_contact_sheet', file_types=('png',))
+
+    else:
+        raise ValueError('output must be per_roi, multipage or contact_sheet')
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Template-based FFT registration, a fast alternative to sima's HiddenMarkov2D row-wise motion correction for
+sessions with modest motion (fparams['mc_method'] = 'rigid' or 'piecewise_rigid', see files_to_analyze.py).
+
+The displacement of each frame relative to a template image is found by phase correlation: the peak of the inverse
+FFT of the whitened cross-power spectrum of frame and template, searched within max_shift. The template FFT is
+computed once (PhaseCorrelationEngine) and the frames are processed in batches, with one vectorized FFT per batch
+and the batches spread over a pool of threads (numpy releases the GIL in its FFT and array operations).
+
+    - 'rigid': one (dy, dx) shift per frame
+    - 'piecewise_rigid': the frame is split into horizontal strips, each registered to its part of the template
+      (within max_strip_deviation of the rigid shift, with the correlation maps of neighbouring strips averaged to
+      suppress noise peaks), and the strip shifts are interpolated to every row. Strips along y are used because
+      sima stores motion correction as one displacement per row; this also covers the slow-scan distortions that
+      the row-wise HMM corrects.
+
+FFTMotionCorrection wraps the engine in sima's MotionEstimationStrategy interface, so it is a drop-in replacement
+for HiddenMarkov2D: its correct() method writes the same "_mc.sima" dataset (with row-wise displacements) that
+sima_motion_bidi_correction.full_process turns into the "_sima_mc.h5" file and projections.
+
+How to use:
+
+    mc_approach = fft_registration.FFTMotionCorrection(max_displacement=[30, 50], method='rigid')
+    dataset = mc_approach.correct(sequences, 'session_mc.sima')
+
+or, on frames in memory:
+
+    engine = fft_registration.PhaseCorrelationEngine(fft_registration.make_template(frames, (20, 20)), (20, 20))
+    shifts = engine.estimate_shifts(frames)  # (frames, 2) displacement of each frame relative to the template
+    registered = fft_registration.shift_frame(frames[0], -shifts[0], engine.template)
+
+"""
+
+import multiprocessing as mp
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from sima.motion.motion import MotionEstimationStrategy
+
+import bidi_offset_correction
+
+
+def _shift_slices(length, shift):
+    # (target, source) slices that move an axis by shift pixels: target[i] = source[i - shift]
+    if shift >= 0:
+        return slice(shift, length), slice(0, length - shift)
+    return slice(0, length + shift), slice(-shift, length)
+
+
+def shift_frame(frame, shift, fill):
+    # moves the frame content by (dy, dx) pixels; the pixels shifted in are taken from fill (an image of the same
+    # shape, e.g. the template) so the weighted sums over them stay close to the baseline
+    out = np.array(fill, dtype='float32')
+    (dst_y, src_y), (dst_x, src_x) = _shift_slices(frame.shape[0], shift[0]), _shift_slices(frame.shape[1], shift[1])
+    out[dst_y, dst_x] = frame[src_y, src_x]
+    return out
+
+
+def _taper(shape):
+    # window that keeps the image borders from dominating the phase correlation
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype('float32')
+
+
+def _whitened_fft(images, taper):
+    # FFT of the mean subtracted, tapered images over the last two dimensions
+    images = np.asarray(images, dtype='float32')
+    images = images - images.mean(axis=(-2, -1), keepdims=True)
+    return np.fft.rfft2(images * taper)
+
+
+class PhaseCorrelationEngine(object):
+
+    def __init__(self, template, max_shift, num_strips=None, max_strip_deviation=3):
+        """
+        Parameters
+        ----------
+        template : np array
+            (y, x) reference image
+        max_shift : tuple of two ints
+            largest (dy, dx) displacement searched (capped below half the frame size)
+        num_strips : int or None
+            number of horizontal strips for piecewise rigid registration (estimate_row_shifts); None for rigid only
+        max_strip_deviation : int
+            largest difference (pixels) between the shift of a strip and the rigid shift of the frame
+        """
+
+        self.template = np.asarray(template, dtype='float32')
+        self.frame_shape = self.template.shape
+        self.max_shift = [min(int(max_shift[dim]), self.frame_shape[dim] // 2 - 1) for dim in range(2)]
+        self.max_strip_deviation = max_strip_deviation
+
+        # signed lags searched, and where they are in the circular cross-correlation
+        self.lags = [np.arange(-self.max_shift[dim], self.max_shift[dim] + 1) for dim in range(2)]
+
+        self._taper = _taper(self.frame_shape)
+        self._template_fft_conj = np.conj(_whitened_fft(self.template, self._taper))
+
+        self.num_strips = num_strips
+        if num_strips:
+            num_rows = self.frame_shape[0]
+            # strips overlap by half their height
+            self.strip_height = min(num_rows, max(2 * num_rows // num_strips, 16))
+            self.strip_starts = np.linspace(0, num_rows - self.strip_height, num_strips).astype(int)
+            self._strip_rows = self.strip_starts[:, None] + np.arange(self.strip_height)
+            strip_shape = (self.strip_height, self.frame_shape[1])
+            self._strip_taper = _taper(strip_shape)
+            self._strip_template_fft_conj = np.conj(_whitened_fft(self.template[self._strip_rows],
+                                                                  self._strip_taper))
+            # linear interpolation of the strip shifts (at the strip centers) to every row, as a (rows, strips) matrix
+            strip_centers = self.strip_starts + (self.strip_height - 1) / 2.0
+            rows = np.arange(num_rows)
+            self._row_interp = np.column_stack([np.interp(rows, strip_centers, np.eye(num_strips)[strip])
+                                                for strip in range(num_strips)])
+
+    def _xcorr_windows(self, images_fft, template_fft_conj, shape):
+        # phase correlation of each image with its template within the searched lags: (..., lags_y, lags_x)
+        cross_power = images_fft * template_fft_conj
+        cross_power /= np.abs(cross_power) + 1e-6
+        xcorr = np.fft.irfft2(cross_power, s=shape)
+        rows = self.lags[0] % shape[0]
+        cols = self.lags[1] % shape[1]
+        return xcorr[..., rows[:, None], cols[None, :]]
+
+    def _peak_shifts(self, windows):
+        # signed (dy, dx) lag of the maximum of each window
+        flat_peaks = np.argmax(windows.reshape(windows.shape[:-2] + (-1,)), axis=-1)
+        peak_y, peak_x = np.unravel_index(flat_peaks, windows.shape[-2:])
+        return np.stack([self.lags[0][peak_y], self.lags[1][peak_x]], axis=-1)
+
+    def estimate_shifts(self, frames):
+        """
+        Returns the (frames, 2) integer (dy, dx) displacements of the frame content relative to the template for a
+        (frames, y, x) batch; shift each frame by minus its displacement to register it.
+        """
+
+        frames_fft = _whitened_fft(frames, self._taper)
+        return self._peak_shifts(self._xcorr_windows(frames_fft, self._template_fft_conj, self.frame_shape))
+
+    def estimate_row_shifts(self, frames, rigid_shifts=None):
+        """
+        Piecewise rigid registration: returns the (frames, rows, 2) integer displacements of every row, interpolated
+        between the shifts of the strips; each strip shift lies within max_strip_deviation of the rigid shift.
+        """
+
+        if not self.num_strips:
+            raise ValueError('PhaseCorrelationEngine was created without strips (num_strips)')
+
+        frames = np.asarray(frames, dtype='float32')
+        if rigid_shifts is None:
+            rigid_shifts = self.estimate_shifts(frames)
+
+        strips_fft = _whitened_fft(frames[:, self._strip_rows], self._strip_taper)  # (frames, strips, h, x)
+        strip_shape = (self.strip_height, self.frame_shape[1])
+        windows = self._xcorr_windows(strips_fft, self._strip_template_fft_conj, strip_shape)
+        # average each strip's correlation map with those of its neighbours (weights 1/4, 1/2, 1/4); strips with
+        # little structure then follow their neighbours instead of picking up a noise peak
+        padded = np.concatenate([windows[:, :1], windows, windows[:, -1:]], axis=1)
+        windows = 0.25 * padded[:, :-2] + 0.5 * padded[:, 1:-1] + 0.25 * padded[:, 2:]
+
+        # only search near the rigid shift of the frame; strips hold too little structure for the full range
+        far_y = np.abs(self.lags[0][None, :] - rigid_shifts[:, 0:1]) > self.max_strip_deviation
+        far_x = np.abs(self.lags[1][None, :] - rigid_shifts[:, 1:2]) > self.max_strip_deviation
+        far = far_y[:, None, :, None] | far_x[:, None, None, :]
+        strip_shifts = self._peak_shifts(np.where(far, -np.inf, windows))
+
+        row_shifts = np.einsum('rs,fsd->frd', self._row_interp, strip_shifts.astype(float))
+        return np.round(row_shifts).astype(int)
+
+
+def make_template(frames, max_shift, num_iterations=2):
+    """
+    Template for registration from a (frames, y, x) sample of a movie: the mean image, sharpened by registering the
+    frames to it and averaging again (num_iterations times).
+    """
+
+    frames = np.asarray(frames, dtype='float32')
+    template = frames.mean(axis=0)
+    for _ in range(num_iterations):
+        engine = PhaseCorrelationEngine(template, max_shift)
+        shifts = engine.estimate_shifts(frames)
+        # center the template on the median position so that the displacements stay small
+        shifts -= np.round(np.median(shifts, axis=0)).astype(int)
+        template = np.mean([shift_frame(frame, -shift, template) for frame, shift in zip(frames, shifts)], axis=0)
+    return template
+
+
+def _iter_batches(sequence, batch_size):
+    # (frames, planes, y, x) float32 batches of a sima sequence, averaged over channels
+    batch = []
+    for frame in sequence:
+        batch.append(np.mean(frame, axis=-1))
+        if len(batch) == batch_size:
+            yield np.array(batch, dtype='float32')
+            batch = []
+    if batch:
+        yield np.array(batch, dtype='float32')
+
+
+class FFTMotionCorrection(MotionEstimationStrategy):
+
+    """
+    sima motion estimation strategy (like sima.motion.HiddenMarkov2D) based on PhaseCorrelationEngine.
+
+    Parameters
+    ----------
+    max_displacement : list of two ints
+        maximum allowed (y, x) displacement in pixels
+    method : string
+        'rigid' or 'piecewise_rigid'
+    num_strips : int
+        number of horizontal strips for 'piecewise_rigid'
+    max_strip_deviation : int
+        largest difference (pixels) between the shift of a strip and the rigid shift of its frame
+    num_template_frames : int
+        number of evenly spaced frames averaged into the template of each plane
+    batch_size : int
+        frames per vectorized FFT batch
+    n_threads : int or None
+        threads processing the batches; defaults to the number of CPUs
+    verbose : bool
+    """
+
+    def __init__(self, max_displacement=(30, 50), method='rigid', num_strips=8, max_strip_deviation=3,
+                 num_template_frames=200, batch_size=100, n_threads=None, verbose=True):
+        if method not in ['rigid', 'piecewise_rigid']:
+            raise ValueError("method must be 'rigid' or 'piecewise_rigid'")
+        self.max_displacement = max_displacement
+        self.method = method
+        self.num_strips = num_strips if method == 'piecewise_rigid' else None
+        self.max_strip_deviation = max_strip_deviation
+        self.num_template_frames = num_template_frames
+        self.batch_size = batch_size
+        self.n_threads = n_threads or mp.cpu_count()
+        self.verbose = verbose
+
+    def _make_engines(self, sequence):
+        """
+        Returns one engine per plane, with the template made from evenly spaced frames, and the bidirectional offset
+        of the data. The frames are bidi corrected before registration: otherwise, for shifts by an odd number of
+        rows, the even rows of a frame are matched to the odd rows of the template and the x shift is off by the
+        offset. The offset is still corrected afterwards by full_process, as for HiddenMarkov2D.
+        """
+
+        num_frames = len(sequence)
+        frame_indices = np.unique(np.linspace(0, num_frames - 1, min(num_frames, self.num_template_frames)).astype(int))
+        sample = np.array([np.mean(sequence._get_frame(t), axis=-1) for t in frame_indices], dtype='float32')
+
+        # the offset is a property of the scanner, so it is estimated on the first plane and applied to all of them
+        bidi_obj = bidi_offset_correction.bidi_offset_correction(sample[:, 0])
+        bidi_offset = bidi_obj.compute_mean_image().determine_bidi_offset().bidi_offset
+        sample = bidi_offset_correction.correct_bidi_rows(sample, bidi_offset)
+
+        engines = []
+        for plane in range(sample.shape[1]):
+            template = make_template(sample[:, plane], self.max_displacement)
+            engines.append(PhaseCorrelationEngine(template, self.max_displacement, self.num_strips,
+                                                  self.max_strip_deviation))
+        return engines, bidi_offset
+
+    def _estimate_batch(self, engines, bidi_offset, batch):
+        # (frames, planes, rows, 2) displacements of the rows of a (frames, planes, y, x) batch
+        batch = bidi_offset_correction.correct_bidi_rows(batch, bidi_offset)
+        row_shifts = np.empty(batch.shape[:3] + (2,), dtype=int)
+        for plane, engine in enumerate(engines):
+            shifts = engine.estimate_shifts(batch[:, plane])
+            if engine.num_strips:
+                row_shifts[:, plane] = engine.estimate_row_shifts(batch[:, plane], shifts)
+            else:
+                row_shifts[:, plane] = shifts[:, None, :]
+        return row_shifts
+
+    def _estimate(self, dataset):
+        """
+        Returns
+        -------
+        displacements : list of (frames, planes, rows, 2) int arrays
+            one per sequence, in sima's convention: the position of each row in the corrected frame, i.e. minus the
+            displacement of its content relative to the template (estimate() then makes them non-negative)
+        """
+
+        displacements = []
+        pool = ThreadPool(self.n_threads)
+        try:
+            for sequence in dataset:
+                engines, bidi_offset = self._make_engines(sequence)
+                sequence_displacements = []
+                batches = _iter_batches(sequence, self.batch_size)
+                # batches are read in the main thread (sequences aren't thread safe) and registered n_threads at a
+                # time, so only that many batches are held in memory
+                while True:
+                    wave = list(islice(batches, self.n_threads))
+                    if not wave:
+                        break
+                    sequence_displacements.extend(pool.map(
+                        lambda batch: self._estimate_batch(engines, bidi_offset, batch), wave))
+                    if self.verbose:
+                        print('Registered {} frames'.format(sum(len(d) for d in sequence_displacements)))
+                # a frame displaced by +d is moved back by -d
+                displacements.append(-np.concatenate(sequence_displacements))
+        finally:
+            pool.close()
+            pool.join()
+        return displacements
@@ -23,6 +23,13 @@ fdir : string
         interpret the backslashes as such
     NOTE: there is no need for a last backslash
 
+chunks : list of strings
+    For recordings split over several raw files (e.g. ScanImage's "_00001.tif", "_00002.tif", ... chunks), the file
+    names (with extension, all in fdir) in recording order. They are analyzed as one continuous movie without
+    being concatenated on disk; fname then only sets the name of the outputs (eg. 'session1.tif' gives
+    "session1_mc.sima" and requires "session1_RoiSet.zip"). main_parallel groups such chunks automatically.
+    Default is [fname]
+
 motion_correct: boolean
     Set to True if SIMA motion correction and bidirectional offset correction is desired; otherwise
     set to False
@@ -46,9 +53,27 @@ max_disp : list of two entries
 
     Defaults to [30, 50]
 
+mc_method : string
+    Motion correction method. 'hmm' is SIMA's row-wise hidden Markov model (HiddenMarkov2D): accurate but slow.
+    'rigid' registers every frame to a template image by FFT phase correlation with a single (y, x) shift, and
+    'piecewise_rigid' additionally registers horizontal strips of the frame and interpolates their shifts to every
+    row. Both are many times faster than 'hmm' and are a good choice for sessions with modest motion; the outputs
+    are the same (see fft_registration.py).
+    Defaults to 'hmm'
+
 save_displacement : boolean
-    Whether or not to have SIMA save the calculated displacements over time. def: False; NOTE: if this is switched to True,
-    it can double the time to perform motion correction.
+    The motion correction displacements (per row, per frame, and the range of the row displacements within each
+    frame) are always stored as int16 arrays in the "_sima_mc.h5" file. Set to True to also save them as
+    "displacement.pkl" in the "_mc.sima" folder and the composite displacement of each frame as
+    "displacements/displacements_sima.npy"; this costs no extra computation.
+
+    Defaults to False
+
+displacement_sidecar : boolean
+    Store the motion correction displacements of the "_mc.sima" folder in a memory-mapped "displacements.npy" next
+    to its sequences.pkl instead of inside it. sequences.pkl then stays small, so the bidirectional offset correction
+    and calculate_neuropil.correct_sima_paths update the folder in place instead of re-pickling hundreds of MB for
+    long sessions. Such folders can only be opened with sima_mc_wrapper on the python path (see sequence_io.py).
 
     Defaults to False
 
@@ -66,6 +91,61 @@ min_neuropil_radius : int
     whose neuropil is being calculated.
     Default will be 15 pixels
 
+num_planes : int
+    Number of imaging planes of volumetric recordings. In tif files the pages are ordered frame, plane, channel;
+    in h5 files the imaging dataset is (time, planes, y, x, channels). ROIs are assigned to a plane by the z
+    coordinate of their polygon, and ROI masks, neuropil weights and neuropil signals are calculated per plane.
+    Default is 1
+
+channel_names : list of strings
+    One name per recorded channel (e.g. ['GCaMP', 'tdTomato']). Signals are extracted and neuropil corrected for
+    every channel; with more than one channel the signal files get a leading channel dimension
+    (channels, rois, frames). Motion correction and the bidirectional offset use all channels and the first
+    channel respectively.
+    Default is ['GCaMP']
+
+tiff_reader : string
+    'memmap' reads uncompressed tif files through a memory map, which is faster than sima's own TIFF reader;
+    compressed files automatically fall back to sima's reader. Either way the "_mc.sima" folder records sima's own
+    TIFF reader, so it can be opened by code outside of sima_mc_wrapper (see sequence_io.py). Set to 'sima' to always
+    use sima's reader.
+    Default is 'memmap'
+
+corr_img : boolean
+    Also save a local correlation image (mean correlation of each pixel with its 8 neighbours) of the motion
+    corrected data; helps finding dim cells when drawing ROIs. Computed in the same pass as the other projections.
+    Default is False
+
+percentile_imgs : list of numbers
+    Percentile projection images to save (e.g. [10, 50]), estimated from a random sample of frames.
+    Default is None (no percentile images)
+
+plots : string
+    Which QC figures to save. 'full' saves all figures, 'summary' only the ROI mask and deadzone overlays on the
+    mean image, and 'none' skips plotting. Figures can also be made later with single_file_process.plot_session.
+    Default is 'full'
+
+plot_output : string
+    How the per-ROI neuropil weight and signal figures are saved. 'per_roi' saves a png and pdf for every ROI,
+    'multipage' saves a single pdf with one page per ROI, and 'contact_sheet' saves one png with a small panel
+    per ROI. The latter two are much faster for sessions with many ROIs.
+    Default is 'per_roi'
+
+plot_workers : int
+    Number of processes used to render the per_roi figures when the session is not run inside the
+    main_parallel pool (pool workers can't start processes of their own and render in series).
+    Default is 4
+
+profile : boolean or string
+    Set to True (or 'cprofile') to profile each processing step with cProfile; 'sampling' uses the pyinstrument
+    sampling profiler if it is installed. For each step a .prof file and a text summary of the slowest functions
+    are saved in a "_profiles" folder next to the session outputs. Useful for diagnosing a slow session.
+    Default is False
+
+profile_top_n : int
+    Number of functions listed in each profiling text summary.
+    Default is 30
+
 Output
 ------
 
@@ -6,6 +6,8 @@
 Finds any .tif, .tiff, .h5 files in the requested directory and performs SIMA-based motion correction and fft-based bidirection 
 offset correction, signal extraction, and neuropil correction. This code parallelizes the computation at the session level
 by passing the multiple file paths (if there are more than one recordings) to the multiprocessing map function.
+Recordings that ScanImage split into several "_00001.tif", "_00002.tif", ... files are analyzed as one session named
+after the common part of the file names (eg. "session1_00001.tif" and "session1_00002.tif" give "session1_mc.sima").
 
 IMPORTANT RECOMENDATION: This pipeline requires the user to manually draw regions-of-interest (ROIs) on the mean
 image (usually the motion-corrected output). The ROI zip file must end in "_RoiSet" with the extension ".zip".
@@ -49,15 +51,21 @@ max_disp : list of two entries
     
     Defaults to [30, 50]
     
-save_displacement : bool 
-    Whether or not to have SIMA save the calculated displacements over time. def: False; NOTE: if this is switched to True,
-    it can double the time to perform motion correction.
+save_displacement : bool
+    The motion correction displacements (per row, per frame, and the range of the row displacements within each
+    frame) are always stored as int16 arrays in the "_sima_mc.h5" file. Set to True to also save them as
+    "displacement.pkl" in the "_mc.sima" folder and the composite displacement of each frame as
+    "displacements/displacements_sima.npy"; this costs no extra computation.
     
     Defaults to False
     
 Output
 -------
-motion corrected file (in the format of h5) with "_sima_mc" appended to the end of the file name
+motion corrected file (in the format of h5) with "_sima_mc" appended to the end of the file name; besides the
+'imaging' data it holds the motion correction displacements (see sima_motion_bidi_correction.displacement_summaries)
+
+"*_projections.h5" : h5 file
+    mean, max and std projection images (mean_img, max_img, std_img) of the motion corrected data
 
 "*_sima_masks.npy" : numpy data file
     3D array containing 2D masks for each ROI
@@ -77,8 +85,12 @@ motion corrected file (in the format of h5) with "_sima_mc" appended to the end
 "*.json" : json file
     file containing the analysis parameters (fparams). Set by files_to_analyze.py or default parameters.
     to view the data, one can easily open in a text editor (eg. word or wordpad).
+    The "stage_metrics" entry holds the wall time, cpu time, peak memory, bytes read/written and frames/sec
+    of each processing stage (see stage_metrics.py).
 
 output_images : folder containing images
+    rendered after the computations of each session by a separate low-priority process. fparams['plots'] selects
+    'full' (default), 'summary' (ROI masks and deadzones only) or 'none'.
 
 You will also find a folder containing plots that reflect how each executed preprocessing step performed. Examples are mean images for motion corrected data, ROI masks overlaid on mean images, extracted signals for each ROI, etc..
 note: * is a wildcard indicating additional characters present in the file name
@@ -95,6 +107,7 @@ import os
 import sima_motion_bidi_correction
 import calculate_neuropil
 import single_file_process
+import sequence_io
 import files_to_analyze
 
 
@@ -116,18 +129,21 @@ def batch_process(root_dir, max_disp=[30, 50], save_displacement=False):
 
         # find files to analyze
         for path, subdirs, files in os.walk(root_dir):  # os.walk grabs all paths and files in subdirectories
-            for name in files:
-                # make sure file of any image file
-                if any([fnmatch(name, ext) for ext in types]) and not any(
-                        [exclude_str in name for exclude_str in exclude_strs]):  # but don't include processed files
-                    tmp_dict = {}
-                    tmp_dict['fname'] = name
-                    tmp_dict['fdir'] = path
-                    tmp_dict['max_disp'] = max_disp
-                    tmp_dict['save_displacement'] = save_displacement
-
-                    print(tmp_dict['fname'])
-                    fparams.append(tmp_dict)
+            # make sure file of any image file
+            names = [name for name in files if any([fnmatch(name, ext) for ext in types]) and not any(
+                [exclude_str in name for exclude_str in exclude_strs])]  # but don't include processed files
+
+            # recordings that ScanImage split into "_00001.tif", "_00002.tif", ... files are analyzed as one session
+            for session_name, chunks in sequence_io.group_chunks(names):
+                tmp_dict = {}
+                tmp_dict['fname'] = session_name
+                tmp_dict['fdir'] = path
+                tmp_dict['chunks'] = chunks
+                tmp_dict['max_disp'] = max_disp
+                tmp_dict['save_displacement'] = save_displacement
+
+                print(tmp_dict['fname'])
+                fparams.append(tmp_dict)
 
     # print info to console
     num_files = len(fparams)
@@ -140,15 +156,55 @@ def batch_process(root_dir, max_disp=[30, 50], save_displacement=False):
     print('Total CPU cores for parallel processing: ' + str(num_processes))
     pool = mp.Pool(processes=num_processes)
 
+    # QC figures are rendered by a separate low-priority process that reads each session's saved outputs, so the
+    # compute workers can start on the next session as soon as one finishes
+    plot_queue = mp.Queue()
+    plotter = mp.Process(target=plot_queue_worker, args=(plot_queue,))
+    plotter.start()
+
     # perform parallel processing; pass iterable list of file params to the analysis module selection code
-    pool.map(single_file_process.process, fparams)
+    try:
+        for session_fparams in pool.imap_unordered(single_file_process.unpack,
+                                                   [(fparam, False) for fparam in fparams]):
+            if needs_plots(session_fparams):
+                plot_queue.put(session_fparams)
+    finally:
+        pool.close()
+        pool.join()
+        plot_queue.put(None)  # tells the plotting process there are no more sessions
+        plotter.join()
 
     ## for testing
     # for fparam in fparams:
     #    single_file_process.process(fparam)
 
-    pool.close()
-    pool.join()
+
+def needs_plots(session_fparams):
+    # figures are only made for neuropil corrected sessions (the outputs they show), unless turned off
+    return session_fparams['npil_correct'] and session_fparams['plots'] != 'none'
+
+
+def lower_process_priority():
+    # let the compute workers take precedence over figure rendering
+    if hasattr(os, 'nice'):
+        os.nice(10)
+    else:
+        try:
+            import psutil
+            psutil.Process().nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)  # windows
+        except ImportError:
+            pass
+
+
+def plot_queue_worker(plot_queue):
+    # renders the figures of each session put on the queue until it receives None
+    lower_process_priority()
+    for session_fparams in iter(plot_queue.get, None):
+        try:
+            single_file_process.plot_session(session_fparams)
+        except Exception as err:
+            # a failed figure shouldn't stop the plots of the remaining sessions
+            print('Plotting failed for {}: {}'.format(session_fparams['fname'], err))
 
 
 if __name__ == "__main__":
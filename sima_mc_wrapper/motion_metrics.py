@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Quality metrics for comparing motion correction outputs (raw data, SIMA, suite2p, caiman, ...), as used in
+in_development/compare_motionCorr.py. The metrics follow Pnevmatikakis EA, Giovannucci A. NoRMCorre: An online
+algorithm for piecewise rigid motion correction of calcium imaging data. J Neurosci Methods. 2017;291:83-94:
+
+    - correlation to mean (CM): Pearson correlation of every frame with the mean image of its dataset
+    - crispness: Frobenius norm of the pixel-wise gradient magnitude of the mean image; a sharper mean image (less
+      blurring by residual motion) has larger gradients. block_crispness tracks it over the session using the means
+      of consecutive blocks of frames
+    - residual motion by optical flow (FlowMetric, requires opencv): Farneback flow of every frame relative to the
+      mean image, kept as per-frame summary statistics (FLOW_STATS)
+    - feature drift (KLTDriftMetric, requires opencv): Shi-Tomasi corners of the mean image tracked into every
+      frame with pyramidal Lucas-Kanade; per-frame median displacement of the tracked features (KLT_STATS)
+
+All metrics stream the movies in blocks of frames (see projections.iter_frame_blocks), so h5 files are read
+without loading the whole movie into memory.
+
+compare_datasets computes all metrics for several datasets at once. Each dataset is a LazyMovie (h5 file opened only
+while it is read) whose crop, intensity scale (suite2p halves intensities) and dtype are applied per block; all
+datasets are cropped to the smallest common field of view around their centers. The datasets are read in lockstep in
+two passes: the first accumulates the mean images and per-block crispness, the second the metrics that need the mean
+image as reference (CM and any other frame_metrics).
+
+How to use:
+
+    sources = OrderedDict([('raw', 'session.h5'), ('sima', 'session_sima_mc.h5'),
+                           ('suite2p', LazyMovie('session_suite2p_mc.h5', scale=2))])
+    results = motion_metrics.compare_datasets(sources)
+    results['sima']['frame_corr']  # (frames,) correlation of each frame with results['sima']['mean_img']
+
+"""
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import h5py
+import numpy as np
+
+try:
+    import cv2
+    have_cv2 = True
+except ImportError:
+    have_cv2 = False
+
+import projections
+
+# per-frame summary statistics of an optical flow field (columns of FlowMetric's output)
+FLOW_STATS = ('norm', 'mean_magnitude', 'max_magnitude', 'mean_dy', 'mean_dx')
+# per-frame drift of the tracked features (columns of KLTDriftMetric's output)
+KLT_STATS = ('drift_y', 'drift_x', 'drift', 'num_tracked')
+
+
+def open_h5_movie(path, key=None):
+    """
+    Returns the (open) h5py file and the movie dataset in it: the given key, 'imaging' (the dataset the pipeline
+    writes) or otherwise the first dataset in the file
+    """
+
+    h5 = h5py.File(path, 'r')
+    if key is None:
+        key = 'imaging' if 'imaging' in h5 else list(h5.keys())[0]
+    return h5, h5[key]
+
+
+def crop_center(img, cropx, cropy):
+    """ Crops the last two (y, x) dimensions of an image or (frames, y, x) block equally on each side """
+
+    y, x = img.shape[-2:]
+    startx = x // 2 - cropx // 2
+    starty = y // 2 - cropy // 2
+    return img[..., starty:starty + cropy, startx:startx + cropx]
+
+
+class LazyMovie(object):
+    """
+    A (frames, y, x) movie read in blocks, with crop, intensity scale and dtype applied to each block.
+
+    Parameters
+    ----------
+    source : string or np array
+        h5 file path (opened only inside a with block, see open_h5_movie) or array-like movie
+    scale : number
+        intensity scale, e.g. 2 for suite2p outputs, which divide intensities by 2
+    dtype : string or None
+        dtype of the blocks (None keeps the stored dtype); the scale is applied after the cast, in place
+    key : string or None
+        dataset in the h5 file
+    """
+
+    def __init__(self, source, scale=1, dtype='int16', key=None):
+        self.source = source
+        self.scale = scale
+        self.dtype = dtype
+        self.key = key
+        self.crop_shape = None  # (y, x); set by compare_datasets
+        self._h5 = None
+        self._data = source if hasattr(source, 'shape') else None
+
+    def __enter__(self):
+        if self._data is None:
+            self._h5, self._data = open_h5_movie(self.source, self.key)
+        return self
+
+    def __exit__(self, *args):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+            self._data = None
+
+    @property
+    def shape(self):
+        # (frames, y, x) with singleton plane/channel dimensions removed
+        shape = self._data.shape
+        return (shape[0],) + tuple(dim for dim in shape[1:] if dim != 1)
+
+    def read_block(self, start, stop):
+        block = projections._squeeze_frame_dims(np.asarray(self._data[start:stop]))
+        if self.crop_shape is not None:
+            block = crop_center(block, self.crop_shape[1], self.crop_shape[0])
+        if self.dtype is not None:
+            block = block.astype(self.dtype)
+        if self.scale != 1:
+            np.multiply(block, self.scale, out=block, casting='unsafe')
+        return block
+
+
+def _unit_reference(ref_img):
+    # reference image flattened, centered and scaled to unit norm, so a frame's correlation is one dot product
+    ref = np.asarray(ref_img, dtype='float64').ravel()
+    ref = ref - ref.mean()
+    return (ref / np.linalg.norm(ref)).astype('float32')
+
+
+def frame_correlations(source, ref_img=None, block_size=100):
+    """
+    Pearson correlation of every frame with a reference image.
+
+    Parameters
+    ----------
+    source : np array, h5py dataset or sima sequence
+        (frames, y, x) movie; see projections.iter_frame_blocks
+    ref_img : np array or None
+        (y, x) reference; by default the mean image of the source (computed in a first streamed pass)
+    block_size : int
+        frames per block; each block costs one matrix-vector product
+
+    Returns
+    -------
+    frame_corr : np array (frames,)
+    """
+
+    if ref_img is None:
+        ref_img = projections.mean_image(source, block_size)
+    block_correlations = correlation_metric(ref_img)
+    return np.concatenate([block_correlations(block) for block in projections.iter_frame_blocks(source, block_size)])
+
+
+def correlation_metric(ref_img):
+    """ Frame metric (see compare_datasets) computing the Pearson correlation of each frame of a block with ref_img """
+
+    ref = _unit_reference(ref_img)
+
+    def block_correlations(block):
+        block = block.reshape(block.shape[0], -1).astype('float32')
+        block -= block.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(block, axis=1)
+        norms[norms == 0] = np.inf  # constant frames have zero correlation
+        return np.dot(block, ref) / norms
+
+    return block_correlations
+
+
+def correlation_to_mean(sources, block_size=100, key=None):
+    """
+    Correlation to mean (CM) metric of several datasets in one call (uncropped, stored dtype); see compare_datasets.
+
+    Returns
+    -------
+    results : OrderedDict of dataset name -> {'mean_img': (y, x) mean image, 'frame_corr': (frames,) CM}
+    """
+
+    results = compare_datasets(sources, block_size, key=key, crop=False, dtype=None)
+    return OrderedDict((name, {'mean_img': result['mean_img'], 'frame_corr': result['frame_corr']})
+                       for name, result in results.items())
+
+
+def gradient_magnitude(img):
+    """ Pixel-wise magnitude of the image gradient, sqrt(dy**2 + dx**2) """
+
+    dy, dx = np.gradient(np.asarray(img, dtype='float64'))
+    return np.hypot(dy, dx)
+
+
+def crispness(img):
+    """ Crispness C(I) = || |grad I| ||_F of an image (NoRMCorre paper) """
+
+    return np.linalg.norm(gradient_magnitude(img), ord='fro')
+
+
+def block_crispness(source, block_size=100):
+    """
+    Crispness of the mean image of each block of frames, to follow registration quality over a session.
+
+    Parameters
+    ----------
+    source : np array, h5py dataset or sima sequence
+        (frames, y, x) movie; see projections.iter_frame_blocks
+    block_size : int
+        frames averaged per crispness value (the last block may be shorter)
+
+    Returns
+    -------
+    block_crisp : np array (blocks,)
+    """
+
+    return np.array([crispness(block.mean(axis=0)) for block in projections.iter_frame_blocks(source, block_size)])
+
+
+class FlowMetric(object):
+    """
+    Frame metric (see compare_datasets): Farneback optical flow of each frame relative to a reference image.
+
+    Frames are downsampled by resize_fact (cv2.INTER_AREA) and the flows of a block are computed in a thread pool
+    (opencv releases the GIL). Only per-frame summary statistics are kept, in pixels of the original frames, as
+    (frames, len(FLOW_STATS)) rows; full flow fields are kept only for every field_stride-th frame.
+
+    Parameters
+    ----------
+    ref_img : np array
+        (y, x) reference, e.g. the dataset's mean image
+    resize_fact : float
+        downsampling of the frames before computing the flow
+    pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags :
+        cv2.calcOpticalFlowFarneback parameters
+    n_threads : int or None
+        threads per block (None: number of cpus)
+    field_stride : int or None
+        keep the (downsampled) flow field of every field_stride-th frame; see extra_results
+    """
+
+    def __init__(self, ref_img, resize_fact=0.2, pyr_scale=0.5, levels=3, winsize=100, iterations=15, poly_n=5,
+                 poly_sigma=1.2 / 5, flags=0, n_threads=None, field_stride=None):
+        if not have_cv2:
+            raise ImportError('the optical flow metric requires opencv (cv2)')
+
+        self.resize_fact = resize_fact
+        self.flow_params = (pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags)
+        self.n_threads = n_threads
+        self.field_stride = field_stride
+        self.template = self._prepare(ref_img)
+        self.sampled_fields = []
+        self.sampled_frames = []
+        self._num_frames = 0
+
+    def _prepare(self, img):
+        img = np.asarray(img, dtype='float32')
+        if self.resize_fact != 1:
+            img = cv2.resize(img, (0, 0), fx=self.resize_fact, fy=self.resize_fact, interpolation=cv2.INTER_AREA)
+        return img
+
+    def _frame_flow(self, frame):
+        flow = cv2.calcOpticalFlowFarneback(self.template, self._prepare(frame), None, *self.flow_params)
+        flow /= self.resize_fact  # (y, x, [dx, dy]) in pixels of the original frames
+        magnitude = np.hypot(flow[..., 0], flow[..., 1])
+        stats = [np.linalg.norm(magnitude), magnitude.mean(), magnitude.max(), flow[..., 1].mean(),
+                 flow[..., 0].mean()]
+        return stats, flow
+
+    def __call__(self, block):
+        pool = ThreadPool(self.n_threads)
+        try:
+            flows = pool.map(self._frame_flow, list(block))
+        finally:
+            pool.close()
+
+        if self.field_stride:
+            for idx, (_, flow) in enumerate(flows):
+                frame_idx = self._num_frames + idx
+                if frame_idx % self.field_stride == 0:
+                    self.sampled_fields.append(flow)
+                    self.sampled_frames.append(frame_idx)
+        self._num_frames += len(flows)
+        return np.array([stats for stats, _ in flows], dtype='float32')
+
+    def extra_results(self):
+        if not self.field_stride:
+            return {}
+        return {'flow_fields': np.array(self.sampled_fields), 'flow_field_frames': np.array(self.sampled_frames)}
+
+
+def optical_flow_stats(source, ref_img=None, block_size=100, **flow_kwargs):
+    """
+    Per-frame optical flow statistics of a movie relative to a reference image (by default its mean image).
+
+    Returns
+    -------
+    flow_stats : np array (frames, len(FLOW_STATS))
+    flow_metric : FlowMetric
+        with the sampled flow fields if field_stride was given
+    """
+
+    if ref_img is None:
+        ref_img = projections.mean_image(source, block_size)
+    flow_metric = FlowMetric(ref_img, **flow_kwargs)
+    flow_stats = np.concatenate([flow_metric(block) for block in projections.iter_frame_blocks(source, block_size)])
+    return flow_stats, flow_metric
+
+
+class KLTDriftMetric(object):
+    """
+    Frame metric (see compare_datasets): drift of features of a reference image, tracked into each frame.
+
+    Features (cv2.goodFeaturesToTrack) are detected once on the reference and tracked from the reference into every
+    frame_stride-th frame with cv2.calcOpticalFlowPyrLK, the frames of a block in a thread pool; nothing is drawn.
+    Images are converted to uint8 (as calcOpticalFlowPyrLK requires) with the reference's 1st-99.9th percentile
+    intensity range. Each frame gets a row of KLT_STATS: the median (y, x) displacement of the tracked features, its
+    magnitude and the number of features tracked; frames skipped by frame_stride get NaN drift and 0 features.
+
+    Parameters
+    ----------
+    ref_img : np array
+        (y, x) reference, e.g. the dataset's mean image
+    frame_stride : int
+        track every frame_stride-th frame
+    max_corners, quality_level, min_distance, block_size :
+        cv2.goodFeaturesToTrack parameters
+    win_size, max_level, criteria :
+        cv2.calcOpticalFlowPyrLK parameters
+    n_threads : int or None
+        threads per block (None: number of cpus)
+    """
+
+    def __init__(self, ref_img, frame_stride=1, max_corners=10, quality_level=0.3, min_distance=7, block_size=7,
+                 win_size=(15, 15), max_level=2, criteria=None, n_threads=None):
+        if not have_cv2:
+            raise ImportError('the feature drift metric requires opencv (cv2)')
+
+        if criteria is None:
+            criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
+        self.frame_stride = frame_stride
+        self.lk_params = dict(winSize=tuple(win_size), maxLevel=max_level, criteria=criteria)
+        self.n_threads = n_threads
+        self._num_frames = 0
+
+        ref_img = np.asarray(ref_img, dtype='float32')
+        self.intensity_range = np.percentile(ref_img, [1, 99.9])
+        self.template = self._to_uint8(ref_img)
+        self.features = cv2.goodFeaturesToTrack(self.template, maxCorners=max_corners, qualityLevel=quality_level,
+                                                minDistance=min_distance, blockSize=block_size)
+        if self.features is None:
+            raise ValueError('no features to track in the reference image')
+
+    def _to_uint8(self, img):
+        low, high = self.intensity_range
+        img = (np.asarray(img, dtype='float32') - low) * (255. / max(high - low, 1e-6))
+        return np.clip(img, 0, 255).astype('uint8')
+
+    def _frame_drift(self, frame):
+        tracked, status, _ = cv2.calcOpticalFlowPyrLK(self.template, self._to_uint8(frame), self.features, None,
+                                                      **self.lk_params)
+        good = status.ravel() == 1
+        if not np.any(good):
+            return [np.nan, np.nan, np.nan, 0]
+        # feature positions are (x, y)
+        drift_x, drift_y = np.median(tracked[good, 0] - self.features[good, 0], axis=0)
+        return [drift_y, drift_x, np.hypot(drift_y, drift_x), np.sum(good)]
+
+    def __call__(self, block):
+        drift = np.full((len(block), len(KLT_STATS)), np.nan, dtype='float32')
+        drift[:, KLT_STATS.index('num_tracked')] = 0
+        # frames of this block that fall on the stride
+        tracked_idx = np.flatnonzero((self._num_frames + np.arange(len(block))) % self.frame_stride == 0)
+        self._num_frames += len(block)
+        if len(tracked_idx):
+            pool = ThreadPool(self.n_threads)
+            try:
+                drift[tracked_idx] = pool.map(self._frame_drift, [block[idx] for idx in tracked_idx])
+            finally:
+                pool.close()
+        return drift
+
+
+def klt_drift(source, ref_img=None, block_size=100, **klt_kwargs):
+    """
+    Per-frame drift (rows of KLT_STATS) of the features of a reference image (by default the movie's mean image);
+    see KLTDriftMetric for the options.
+    """
+
+    if ref_img is None:
+        ref_img = projections.mean_image(source, block_size)
+    drift_metric = KLTDriftMetric(ref_img, **klt_kwargs)
+    return np.concatenate([drift_metric(block) for block in projections.iter_frame_blocks(source, block_size)])
+
+
+def _as_lazy_movie(source, dtype, key):
+    if isinstance(source, LazyMovie):
+        return source
+    return LazyMovie(source, dtype=dtype, key=key)
+
+
+def _iter_synchronized_blocks(movies, num_frames, block_size):
+    # the same frames of every movie, one block at a time
+    for start in range(0, num_frames, block_size):
+        stop = min(start + block_size, num_frames)
+        yield [movie.read_block(start, stop) for movie in movies]
+
+
+def compare_datasets(sources, block_size=100, key=None, crop=True, dtype='int16', frame_metrics=None):
+    """
+    Streams several datasets in lockstep and computes all motion correction metrics.
+
+    Parameters
+    ----------
+    sources : OrderedDict (or dict) of dataset name -> h5 file path, array or LazyMovie
+        e.g. raw, sima, suite2p and caiman outputs; paths and arrays are wrapped in a LazyMovie with the given
+        dtype and key (use a LazyMovie directly to set the scale)
+    block_size : int
+        frames read per dataset at a time; also the block length of 'block_crispness'
+    crop : bool
+        crop all datasets to the smallest (y, x) among them, around their centers (some packages crop the edges
+        after shifting)
+    frame_metrics : OrderedDict (or dict) of metric name -> factory or None
+        per-frame metrics computed in the second pass; factory(mean_img) returns a function that takes a block and
+        returns one value (or row of values) per frame; if that function has an extra_results method, the dict it
+        returns after the pass is added to the results. Default: {'frame_corr': correlation_metric}
+
+    Returns
+    -------
+    results : OrderedDict of dataset name -> dict with
+        'mean_img' : (y, x) mean image
+        'crispness' : crispness of the mean image
+        'block_crispness' : (blocks,) crispness of the mean of each block of frames
+        and one (frames, ...) array per frame metric. Datasets with more frames than the shortest one are truncated.
+    """
+
+    if frame_metrics is None:
+        frame_metrics = OrderedDict([('frame_corr', correlation_metric)])
+
+    names = list(sources.keys())
+    movies = [_as_lazy_movie(sources[name], dtype, key) for name in names]
+    for movie in movies:
+        movie.__enter__()
+    try:
+        shapes = [movie.shape for movie in movies]
+        num_frames = min(shape[0] for shape in shapes)
+        if crop:
+            crop_shape = (min(shape[1] for shape in shapes), min(shape[2] for shape in shapes))
+            for movie in movies:
+                movie.crop_shape = crop_shape
+
+        # first pass: mean images and block crispness
+        totals = [0] * len(movies)
+        block_crisp = [[] for _ in movies]
+        for blocks in _iter_synchronized_blocks(movies, num_frames, block_size):
+            for idx, block in enumerate(blocks):
+                block_sum = block.sum(axis=0, dtype='float64')
+                totals[idx] = totals[idx] + block_sum
+                block_crisp[idx].append(crispness(block_sum / block.shape[0]))
+        mean_imgs = [total / num_frames for total in totals]
+
+        # second pass: metrics relative to the mean images
+        metric_funcs = [[(metric_name, factory(mean_img)) for metric_name, factory in frame_metrics.items()]
+                        for mean_img in mean_imgs]
+        metric_values = [OrderedDict((metric_name, []) for metric_name in frame_metrics) for _ in movies]
+        for blocks in _iter_synchronized_blocks(movies, num_frames, block_size):
+            for idx, block in enumerate(blocks):
+                for metric_name, func in metric_funcs[idx]:
+                    metric_values[idx][metric_name].append(func(block))
+    finally:
+        for movie in movies:
+            movie.__exit__()
+
+    results = OrderedDict()
+    for idx, name in enumerate(names):
+        results[name] = {'mean_img': mean_imgs[idx],
+                         'crispness': crispness(mean_imgs[idx]),
+                         'block_crispness': np.array(block_crisp[idx])}
+        for metric_name, values in metric_values[idx].items():
+            results[name][metric_name] = np.concatenate(values)
+        for metric_name, func in metric_funcs[idx]:
+            if hasattr(func, 'extra_results'):
+                results[name].update(func.extra_results())
+    return results
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+The ROI masks -> neuropil weights -> neuropil traces steps, in one implementation shared by the pipeline
+(calculate_neuropil), online processing and the suite2p/SIMA neuropil notebooks in in_development.
+
+ROI sources return (roi_masks, roi_centroids, im_shape), with centroids in (x, y) order:
+
+    - rois_from_sima(fdir, fname): ROIs of the latest extraction of the session's .sima folder (signals_0.pkl)
+    - rois_from_imagej(roi_zip_path, im_shape): ImageJ RoiSet zip
+    - rois_from_suite2p(plane_dir): suite2p stat.npy/iscell.npy, as sparse (num_rois, y * x) masks (see suite2p_rois)
+
+Movie sources return a sima sequence, which iter_movie_blocks streams as (frames, planes, y, x, channels) blocks:
+
+    - movie_from_sima(fdir, fname): motion corrected dataset; the rows left empty by motion correction are filled
+    - movie_from_file(fpath): raw h5 or TIFF file (see sequence_io.create_sequence)
+
+Neuropil weights (neuropil_exclusion, roi_spatialweights): a gaussian around each ROI's centroid, zero within
+min_neuropil_radius of any ROI centroid and on the pixels of any ROI of the same plane. The gaussian is separable, so
+each ROI's map is an outer product of a row and a column profile.
+
+Traces (weighted_traces): weighted means of each frame for all ROIs, one matrix product per plane and block of
+frames. Works with the neuropil weights as well as with (dense or sparse) ROI masks.
+
+How to use:
+
+    roi_masks, roi_centroids, im_shape = neuropil_engine.rois_from_suite2p(plane_dir)
+    roi_planes, deadzones, allowed = neuropil_engine.neuropil_exclusion(roi_masks, roi_centroids, 15, im_shape)
+    weights = np.array([neuropil_engine.roi_spatialweights(centroid, 50, allowed[plane])
+                        for centroid, plane in zip(roi_centroids, roi_planes)])
+    blocks = neuropil_engine.iter_movie_blocks(neuropil_engine.movie_from_file(fpath))
+    neuropil_signals = neuropil_engine.weighted_traces(blocks, weights, roi_planes)  # (channels, rois, frames)
+
+"""
+
+import os
+import pickle
+from itertools import product
+from warnings import warn
+
+import numpy as np
+import scipy.sparse
+import sima
+from shapely.geometry import Polygon, Point
+from sima import sequence as sequence_module
+from sima.ROI import ROIList, _reformat_polygons
+
+import sequence_io
+import suite2p_rois
+
+
+def load_rois_for_session(session_folder, fname):
+
+    sima_folder = os.path.join(session_folder, fname + '_mc.sima')
+    with open(os.path.join(session_folder, sima_folder, 'signals_0.pkl'), 'rb') as temp:
+        a = pickle.load(temp)
+    numrois = len(a[sorted(a.keys())[-1]]['rois'])  # Load the latest extraction
+    im_shape = a[sorted(a.keys())[-1]]['rois'][0]['im_shape']  # (planes, y, x)
+    # roi_polygons = [a[sorted(a.keys())[-1]]['rois'][roi_id]['polygons'][0][:,:-1] for roi_id in range(numrois)] # no z coordinate
+    roi_polygons = [a[sorted(a.keys())[-1]]['rois'][roi_id]['polygons'][0] for roi_id in
+                    range(numrois)]  # with z coordinate
+
+    return roi_polygons, im_shape
+
+
+def calculate_roi_centroids(session_folder, fname):
+    roi_polygons, im_shape = load_rois_for_session(session_folder, fname)
+    roi_centroids = [Polygon(roi).centroid.coords[0] for roi in roi_polygons]
+    return roi_centroids, im_shape, roi_polygons
+
+
+def calculate_roi_masks(roi_polygons, im_size):
+    """
+    Returns
+    -------
+    masks : np array (bool)
+        (num_rois, y, x) for single-plane data, (num_rois, planes, y, x) if im_size has more than one plane; each ROI
+        is drawn on the plane given by the z coordinate of its polygon
+    """
+    masks = []
+    if len(im_size) == 2:
+        im_size = (1,) + tuple(im_size)
+    roi_polygons = _reformat_polygons(roi_polygons)
+    for poly in roi_polygons:
+        mask = np.zeros(im_size, dtype=bool)
+        # assuming all points in the polygon share a z-coordinate
+        z = int(np.array(poly.exterior.coords)[0][2])
+        if z >= im_size[0]:
+            warn('Polygon with zero-coordinate {} '.format(z) +
+                 'cropped using im_size = {}'.format(im_size))
+            continue
+        x_min, y_min, x_max, y_max = poly.bounds
+
+        # Shift all points by 0.5 to move coordinates to corner of pixel
+        shifted_poly = Polygon(np.array(poly.exterior.coords)[:, :2] - 0.5)
+
+        points = [Point(x, y) for x, y in
+                  product(np.arange(int(x_min), np.ceil(x_max)),
+                          np.arange(int(y_min), np.ceil(y_max)))]
+        points_in_poly = list(filter(shifted_poly.contains, points))
+        for point in points_in_poly:
+            xx, yy = point.xy
+            x = int(xx[0])
+            y = int(yy[0])
+            if 0 <= y < im_size[1] and 0 <= x < im_size[2]:
+                mask[z, y, x] = True
+        masks.append(mask)
+
+    masks = np.array(masks).reshape((-1,) + tuple(im_size))
+    if im_size[0] == 1:
+        return masks[:, 0]
+    return masks
+
+
+def roi_planes_from_masks(roi_masks):
+    # plane of each ROI and the masks as (num_rois, planes, y, x), for masks from calculate_roi_masks
+    roi_masks = np.asarray(roi_masks)
+    if roi_masks.ndim == 3:
+        roi_masks = roi_masks[:, None]
+    roi_planes = np.array([np.argmax(np.any(mask, axis=(1, 2))) for mask in roi_masks], dtype=int)
+    return roi_planes, roi_masks
+
+
+def rois_from_sima(fdir, fname):
+    roi_centroids, im_shape, roi_polygons = calculate_roi_centroids(fdir, fname)
+    return calculate_roi_masks(roi_polygons, im_shape), roi_centroids, im_shape
+
+
+def rois_from_imagej(roi_zip_path, im_shape):
+    rois = ROIList.load(roi_zip_path, fmt='ImageJ')
+    roi_polygons = [roi.coords[0] for roi in rois]
+    roi_centroids = [Polygon(roi).centroid.coords[0] for roi in roi_polygons]
+    return calculate_roi_masks(roi_polygons, im_shape), roi_centroids, im_shape
+
+
+def rois_from_suite2p(plane_dir, cells_only=True):
+    roi_masks, roi_centroids, im_shape, _ = suite2p_rois.load_suite2p_rois(plane_dir, cells_only)
+    return roi_masks, roi_centroids, im_shape
+
+
+def movie_from_sima(fdir, fname):
+    return sequence_io.load_dataset(os.path.join(fdir, fname + '_mc.sima')).sequences[0]
+
+
+def movie_from_file(fpath, num_planes=1, num_channels=1):
+    return sequence_io.create_sequence(fpath, num_planes=num_planes, num_channels=num_channels)
+
+
+def iter_movie_blocks(sequence, block_size=100, fill_gaps=False):
+    """
+    Yields float32 (frames, planes, y, x, channels) blocks of a sima sequence.
+
+    fill_gaps fills the NaN pixels left by motion correction with the most recent observed values (sima's
+    _fill_gaps); use it for motion corrected sequences (movie_from_sima).
+    """
+
+    frames_array = getattr(sequence, 'frames_array', None)
+    if frames_array is not None and not fill_gaps:
+        # memory-mapped TIFF, (frames, planes, channels, y, x)
+        for start in range(0, frames_array.shape[0], block_size):
+            yield np.asarray(frames_array[start:start + block_size], dtype='float32').transpose(0, 1, 3, 4, 2)
+        return
+
+    if fill_gaps:
+        frames = sequence_module._fill_gaps(iter(sequence), iter(sequence))
+    else:
+        frames = iter(sequence)
+    block = []
+    for frame in frames:
+        block.append(frame)
+        if len(block) == block_size:
+            yield np.array(block, dtype='float32')
+            block = []
+    if block:
+        yield np.array(block, dtype='float32')
+
+
+def neuropil_exclusion(roi_masks, roi_centroids, min_neuropil_radius, im_shape=None):
+    """
+    Pixels that the neuropil weights exclude.
+
+    Parameters
+    ----------
+    roi_masks : np array or scipy.sparse matrix
+        (num_rois, y, x) or (num_rois, planes, y, x) masks (calculate_roi_masks), or sparse (num_rois, y * x) masks of
+        a single plane, in which case im_shape (y, x) is needed
+    roi_centroids : sequence of (x, y)
+    min_neuropil_radius : number
+        pixels closer than this to any ROI centroid (of the same plane) are excluded
+
+    Returns
+    -------
+    roi_planes : np array (num_rois,)
+    deadzones_aroundrois : np array (planes, y, x)
+        0 within min_neuropil_radius of a ROI centroid, 1 elsewhere
+    allowed : np array (planes, y, x) bool
+        pixels outside the deadzones and outside all ROIs
+    """
+
+    if scipy.sparse.issparse(roi_masks):
+        (numrois, num_planes, (im_ysize, im_xsize)) = (roi_masks.shape[0], 1, im_shape)
+        roi_planes = np.zeros(numrois, dtype=int)
+        allowed = np.logical_not(roi_masks.getnnz(axis=0).reshape(1, im_ysize, im_xsize))
+    else:
+        roi_planes, roi_masks = roi_planes_from_masks(roi_masks)
+        (numrois, num_planes, im_ysize, im_xsize) = roi_masks.shape
+        allowed = np.logical_not(np.any(roi_masks, axis=0))
+
+    # pixel coordinates start at 1, as in the original weight computation
+    y_base = np.arange(1, im_ysize + 1)
+    x_base = np.arange(1, im_xsize + 1)
+    min_radius_sq = min_neuropil_radius ** 2
+    deadzones_aroundrois = np.ones((num_planes, im_ysize, im_xsize))
+    for roi in range(numrois):
+        # only the rows and columns within the radius can be in the deadzone
+        y_diff_sq = (y_base - roi_centroids[roi][1]) ** 2
+        x_diff_sq = (x_base - roi_centroids[roi][0]) ** 2
+        rows = np.flatnonzero(y_diff_sq < min_radius_sq)
+        cols = np.flatnonzero(x_diff_sq < min_radius_sq)
+        if len(rows) == 0 or len(cols) == 0:
+            continue
+        rows = slice(rows[0], rows[-1] + 1)
+        cols = slice(cols[0], cols[-1] + 1)
+        inside = y_diff_sq[rows, None] + x_diff_sq[None, cols] < min_radius_sq
+        deadzones_aroundrois[roi_planes[roi], rows, cols][inside] = 0
+
+    allowed &= deadzones_aroundrois.astype(bool)
+    return roi_planes, deadzones_aroundrois, allowed
+
+
+def roi_spatialweights(roi_centroid, neuropil_radius, allowed):
+    """
+    Neuropil weights of one ROI: exp(-d**2 / neuropil_radius**2) of the distance d to the centroid (x, y), scaled to
+    sum to the number of pixels before the excluded pixels (allowed == False, see neuropil_exclusion) are set to 0
+    """
+
+    (im_ysize, im_xsize) = allowed.shape
+    y_weights = np.exp(-(np.arange(1, im_ysize + 1) - roi_centroid[1]) ** 2 / float(neuropil_radius) ** 2)
+    x_weights = np.exp(-(np.arange(1, im_xsize + 1) - roi_centroid[0]) ** 2 / float(neuropil_radius) ** 2)
+    spatialweights = np.outer(y_weights, x_weights)
+    spatialweights *= im_ysize * im_xsize / (y_weights.sum() * x_weights.sum())
+    spatialweights *= allowed
+    return spatialweights
+
+
+def _roi_rows(weights, rois):
+    # float32 (len(rois), pixels) rows of (num_rois, y, x) weights for the given increasing ROI indices; a view of
+    # float32 arrays if the ROIs are contiguous
+    num_pixels = int(np.prod(weights.shape[1:]))
+    if len(rois) == 0:
+        return np.zeros((0, num_pixels), dtype='float32')
+    if rois[-1] - rois[0] + 1 == len(rois):
+        rows = weights[rois[0]:rois[-1] + 1]
+    else:
+        # h5py datasets take a list of increasing indices
+        rows = weights[list(rois)]
+    return np.asarray(rows, dtype='float32').reshape(len(rois), num_pixels)
+
+
+def weighted_traces(frame_blocks, weights, roi_planes=None, normalize=True):
+    """
+    Weighted sums (or means) over the pixels of each frame, for all ROIs.
+
+    Parameters
+    ----------
+    frame_blocks : iterable of np arrays
+        (frames, planes, y, x, channels) blocks, e.g. from iter_movie_blocks
+    weights : np array, h5py dataset or scipy.sparse matrix
+        (num_rois, y, x) weights (neuropil weights or ROI masks), each on the plane given by roi_planes, or sparse
+        (num_rois, y * x) weights of a single plane
+    roi_planes : np array or None
+        plane of each ROI (default: all on plane 0)
+    normalize : bool
+        divide by the sum of each ROI's weights (weighted means)
+
+    Returns
+    -------
+    traces : np array (channels, num_rois, frames)
+    """
+
+    numrois = weights.shape[0]
+    if roi_planes is None:
+        roi_planes = np.zeros(numrois, dtype=int)
+    plane_rois = [np.flatnonzero(roi_planes == plane) for plane in range(np.max(roi_planes) + 1 if numrois else 0)]
+
+    if scipy.sparse.issparse(weights):
+        weights = weights.tocsr().astype('float32')
+        weight_sums = weights.dot(np.ones(weights.shape[1], dtype='float32'))
+        plane_weights = [weights[rois] for rois in plane_rois]
+    else:
+        # (rois, pixels) weights of each plane, read plane by plane from h5py datasets; the dense weights can be
+        # ~1 GB, so they are not copied when they are float32 and the ROIs of a plane are contiguous (always for
+        # single-plane data)
+        plane_weights = [_roi_rows(weights, rois) for rois in plane_rois]
+        weight_sums = np.zeros(numrois, dtype='float32')
+        for rois, rows in zip(plane_rois, plane_weights):
+            weight_sums[rois] = rows.sum(axis=1)
+
+    traces = []
+    for block in frame_blocks:
+        (num_frames, _, im_ysize, im_xsize, num_channels) = block.shape
+        block_traces = np.zeros((num_channels, numrois, num_frames))
+        for plane, rois in enumerate(plane_rois):
+            if len(rois) == 0:
+                continue
+            # (pixels, frames * channels), so each plane is a single matrix product for all ROIs and channels
+            plane_data = block[:, plane].reshape(num_frames, -1, num_channels).transpose(1, 0, 2)
+            plane_data = plane_data.reshape(im_ysize * im_xsize, -1)
+            plane_traces = np.asarray(plane_weights[plane].dot(plane_data))
+            block_traces[:, rois] = plane_traces.reshape(len(rois), num_frames, num_channels).transpose(2, 0, 1)
+        traces.append(block_traces)
+
+    traces = np.concatenate(traces, axis=2) if traces else np.zeros((1, numrois, 0))
+    if normalize:
+        traces /= weight_sums[None, :, None]
+    return traces
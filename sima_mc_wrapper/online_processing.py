@@ -0,0 +1,742 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+
+Online (real-time) mode: motion-corrects frames and extracts ROI and neuropil traces while the recording is still
+being acquired, e.g. for closed-loop experiments or to check data quality while the animal is on the rig.
+
+Frames come from a frame source, a generator of (frame, arrival_time) tuples:
+
+    - tail_tiff(path): pages appended to an uncompressed TIFF that is still being written (e.g. by ScanImage)
+    - tail_h5(path): frames appended to an HDF5 dataset, read in SWMR mode when the writer uses it
+    - iter_queue(queue): frames put on a multiprocessing (or threading) queue by another process; None ends the stream
+    - iter_socket(host, port, frame_shape): raw frames sent over a local TCP socket
+
+and every frame goes through OnlineProcessor.process_frame:
+
+    1) the odd rows are shifted by the bidirectional scanning offset (estimated with bidi_offset_correction on the
+       first frames, or given)
+    2) rigid registration to a template image by phase correlation (fft_registration.PhaseCorrelationEngine, integer
+       shifts up to max_shift); the template is made from the first frames (fft_registration.make_template) or given,
+       e.g. the mean_img of an earlier session of the same field of view
+    3) projection onto the ROI masks and the neuropil weights of calculate_neuropil.calculate_spatialweights_around_roi;
+       both are preloaded as one (2 * rois, pixels) matrix so all traces of a frame cost a single matrix product
+
+which gives per ROI the raw trace (mean of the ROI pixels), the neuropil trace (weighted mean around the ROI) and the
+corrected trace (raw - beta_neuropil * neuropil), as in calculate_neuropil.calculate_neuropil_signals_for_session.
+
+Latency: the time from a frame's arrival to its traces is recorded for every frame. If a frame is picked up more
+than max_latency seconds after it arrived (the processor has fallen behind, e.g. after a burst from the source),
+its registration is skipped and the last shift is reused until the processor has caught up. This bounds the
+per-frame cost; skipped frames are flagged with registered=False in the output.
+
+Only single-plane data is supported; for multi-channel recordings the sources select one channel.
+
+How to use:
+
+    processor = online_processing.OnlineProcessor.from_roi_zip(roi_zip_path, frame_shape, max_latency=0.05)
+    for record in processor.run(online_processing.tail_tiff(tif_path), save_path=fdir + '/session_online.h5'):
+        record['corrected']  # (num_rois,) traces of this frame; also 'raw', 'neuropil', 'shift', 'latency'
+    print(processor.latency_summary())
+
+or with the ROIs and neuropil weights of an analyzed session (its "_sima_masks.npy" and "_spatialweights_*.h5"):
+
+    processor = online_processing.OnlineProcessor.from_session(fdir, fname)
+
+or from the command line:
+
+    python online_processing.py path/to/growing.tif path/to/RoiSet.zip --max_latency 0.05
+
+"""
+
+import argparse
+import os
+import socket
+import time
+from collections import OrderedDict
+
+try:
+    from Queue import Empty  # python 2
+except ImportError:
+    from queue import Empty
+
+import h5py
+import numpy as np
+
+import bidi_offset_correction
+import calculate_neuropil
+import fft_registration
+import neuropil_engine
+
+
+# TIFF tag ids and field types read by _TiffTail
+_tiff_tags = {'width': 256, 'length': 257, 'bits': 258, 'compression': 259, 'strip_offsets': 273,
+              'samples': 277, 'strip_bytecounts': 279, 'sample_format': 339}
+_tiff_type_formats = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+_tiff_sample_kinds = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class _TiffTail(object):
+    """
+    Reads the pages appended to a TIFF (classic or BigTIFF, uncompressed, one sample per pixel) that is still being
+    written, keeping one file handle open across polls.
+
+    Each poll parses only the IFDs after the last page read: the offset of the next IFD is re-read from the last
+    page's IFD (writers fill it in when they append a page) and the walk stops at the first page whose IFD or pixel
+    data isn't completely in the file yet. Once three pages are equally spaced (ScanImage and tifffile write pages of
+    the same size one after another) the next pages are predicted from that stride. A prediction is only used if the
+    last page's next IFD pointer points at the predicted IFD and that IFD has the same number of tags and the
+    predicted strip offsets; otherwise (e.g. a ScanImage description of a different length moved the pixel data)
+    the IFD chain is walked again from the last page.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+        self._next_pointer = None  # file position of the offset of the next IFD
+        self._last_page = None  # (ifd offset, strip offsets, number of tags, strip offsets entry) of the last page
+        self._page_info = None  # (shape, dtype, strip bytecounts) of the last page read
+        self._strides = None  # (ifd stride, data stride) of the last two pages
+        self._fixed_stride = False
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _open(self):
+        # unbuffered: a buffered file object can return the stale bytes it read at the old end of the file
+        fh = open(self.path, 'rb', 0)
+        header = fh.read(16)
+        if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+            # not written yet
+            fh.close()
+            return False
+        self._byteorder = '<' if header[:2] == b'II' else '>'
+        version = np.frombuffer(header[2:4], self._byteorder + 'u2')[0]
+        if version == 43:
+            if len(header) < 16:
+                fh.close()
+                return False
+            self._offset_format, self._count_format, self._entry_size = 'u8', 'u8', 20
+            self._next_pointer = 8
+        else:
+            self._offset_format, self._count_format, self._entry_size = 'u4', 'u2', 12
+            self._next_pointer = 4
+        self._fh = fh
+        return True
+
+    def _read(self, offset, num_bytes):
+        self._fh.seek(offset)
+        return self._fh.read(num_bytes)
+
+    def _read_number(self, offset, fmt):
+        data = self._read(offset, np.dtype(fmt).itemsize)
+        return int(np.frombuffer(data, self._byteorder + fmt)[0])
+
+    def _ifd_size(self, num_tags):
+        count_size = np.dtype(self._count_format).itemsize
+        offset_size = np.dtype(self._offset_format).itemsize
+        return count_size + num_tags * self._entry_size + offset_size
+
+    def _entry_values(self, entry, file_size):
+        # (tag, values) of an IFD entry; values is None for tags that aren't read and False if they aren't written yet
+        offset_size = np.dtype(self._offset_format).itemsize
+        tag, field_type = np.frombuffer(entry[:4], self._byteorder + 'u2')
+        if tag not in _tiff_tags.values() or field_type not in _tiff_type_formats:
+            return int(tag), None
+        count = int(np.frombuffer(entry[4:4 + offset_size], self._byteorder + self._offset_format)[0])
+        dtype = np.dtype(self._byteorder + _tiff_type_formats[field_type])
+        value_bytes = entry[4 + offset_size:]
+        if count * dtype.itemsize > offset_size:
+            value_offset = int(np.frombuffer(value_bytes, self._byteorder + self._offset_format)[0])
+            if value_offset + count * dtype.itemsize > file_size:
+                return int(tag), False
+            value_bytes = self._read(value_offset, count * dtype.itemsize)
+        return int(tag), np.frombuffer(value_bytes[:count * dtype.itemsize], dtype).astype('int64')
+
+    def _parse_ifd(self, ifd_offset, file_size):
+        # returns (next pointer position, number of tags, strip offsets entry, page) or None if the IFD isn't
+        # completely written yet
+        count_size = np.dtype(self._count_format).itemsize
+        if ifd_offset + count_size > file_size:
+            return None
+        num_tags = self._read_number(ifd_offset, self._count_format)
+        ifd_size = self._ifd_size(num_tags)
+        if ifd_offset + ifd_size > file_size:
+            return None
+        entries = self._read(ifd_offset + count_size, num_tags * self._entry_size)
+
+        offset_size = np.dtype(self._offset_format).itemsize
+        values = {}
+        strip_entry = None
+        for idx in range(num_tags):
+            tag, tag_values = self._entry_values(entries[idx * self._entry_size:(idx + 1) * self._entry_size],
+                                                 file_size)
+            if tag_values is False:
+                return None
+            if tag_values is not None:
+                values[tag] = tag_values
+            if tag == _tiff_tags['strip_offsets']:
+                strip_entry = idx
+
+        if values.get(_tiff_tags['compression'], [1])[0] != 1 or values.get(_tiff_tags['samples'], [1])[0] != 1:
+            raise ValueError('Only uncompressed, single-sample TIFF pages can be read while they are written')
+        bits = values.get(_tiff_tags['bits'], [1])[0]
+        kind = _tiff_sample_kinds[values.get(_tiff_tags['sample_format'], [1])[0]]
+        page_dtype = np.dtype(self._byteorder + kind + str(bits // 8))
+        shape = (int(values[_tiff_tags['length']][0]), int(values[_tiff_tags['width']][0]))
+        page = (values[_tiff_tags['strip_offsets']], values[_tiff_tags['strip_bytecounts']], shape, page_dtype)
+        return ifd_offset + ifd_size - offset_size, num_tags, strip_entry, page
+
+    def _predict_page(self, file_size):
+        # the next page from the fixed stride, or None if it isn't completely written yet or breaks the stride
+        ifd_offset, strip_offsets, num_tags, strip_entry = self._last_page
+        ifd_stride, data_stride = self._strides
+        shape, page_dtype, bytecounts = self._page_info
+        next_ifd = ifd_offset + ifd_stride
+        next_offsets = strip_offsets + data_stride
+        if self._next_pointer + np.dtype(self._offset_format).itemsize > file_size:
+            return None
+        pointer = self._read_number(self._next_pointer, self._offset_format)
+        if pointer == 0:
+            # the next page isn't linked yet
+            return None
+        if pointer != next_ifd:
+            self._fixed_stride = False
+            return None
+        if max(next_ifd + self._ifd_size(num_tags), np.max(next_offsets + bytecounts)) > file_size:
+            return None
+
+        # the tag count and the strip offsets entry of the predicted IFD, in one read
+        count_size = np.dtype(self._count_format).itemsize
+        head_size = count_size + (strip_entry + 1) * self._entry_size
+        head = self._read(next_ifd, head_size)
+        tag, offsets = self._entry_values(head[head_size - self._entry_size:], file_size)
+        if offsets is False:
+            # the strip offsets of the page aren't written yet
+            return None
+        if int(np.frombuffer(head[:count_size], self._byteorder + self._count_format)[0]) != num_tags or \
+                tag != _tiff_tags['strip_offsets'] or offsets is None or offsets is False or \
+                not np.array_equal(offsets, next_offsets):
+            self._fixed_stride = False
+            return None
+        return next_ifd, next_offsets, num_tags, strip_entry
+
+    def read_new_pages(self):
+        """
+        Returns
+        -------
+        pages : list of 2D np arrays
+            the pages that were completely written to the file since the last call
+        """
+
+        if self._fh is None and not self._open():
+            return []
+        file_size = os.fstat(self._fh.fileno()).st_size
+
+        pages = []
+        while True:
+            if self._fixed_stride:
+                predicted = self._predict_page(file_size)
+                if predicted is not None:
+                    ifd_offset, strip_offsets, num_tags, _ = predicted
+                    self._next_pointer = ifd_offset + self._ifd_size(num_tags) - \
+                        np.dtype(self._offset_format).itemsize
+                    self._last_page = predicted
+                    pages.append(self._read_page(strip_offsets, *self._page_info))
+                    continue
+                if self._fixed_stride:
+                    break
+
+            if self._next_pointer + np.dtype(self._offset_format).itemsize > file_size:
+                break
+            ifd_offset = self._read_number(self._next_pointer, self._offset_format)
+            if ifd_offset == 0:
+                break
+            parsed = self._parse_ifd(ifd_offset, file_size)
+            if parsed is None:
+                break
+            next_pointer, num_tags, strip_entry, (strip_offsets, bytecounts, shape, page_dtype) = parsed
+            # the IFD may be written before the pixels; wait until the page's data is in the file
+            if np.max(strip_offsets + bytecounts) > file_size:
+                break
+
+            page_info = (shape, page_dtype, bytecounts)
+            if self._last_page is not None and _same_page_info(page_info, self._page_info) and \
+                    num_tags == self._last_page[2]:
+                strides = (ifd_offset - self._last_page[0], strip_offsets - self._last_page[1])
+                self._fixed_stride = (self._strides is not None and strides[0] == self._strides[0] and
+                                      np.array_equal(strides[1], self._strides[1]))
+                self._strides = strides
+            else:
+                self._strides = None
+            self._next_pointer = next_pointer
+            self._last_page = (ifd_offset, strip_offsets, num_tags, strip_entry)
+            self._page_info = page_info
+            pages.append(self._read_page(strip_offsets, shape, page_dtype, bytecounts))
+        return pages
+
+    def _read_page(self, strip_offsets, shape, page_dtype, bytecounts):
+        data = b''.join(self._read(offset, count) for offset, count in zip(strip_offsets, bytecounts))
+        return np.frombuffer(data, page_dtype)[:shape[0] * shape[1]].reshape(shape).astype(page_dtype.newbyteorder('='))
+
+
+def _same_page_info(info_a, info_b):
+    return info_a[0] == info_b[0] and info_a[1] == info_b[1] and np.array_equal(info_a[2], info_b[2])
+
+
+def tail_tiff(path, poll_interval=0.05, timeout=10.0, num_planes=1, num_channels=1, plane=0, channel=0):
+    """
+    Yields the pages of a TIFF as they are appended to the file.
+
+    Pages must be uncompressed with one sample per pixel, as written by ScanImage; the file is kept open and each
+    poll reads only the pages added since the previous one (see _TiffTail), so the cost of a poll doesn't grow with
+    the length of the recording.
+
+    Parameters
+    ----------
+    path : string
+    poll_interval : float
+        seconds between checks for new pages
+    timeout : float
+        the stream ends when no new page was added for this many seconds (acquisition stopped)
+    num_planes, num_channels, plane, channel : int
+        page interleaving as in sequence_io.create_sequence; only the pages of the given plane and channel are returned
+
+    Yields
+    ------
+    (frame, arrival_time) : (2D np array, float)
+        arrival_time is the time (time.time()) the page was found in the file
+    """
+
+    pages_per_frame = num_planes * num_channels
+    page_in_frame = plane * num_channels + channel
+    page_idx = 0
+    last_new_page = time.time()
+    tail = _TiffTail(path)
+
+    try:
+        while True:
+            arrival_time = time.time()
+            try:
+                pages = tail.read_new_pages()
+            except (IOError, OSError):
+                # the file doesn't exist yet; try again on the next poll
+                pages = []
+
+            for page in pages:
+                if page_idx % pages_per_frame == page_in_frame:
+                    yield page, arrival_time
+                page_idx += 1
+
+            if pages:
+                last_new_page = arrival_time
+            elif time.time() - last_new_page > timeout:
+                return
+            else:
+                time.sleep(poll_interval)
+    finally:
+        tail.close()
+
+
+def _open_h5_for_tailing(path):
+    # SWMR mode lets us keep the file open and see frames appended by a writer that enabled it; otherwise the file
+    # is reopened on every poll. Returns None if the file can't be opened at the moment (e.g. locked by the writer)
+    try:
+        return h5py.File(path, 'r', libver='latest', swmr=True)
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return h5py.File(path, 'r')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def tail_h5(path, dataset='imaging', poll_interval=0.05, timeout=10.0):
+    """
+    Yields the frames of a (time, y, x) HDF5 dataset as they are appended to it; see tail_tiff for the parameters.
+    """
+
+    next_frame = 0
+    last_new_frame = time.time()
+    h5 = None
+
+    try:
+        while True:
+            if h5 is None:
+                h5 = _open_h5_for_tailing(path)
+
+            frames = []
+            arrival_time = time.time()
+            if h5 is not None and dataset in h5:
+                dset = h5[dataset]
+                if h5.swmr_mode:
+                    dset.refresh()
+                if dset.shape[0] > next_frame:
+                    frames = dset[next_frame:]
+                    next_frame += len(frames)
+                if not h5.swmr_mode:
+                    h5.close()
+                    h5 = None
+
+            for frame in frames:
+                yield frame, arrival_time
+
+            if len(frames):
+                last_new_frame = arrival_time
+            elif time.time() - last_new_frame > timeout:
+                return
+            else:
+                time.sleep(poll_interval)
+    finally:
+        if h5 is not None:
+            h5.close()
+
+
+def iter_queue(queue, timeout=None):
+    """
+    Yields frames put on a queue; items are frames or (frame, arrival_time) tuples and None ends the stream (as
+    does waiting longer than timeout seconds for the next item).
+    """
+
+    while True:
+        try:
+            item = queue.get(timeout=timeout)
+        except Empty:
+            return
+        if item is None:
+            return
+        if isinstance(item, tuple):
+            yield item
+        else:
+            yield item, time.time()
+
+
+def _recv_exactly(conn, num_bytes):
+    buf = bytearray(num_bytes)
+    view = memoryview(buf)
+    received = 0
+    while received < num_bytes:
+        count = conn.recv_into(view[received:], num_bytes - received)
+        if count == 0:
+            return None
+        received += count
+    return buf
+
+
+def iter_socket(host, port, frame_shape, dtype='int16'):
+    """
+    Connects to a TCP server (e.g. localhost on the acquisition computer) that sends frames as raw C-ordered pixels
+    of the given shape and dtype, one after another; the stream ends when the server closes the connection.
+    """
+
+    dtype = np.dtype(dtype)
+    frame_bytes = int(np.prod(frame_shape)) * dtype.itemsize
+    conn = socket.create_connection((host, port))
+    try:
+        while True:
+            buf = _recv_exactly(conn, frame_bytes)
+            if buf is None:
+                return
+            yield np.frombuffer(buf, dtype=dtype).reshape(frame_shape), time.time()
+    finally:
+        conn.close()
+
+
+class OnlineProcessor(object):
+
+    def __init__(self, roi_masks, spatial_weights, beta_neuropil=0.8, template=None, bidi_offset=None,
+                 n_init_frames=100, max_shift=(20, 20), max_latency=None):
+        """
+        Parameters
+        ----------
+        roi_masks : np array
+            (num_rois, y, x) ROI masks, e.g. from calculate_neuropil.calculate_roi_masks
+        spatial_weights : np array
+            (num_rois, y, x) neuropil weights, e.g. the 'spatialweights' of
+            calculate_neuropil.calculate_spatialweights_around_roi
+        beta_neuropil : float
+            neuropil coefficient of the corrected traces
+        template : np array or None
+            (y, x) image the frames are registered to (bidi corrected); by default the mean of the first
+            n_init_frames frames
+        bidi_offset : int or None
+            bidirectional offset; by default estimated from the first n_init_frames frames
+        n_init_frames : int
+            number of frames used to estimate the template and bidi offset if they are not given; these frames are
+            buffered, so their traces are emitted once the last of them has arrived
+        max_shift : tuple of two ints
+            largest (dy, dx) displacement searched by the registration
+        max_latency : float or None
+            seconds; frames picked up later than this after their arrival are not registered (the last shift is
+            reused) until the processor has caught up. None registers every frame
+        """
+
+        roi_masks = np.asarray(roi_masks)
+        if roi_masks.ndim != 3:
+            raise ValueError('Online processing supports single-plane (num_rois, y, x) ROI masks only')
+        self.frame_shape = roi_masks.shape[1:]
+        self.num_rois = roi_masks.shape[0]
+        self.beta_neuropil = beta_neuropil
+        self.n_init_frames = n_init_frames
+        self.max_shift = max_shift
+        self.max_latency = max_latency
+
+        # ROI and neuropil weights normalized to sum to one, stacked so that one product gives all traces of a frame
+        roi_weights = roi_masks.reshape(self.num_rois, -1).astype('float32')
+        npil_weights = np.asarray(spatial_weights, dtype='float32').reshape(self.num_rois, -1)
+        self.weights = np.vstack([roi_weights / roi_weights.sum(axis=1, keepdims=True),
+                                  npil_weights / npil_weights.sum(axis=1, keepdims=True)])
+
+        self.bidi_offset = bidi_offset
+        self.engine = None
+        if template is not None:
+            self.set_template(template)
+
+        self.num_frames = 0
+        self.last_shift = (0, 0)
+        self.latencies = []
+        self.num_skipped = 0
+
+    @classmethod
+    def from_roi_zip(cls, roi_zip_path, frame_shape, neuropil_radius=50, min_neuropil_radius=15, weights_dir=None,
+                     **kwargs):
+        """
+        Loads ImageJ ROIs (an "_RoiSet.zip") and computes the ROI masks and the neuropil weights as the pipeline does;
+        the weights are written to weights_dir (default: next to the zip) as "<zip name>_online_spatialweights_*.h5".
+        Other keyword arguments are passed to OnlineProcessor.
+        """
+
+        roi_masks, roi_centroids, _ = neuropil_engine.rois_from_imagej(roi_zip_path, frame_shape)
+
+        if weights_dir is None:
+            weights_dir = os.path.dirname(os.path.abspath(roi_zip_path))
+        fname = os.path.splitext(os.path.basename(roi_zip_path))[0] + '_online'
+        calculate_neuropil.calculate_spatialweights_around_roi(weights_dir, roi_masks, roi_centroids,
+                                                               neuropil_radius, min_neuropil_radius, fname)
+        with h5py.File(os.path.join(weights_dir, '%s_spatialweights_%d_%d.h5' % (fname, min_neuropil_radius,
+                                                                                 neuropil_radius)), 'r') as h5:
+            spatial_weights = h5['spatialweights'][()]
+
+        return cls(roi_masks, spatial_weights, **kwargs)
+
+    @classmethod
+    def from_session(cls, fdir, fname, neuropil_radius=50, min_neuropil_radius=15, **kwargs):
+        """
+        Reuses the ROI masks ("<fname>_sima_masks.npy") and neuropil weights ("<fname>_spatialweights_*.h5") that
+        calculate_neuropil.calculate_neuropil_signals_for_session saved for an analyzed session. Other keyword
+        arguments are passed to OnlineProcessor.
+        """
+
+        roi_masks = np.load(os.path.join(fdir, fname + '_sima_masks.npy'))
+        with h5py.File(os.path.join(fdir, '%s_spatialweights_%d_%d.h5' % (fname, min_neuropil_radius,
+                                                                           neuropil_radius)), 'r') as h5:
+            spatial_weights = h5['spatialweights'][()]
+        return cls(roi_masks, spatial_weights, **kwargs)
+
+    @property
+    def initialized(self):
+        return self.engine is not None and self.bidi_offset is not None
+
+    @property
+    def template(self):
+        return None if self.engine is None else self.engine.template
+
+    def set_template(self, template):
+        # the registration engine caches the FFT of the template
+        self.engine = fft_registration.PhaseCorrelationEngine(template, self.max_shift)
+
+    def initialize(self, frames):
+        """Estimates the bidi offset and the template (whichever wasn't given) from a (frames, y, x) array"""
+
+        frames = np.asarray(frames, dtype='float32')
+        if self.bidi_offset is None:
+            bidi_obj = bidi_offset_correction.bidi_offset_correction(frames)
+            self.bidi_offset = bidi_obj.compute_mean_image().determine_bidi_offset().bidi_offset
+
+        if self.engine is None:
+            frames = bidi_offset_correction.correct_bidi_rows(frames, self.bidi_offset)
+            self.set_template(fft_registration.make_template(frames, self.max_shift))
+
+    def process_frame(self, frame, arrival_time=None):
+        """
+        Returns
+        -------
+        record : dictionary
+            'frame_idx', 'raw', 'neuropil' and 'corrected' ((num_rois,) float32 traces), 'shift' ((dy, dx)
+            displacement that was corrected), 'registered' (False if the registration was skipped to catch up) and
+            'latency' (seconds from arrival_time to the traces; 0 if no arrival time was given)
+        """
+
+        if not self.initialized:
+            raise RuntimeError('OnlineProcessor needs a template and bidi offset; call initialize first')
+
+        start_time = time.time()
+        if arrival_time is None:
+            arrival_time = start_time
+
+        frame = bidi_offset_correction.correct_bidi_rows(frame, self.bidi_offset)
+        register = self.max_latency is None or start_time - arrival_time <= self.max_latency
+        if register:
+            self.last_shift = tuple(int(shift) for shift in self.engine.estimate_shifts(frame[None])[0])
+        else:
+            self.num_skipped += 1
+        registered = fft_registration.shift_frame(frame, (-self.last_shift[0], -self.last_shift[1]),
+                                                  self.engine.template)
+
+        traces = np.dot(self.weights, registered.ravel())
+        raw = traces[:self.num_rois]
+        neuropil = traces[self.num_rois:]
+
+        record = {'frame_idx': self.num_frames,
+                  'raw': raw,
+                  'neuropil': neuropil,
+                  'corrected': raw - self.beta_neuropil * neuropil,
+                  'shift': self.last_shift,
+                  'registered': register,
+                  'latency': time.time() - arrival_time}
+        self.latencies.append(record['latency'])
+        self.num_frames += 1
+        return record
+
+    def run(self, frame_source, save_path=None, callback=None):
+        """
+        Processes the frames of a frame source (see tail_tiff, tail_h5, iter_queue and iter_socket) and yields the
+        record (see process_frame) of each frame. If the template or bidi offset are missing, the first
+        n_init_frames frames are buffered to estimate them.
+
+        Parameters
+        ----------
+        save_path : string or None
+            h5 file the traces are appended to while running (see OnlineTraceWriter)
+        callback : function or None
+            called with each record, e.g. to drive a closed-loop stimulus
+        """
+
+        writer = OnlineTraceWriter(save_path, self.num_rois) if save_path else None
+        init_buffer = []
+        try:
+            for frame, arrival_time in frame_source:
+                if not self.initialized:
+                    init_buffer.append((frame, arrival_time))
+                    if len(init_buffer) < self.n_init_frames:
+                        continue
+                    self.initialize([buffered_frame for buffered_frame, _ in init_buffer])
+                    pending, init_buffer = init_buffer, []
+                else:
+                    pending = [(frame, arrival_time)]
+
+                for pending_frame, pending_arrival in pending:
+                    record = self.process_frame(pending_frame, pending_arrival)
+                    if writer is not None:
+                        writer.append(record)
+                    if callback is not None:
+                        callback(record)
+                    yield record
+
+            # streams shorter than n_init_frames are initialized on whatever arrived
+            if init_buffer:
+                self.initialize([buffered_frame for buffered_frame, _ in init_buffer])
+                for pending_frame, pending_arrival in init_buffer:
+                    record = self.process_frame(pending_frame, pending_arrival)
+                    if writer is not None:
+                        writer.append(record)
+                    if callback is not None:
+                        callback(record)
+                    yield record
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def latency_summary(self):
+        # latency statistics in seconds, and the number of frames whose registration was skipped
+        latencies = np.array(self.latencies)
+        summary = OrderedDict([('num_frames', self.num_frames), ('num_skipped', self.num_skipped)])
+        if len(latencies):
+            summary['median_latency'] = float(np.median(latencies))
+            summary['p99_latency'] = float(np.percentile(latencies, 99))
+            summary['max_latency'] = float(latencies.max())
+            if self.max_latency is not None:
+                summary['frac_over_budget'] = float(np.mean(latencies > self.max_latency))
+        return summary
+
+
+class OnlineTraceWriter(object):
+
+    """
+    Appends the records of OnlineProcessor to an h5 file with the resizable datasets 'raw', 'neuropil' and
+    'corrected' (frames, rois), 'shifts' (frames, 2), 'registered' and 'latency' (frames,). The file is in SWMR mode,
+    so other processes (e.g. a live plot) can read the traces while they are being written.
+    """
+
+    def __init__(self, path, num_rois, flush_every=50):
+        self.h5 = h5py.File(path, 'w', libver='latest')
+        self.flush_every = flush_every
+        self.num_frames = 0
+        for name in ['raw', 'neuropil', 'corrected']:
+            self.h5.create_dataset(name, (0, num_rois), maxshape=(None, num_rois), dtype='float32',
+                                   chunks=(flush_every, num_rois))
+        self.h5.create_dataset('shifts', (0, 2), maxshape=(None, 2), dtype='int16', chunks=(flush_every, 2))
+        self.h5.create_dataset('registered', (0,), maxshape=(None,), dtype=bool, chunks=(flush_every,))
+        self.h5.create_dataset('latency', (0,), maxshape=(None,), dtype='float32', chunks=(flush_every,))
+        self.h5.swmr_mode = True
+
+    def append(self, record):
+        idx = self.num_frames
+        for name, value in [('raw', record['raw']), ('neuropil', record['neuropil']),
+                            ('corrected', record['corrected']), ('shifts', record['shift']),
+                            ('registered', record['registered']), ('latency', record['latency'])]:
+            dset = self.h5[name]
+            dset.resize(idx + 1, axis=0)
+            dset[idx] = value
+        self.num_frames += 1
+        if self.num_frames % self.flush_every == 0:
+            self.h5.flush()
+
+    def close(self):
+        self.h5.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Motion-correct a recording and extract ROI traces while it is '
+                                                 'being acquired')
+    parser.add_argument('source', help='growing .tif/.tiff or .h5 file')
+    parser.add_argument('roi_zip', help='ImageJ RoiSet zip')
+    parser.add_argument('--save', default=None, help='h5 file for the traces (default: <source>_online.h5)')
+    parser.add_argument('--max_shift', type=int, nargs=2, default=[20, 20])
+    parser.add_argument('--max_latency', type=float, default=None, help='latency budget per frame in seconds')
+    parser.add_argument('--beta_neuropil', type=float, default=0.8)
+    parser.add_argument('--neuropil_radius', type=int, default=50)
+    parser.add_argument('--min_neuropil_radius', type=int, default=15)
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='stop after this many seconds without new frames')
+    args = parser.parse_args()
+
+    fext = os.path.splitext(args.source)[1]
+    if fext in ['.tif', '.tiff']:
+        source = tail_tiff(args.source, timeout=args.timeout)
+    elif fext == '.h5':
+        source = tail_h5(args.source, timeout=args.timeout)
+    else:
+        raise Exception('Inappropriate file extension')
+
+    # the frame shape is needed for the ROI masks; wait for the first frame
+    first_frame, first_arrival = next(source)
+
+    def all_frames():
+        yield first_frame, first_arrival
+        for item in source:
+            yield item
+
+    processor = OnlineProcessor.from_roi_zip(args.roi_zip, first_frame.shape, args.neuropil_radius,
+                                             args.min_neuropil_radius, beta_neuropil=args.beta_neuropil,
+                                             max_shift=args.max_shift, max_latency=args.max_latency)
+    save_path = args.save or os.path.splitext(args.source)[0] + '_online.h5'
+    for record in processor.run(all_frames(), save_path=save_path):
+        if record['frame_idx'] % 100 == 0:
+            print('frame {}: shift {}, latency {:.1f} ms'.format(record['frame_idx'], record['shift'],
+                                                                1000 * record['latency']))
+    print(processor.latency_summary())
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Per-session store of the projection images (mean, max, std) of the motion-corrected movie.
+
+The projections are computed once during motion correction (sima_motion_bidi_correction.full_process) and saved as
+"*_projections.h5" next to the raw data, with one dataset per projection ('mean_img', 'max_img', 'std_img').
+Downstream steps (neuropil correction, plotting, notebooks) read this small file instead of reloading the
+sima.ImagingDataset, whose time_averages can trigger a pass over the whole movie.
+
+For sessions motion corrected before the store existed (or run with motion_correct=False), load_projection builds
+the store once from the .sima folder.
+
+The projections are computed in a single streaming pass with ProjectionAccumulator, which takes blocks of frames
+from any source (numpy array, h5py dataset or sima sequence, see iter_frame_blocks) and keeps only image-sized
+running statistics: max, mean and the sum of squared deviations (M2) for the std, combined block by block with
+Chan et al.'s parallel form of Welford's algorithm. It can also produce, in the same pass:
+
+    - a local correlation image ('corr_img'): mean correlation of each pixel's time course with its 8 neighbours
+    - percentile images (e.g. 'percentile10_img'), from a reservoir sample of frames
+
+"""
+
+import os
+
+import h5py
+import numpy as np
+
+
+def _squeeze_frame_dims(block):
+    # drop singleton plane/channel dimensions of a (frames, ...) block but keep the frame axis
+    return block.reshape((block.shape[0],) + tuple(dim for dim in block.shape[1:] if dim != 1))
+
+
+def iter_frame_blocks(source, block_size=100, fill_gaps=False):
+    """
+    Yields consecutive (frames, ...) blocks of a movie with singleton plane/channel dimensions removed.
+
+    Parameters
+    ----------
+    source : np array, h5py dataset, sima sequence or any iterable of frames
+        arrays and h5py datasets are sliced along the first axis, so only one block is in memory at a time
+    block_size : int
+        number of frames per block
+    fill_gaps : bool
+        for sima sequences: fill the NaN pixels left by motion correction with the last valid value (sima's
+        _fill_gaps, as used in sima_motion_bidi_correction.full_process)
+    """
+
+    if isinstance(source, (np.ndarray, h5py.Dataset)):
+        for start in range(0, source.shape[0], block_size):
+            yield _squeeze_frame_dims(np.asarray(source[start:start + block_size]))
+        return
+
+    if fill_gaps:
+        from sima import sequence
+        frames = sequence._fill_gaps(iter(source), iter(source))
+    else:
+        frames = iter(source)
+
+    block = []
+    for frame in frames:
+        block.append(np.asarray(frame))
+        if len(block) == block_size:
+            yield _squeeze_frame_dims(np.array(block))
+            block = []
+    if block:
+        yield _squeeze_frame_dims(np.array(block))
+
+
+def _neighbour_slices(offset):
+    # indices of the last two (y, x) dimensions that pair each pixel with its neighbour at offset (dy, dx)
+    dy, dx = offset
+    src = (Ellipsis, slice(0, None if dy == 0 else -dy), slice(max(-dx, 0), None if dx <= 0 else -dx))
+    dst = (Ellipsis, slice(dy, None), slice(max(dx, 0), None if dx >= 0 else dx))
+    return src, dst
+
+
+class ProjectionAccumulator(object):
+
+    # pixel offsets of the neighbours used for the correlation image; the opposite offsets are covered by symmetry
+    neighbour_offsets = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+    def __init__(self, correlation=False, percentiles=None, reservoir_size=200, seed=0):
+        """
+        Parameters
+        ----------
+        correlation : bool
+            also compute the local correlation image; the last two dimensions of the frames must be (y, x)
+        percentiles : list of numbers or None
+            percentile images to compute (e.g. [10, 50])
+        reservoir_size : int
+            number of frames randomly sampled (in the input dtype) for the percentile images
+        seed : int
+            seed of the reservoir sampling
+        """
+
+        self.correlation = correlation
+        self.percentiles = percentiles or []
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.RandomState(seed)
+
+        self.num_frames = 0
+        self.max_img = None
+        self.mean = None
+        self.m2 = None
+
+        # for the correlation image: frames are centered on a fixed reference (the mean of the first block) before
+        # the neighbour products are summed, which avoids the cancellation of summing raw products
+        self.ref = None
+        self.centered_sum = None
+        self.neighbour_sums = None
+
+        self.reservoir = None
+
+    def update(self, block):
+        """Adds a (frames, ...) block of frames"""
+
+        if block.shape[0] == 0:
+            return
+
+        if self.percentiles:
+            self._update_reservoir(block)
+
+        # float32 copy of only this block; the running statistics are kept in float64
+        block = np.asarray(block, dtype='float32')
+        num_block = block.shape[0]
+        block_mean = block.mean(axis=0, dtype='float64')
+        block_m2 = np.sum(np.square(block - block_mean.astype('float32')), axis=0, dtype='float64')
+        block_max = block.max(axis=0)
+
+        if self.num_frames == 0:
+            self.max_img = block_max
+            self.mean = block_mean
+            self.m2 = block_m2
+        else:
+            # merge the block statistics into the running ones (Chan et al.)
+            total = self.num_frames + num_block
+            delta = block_mean - self.mean
+            self.mean += delta * (num_block / float(total))
+            self.m2 += block_m2 + np.square(delta) * (self.num_frames * num_block / float(total))
+            np.maximum(self.max_img, block_max, out=self.max_img)
+
+        if self.correlation:
+            self._update_correlation(block, block_mean)
+
+        self.num_frames += num_block
+
+    def _update_correlation(self, block, block_mean):
+
+        if self.ref is None:
+            self.ref = block_mean.astype('float32')
+            self.centered_sum = np.zeros(block_mean.shape)
+            self.neighbour_sums = [0] * len(self.neighbour_offsets)
+
+        centered = block - self.ref
+        self.centered_sum += centered.sum(axis=0, dtype='float64')
+        for idx, offset in enumerate(self.neighbour_offsets):
+            src, dst = _neighbour_slices(offset)
+            self.neighbour_sums[idx] = self.neighbour_sums[idx] + np.sum(centered[src] * centered[dst], axis=0,
+                                                                         dtype='float64')
+
+    def _update_reservoir(self, block):
+        # reservoir sampling (algorithm R): every frame ends up in the sample with equal probability
+        if self.reservoir is None:
+            self.reservoir = np.empty((self.reservoir_size,) + block.shape[1:], dtype=block.dtype)
+        for idx, frame in enumerate(block):
+            frame_num = self.num_frames + idx
+            if frame_num < self.reservoir_size:
+                self.reservoir[frame_num] = frame
+            else:
+                slot = self.rng.randint(0, frame_num + 1)
+                if slot < self.reservoir_size:
+                    self.reservoir[slot] = frame
+
+    def _correlation_image(self):
+
+        num = float(self.num_frames)
+        centered_mean = self.centered_sum / num
+        std = np.sqrt(self.m2 / num)
+        std[std == 0] = np.inf  # constant pixels have zero correlation
+
+        corr_sum = np.zeros(self.mean.shape)
+        num_neighbours = np.zeros(self.mean.shape[-2:])
+        for offset, neighbour_sum in zip(self.neighbour_offsets, self.neighbour_sums):
+            src, dst = _neighbour_slices(offset)
+            cov = neighbour_sum / num - centered_mean[src] * centered_mean[dst]
+            corr = cov / (std[src] * std[dst])
+            # the correlation counts for both pixels of the pair
+            corr_sum[src] += corr
+            corr_sum[dst] += corr
+            num_neighbours[src] += 1
+            num_neighbours[dst] += 1
+
+        return corr_sum / num_neighbours
+
+    def result(self):
+        """
+        Returns
+        -------
+        proj_imgs : dictionary of float32 images
+            'max_img', 'mean_img', 'std_img' and, if requested, 'corr_img' and 'percentile<p>_img' for each
+            percentile p
+        """
+
+        if self.num_frames == 0:
+            raise ValueError('No frames were added to the projection accumulator')
+
+        proj_imgs = {'max_img': self.max_img.astype('float32'),
+                     'mean_img': self.mean.astype('float32'),
+                     'std_img': np.sqrt(self.m2 / self.num_frames).astype('float32')}
+
+        if self.correlation:
+            proj_imgs['corr_img'] = self._correlation_image().astype('float32')
+
+        if self.percentiles:
+            sample = self.reservoir[:min(self.num_frames, self.reservoir_size)]
+            for percentile in self.percentiles:
+                proj_imgs['percentile%g_img' % percentile] = np.percentile(sample, percentile,
+                                                                           axis=0).astype('float32')
+
+        return proj_imgs
+
+
+def compute_projections(source, block_size=100, fill_gaps=False, **accumulator_kwargs):
+    """
+    Streams a movie once through a ProjectionAccumulator and returns its projection images; see
+    iter_frame_blocks for the supported sources and ProjectionAccumulator for the options.
+    """
+
+    accumulator = ProjectionAccumulator(**accumulator_kwargs)
+    for block in iter_frame_blocks(source, block_size, fill_gaps):
+        accumulator.update(block)
+    return accumulator.result()
+
+
+def mean_image(source, block_size=100, fill_gaps=False):
+    # streamed mean image only (float64 running sum); see iter_frame_blocks for the supported sources
+    total = 0
+    num_frames = 0
+    for block in iter_frame_blocks(source, block_size, fill_gaps):
+        total = total + block.sum(axis=0, dtype='float64')
+        num_frames += block.shape[0]
+    return total / num_frames
+
+
+def projection_store_path(fdir, fbasename):
+    return os.path.join(fdir, fbasename + '_projections.h5')
+
+
+def save_projection_store(store_path, projections):
+    # projections: dictionary of projection name -> image
+    with h5py.File(store_path, 'w') as h5:
+        for name, img in projections.items():
+            h5.create_dataset(name, data=np.asarray(img, dtype='float32'))
+
+
+def create_projection_store_from_sima(sima_dir, store_path):
+
+    import sequence_io
+
+    dataset = sequence_io.load_dataset(sima_dir)
+    # first channel of the first sequence, with the gaps left by motion correction filled as in full_process
+    sequence = dataset.sequences[0][:, :, :, :, 0]
+    save_projection_store(store_path, compute_projections(sequence, fill_gaps=True))
+
+
+def load_projection(fdir, fbasename, name='mean_img'):
+    """
+    Parameters
+    ----------
+    fdir : string
+        session directory
+    fbasename : string
+        raw data file name without the extension
+    name : string
+        'mean_img', 'max_img' or 'std_img'
+
+    Returns
+    -------
+    img : np array (float32)
+    """
+
+    store_path = projection_store_path(fdir, fbasename)
+
+    if not os.path.exists(store_path):
+        print('No projection file found for %s; computing projections from the .sima folder' % fbasename)
+        create_projection_store_from_sima(os.path.join(fdir, fbasename + '_mc.sima'), store_path)
+
+    with h5py.File(store_path, 'r') as h5:
+        if name not in h5:
+            raise KeyError('%s not in %s' % (name, store_path))
+        return h5[name][()]
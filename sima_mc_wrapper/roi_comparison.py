@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Compares the ROI traces of two segmentations or motion correction outputs of a session, e.g. suite2p ROIs on the
+suite2p registered movie against manual (imagej/SIMA) ROIs on the SIMA registered movie, as in
+in_development/suite2p_manual_time_corr.py.
+
+roi_traces extracts the mean trace of every ROI from a movie streamed in blocks of frames: the ROI masks are a
+scipy.sparse (num_rois, y * x) matrix (suite2p_rois.load_suite2p_rois, or dense masks converted with sparse_masks),
+so each block is a single sparse matrix product for all ROIs (neuropil_engine.weighted_traces) instead of one
+fancy-index copy of (frames, roi pixels) per ROI.
+
+The correlations work on unit traces (zero mean, unit norm), for which the Pearson correlation of two traces is
+their dot product: correlation_matrix is one matrix product for all pairs of ROIs and matched_correlations the row-wise
+products of the matched pairs.
+
+match_rois pairs the ROIs of the two segmentations by overlap, replacing hand-made matching tables
+(cell_matching.csv): KD-trees over the ROI bounding box centers, binned by ROI size, find the pairs whose bounding
+boxes can intersect, the intersection over union (IoU) is computed from the sparse masks for these candidate pairs
+only, and each group of ROIs connected by candidate pairs is assigned separately (most are single pairs, the others
+are solved with scipy's linear_sum_assignment on the IoUs), so two sets of ~1000 ROIs are matched in a fraction of a
+second.
+
+How to use:
+
+    traces_s2p = roi_comparison.roi_traces('session_suite2p_mc.h5', masks_s2p)
+    traces_manual = roi_comparison.roi_traces('session_sima_mc.h5', roi_comparison.sparse_masks(manual_masks))
+    s2p_ids, manual_ids, ious = roi_comparison.match_rois(masks_s2p, manual_masks, im_shape)
+    corrs = roi_comparison.matched_correlations(traces_s2p, traces_manual, s2p_ids, manual_ids)
+
+"""
+
+import h5py
+import numpy as np
+import scipy.sparse
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+import motion_metrics
+import neuropil_engine
+import projections
+
+
+def sparse_masks(masks):
+    # (num_rois, y * x) sparse masks from (num_rois, y, x) dense masks; sparse masks are returned as csr
+    if scipy.sparse.issparse(masks):
+        return masks.tocsr()
+    masks = np.asarray(masks)
+    return scipy.sparse.csr_matrix(masks.reshape(masks.shape[0], -1))
+
+
+def roi_traces(source, masks, block_size=100, key=None):
+    """
+    Mean trace of every ROI of a single plane, single channel movie.
+
+    Parameters
+    ----------
+    source : string, np array or h5py dataset
+        h5 file path (see motion_metrics.open_h5_movie for the key) or (frames, y, x) movie; the movie is read one
+        block of frames at a time
+    masks : scipy.sparse matrix (num_rois, y * x) or np array (num_rois, y, x)
+        binary masks or pixel weights (e.g. suite2p's lam); traces are the weighted means over each ROI
+    block_size : int
+        number of frames per block
+    key : string or None
+        dataset in the h5 file
+
+    Returns
+    -------
+    traces : np array (num_rois, frames)
+    """
+
+    if isinstance(source, (np.ndarray, h5py.Dataset)):
+        return _roi_traces(source, sparse_masks(masks), block_size)
+    h5, data = motion_metrics.open_h5_movie(source, key)
+    try:
+        return _roi_traces(data, sparse_masks(masks), block_size)
+    finally:
+        h5.close()
+
+
+def _roi_traces(data, masks, block_size):
+    # weighted_traces takes (frames, planes, y, x, channels) blocks
+    frame_blocks = (block[:, None, :, :, None] for block in projections.iter_frame_blocks(data, block_size))
+    return neuropil_engine.weighted_traces(frame_blocks, masks)[0]
+
+
+def unit_traces(traces):
+    # zero mean, unit norm rows; constant traces become NaN, as with np.corrcoef
+    traces = np.asarray(traces, dtype='float64')
+    centered = traces - traces.mean(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return centered / np.linalg.norm(centered, axis=1, keepdims=True)
+
+
+def correlation_matrix(traces_a, traces_b):
+    """
+    Pearson correlation of every ROI trace in traces_a (num_rois_a, frames) with every ROI trace in traces_b
+    (num_rois_b, frames), as a (num_rois_a, num_rois_b) array
+    """
+
+    return unit_traces(traces_a).dot(unit_traces(traces_b).T)
+
+
+def matched_correlations(traces_a, traces_b, ids_a, ids_b):
+    """
+    Pearson correlations of matched ROI pairs.
+
+    Parameters
+    ----------
+    traces_a, traces_b : np arrays (num_rois, frames)
+        traces of the two datasets, with the same number of frames
+    ids_a, ids_b : sequences of int
+        rows of traces_a and traces_b of each matched pair (e.g. the columns of a cell matching table)
+
+    Returns
+    -------
+    corrs : np array (num_pairs,)
+    """
+
+    ids_a = np.asarray(ids_a, dtype=int)
+    ids_b = np.asarray(ids_b, dtype=int)
+    return np.einsum('ij,ij->i', unit_traces(np.asarray(traces_a)[ids_a]), unit_traces(np.asarray(traces_b)[ids_b]))
+
+
+def bounding_boxes(masks, im_shape):
+    """
+    Bounding boxes of ROI masks.
+
+    Parameters
+    ----------
+    masks : scipy.sparse matrix (num_rois, y * x)
+    im_shape : tuple
+        (y, x)
+
+    Returns
+    -------
+    boxes : np array (num_rois, 4)
+        (y_min, x_min, y_max, x_max), inclusive; NaN for ROIs without pixels
+    """
+
+    masks = _binary_masks(masks)
+    masks.sort_indices()
+    boxes = np.full((masks.shape[0], 4), np.nan)
+    nonempty = np.diff(masks.indptr) > 0
+    if not np.any(nonempty):
+        return boxes
+    ys, xs = np.unravel_index(masks.indices, im_shape)
+    starts = masks.indptr[:-1][nonempty]
+    boxes[nonempty] = np.column_stack([np.minimum.reduceat(ys, starts), np.minimum.reduceat(xs, starts),
+                                       np.maximum.reduceat(ys, starts), np.maximum.reduceat(xs, starts)])
+    return boxes
+
+
+def _size_bins(half_diagonals):
+    # ROIs grouped by powers of two of their half diagonal, so a group's largest ROI is at most twice its smallest
+    return np.floor(np.log2(np.maximum(half_diagonals, 1))).astype(int)
+
+
+def candidate_pairs(boxes_a, boxes_b):
+    """
+    Pairs of ROIs (rows of boxes_a, rows of boxes_b) whose bounding boxes intersect, found with a KD-tree over the
+    box centers: boxes can only intersect if their centers are closer than the sum of their half diagonals.
+
+    The ROIs of each set are binned by size and every pair of bins is searched with the radius of its own largest
+    ROIs, so a few large ROIs do not widen the search for all the others.
+    """
+
+    valid_a = np.flatnonzero(~np.isnan(boxes_a[:, 0]))
+    valid_b = np.flatnonzero(~np.isnan(boxes_b[:, 0]))
+    if len(valid_a) == 0 or len(valid_b) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    boxes_a = boxes_a[valid_a]
+    boxes_b = boxes_b[valid_b]
+
+    centers_a = (boxes_a[:, :2] + boxes_a[:, 2:]) / 2.
+    centers_b = (boxes_b[:, :2] + boxes_b[:, 2:]) / 2.
+    half_diagonals_a = np.hypot(*(boxes_a[:, 2:] - boxes_a[:, :2] + 1).T) / 2.
+    half_diagonals_b = np.hypot(*(boxes_b[:, 2:] - boxes_b[:, :2] + 1).T) / 2.
+    bins_a = _size_bins(half_diagonals_a)
+    bins_b = _size_bins(half_diagonals_b)
+
+    bins = []
+    for bin_ids, half_diagonals, centers in [(bins_a, half_diagonals_a, centers_a),
+                                             (bins_b, half_diagonals_b, centers_b)]:
+        members = [np.flatnonzero(bin_ids == size_bin) for size_bin in np.unique(bin_ids)]
+        bins.append([(rows, half_diagonals[rows].max(), cKDTree(centers[rows])) for rows in members])
+
+    ids_a = []
+    ids_b = []
+    for rows_a, max_a, tree_a in bins[0]:
+        for rows_b, max_b, tree_b in bins[1]:
+            neighbours = tree_a.query_ball_tree(tree_b, max_a + max_b)
+            ids_a.append(np.repeat(rows_a, [len(ids) for ids in neighbours]))
+            ids_b.append(rows_b[np.array([idx for ids in neighbours for idx in ids], dtype=int)])
+    ids_a = np.concatenate(ids_a)
+    ids_b = np.concatenate(ids_b)
+
+    # exact bounding box intersection
+    overlap = np.all((boxes_a[ids_a, :2] <= boxes_b[ids_b, 2:]) & (boxes_b[ids_b, :2] <= boxes_a[ids_a, 2:]), axis=1)
+    return valid_a[ids_a[overlap]], valid_b[ids_b[overlap]]
+
+
+def _binary_masks(masks):
+    masks = sparse_masks(masks).astype(bool)
+    masks.eliminate_zeros()
+    return masks.astype('float32')
+
+
+def pair_ious(masks_a, masks_b, ids_a, ids_b):
+    # intersection over union of the (binarized) sparse masks of the given pairs
+    masks_a = _binary_masks(masks_a)
+    masks_b = _binary_masks(masks_b)
+    intersections = masks_a[ids_a].multiply(masks_b[ids_b]).dot(np.ones(masks_a.shape[1], dtype='float32'))
+    areas_a = masks_a.getnnz(axis=1)[ids_a]
+    areas_b = masks_b.getnnz(axis=1)[ids_b]
+    return intersections / (areas_a + areas_b - intersections)
+
+
+def match_rois(masks_a, masks_b, im_shape=None, min_iou=0.2):
+    """
+    One-to-one matching of two sets of ROIs of the same field of view by mask overlap.
+
+    Parameters
+    ----------
+    masks_a, masks_b : scipy.sparse matrix (num_rois, y * x) or np array (num_rois, y, x)
+        ROI masks (or pixel weights, which are binarized), e.g. suite2p and manual/SIMA ROIs
+    im_shape : tuple or None
+        (y, x); required for sparse masks
+    min_iou : float
+        minimal intersection over union of a matched pair
+
+    Returns
+    -------
+    ids_a, ids_b : np arrays of int
+        rows of masks_a and masks_b of each matched pair, sorted by ids_a; pass them to matched_correlations
+    ious : np array
+        intersection over union of each matched pair
+    """
+
+    if im_shape is None:
+        im_shape = np.shape(masks_a)[1:]
+    masks_a = sparse_masks(masks_a)
+    masks_b = sparse_masks(masks_b)
+    num_rois_a = masks_a.shape[0]
+
+    ids_a, ids_b = candidate_pairs(bounding_boxes(masks_a, im_shape), bounding_boxes(masks_b, im_shape))
+    ious = pair_ious(masks_a, masks_b, ids_a, ids_b)
+    keep = ious >= min_iou
+    ids_a, ids_b, ious = ids_a[keep], ids_b[keep], ious[keep]
+    if len(ids_a) == 0:
+        return ids_a, ids_b, ious
+
+    # ROIs connected by candidate pairs compete for the same matches; each group is assigned on its own
+    graph = scipy.sparse.coo_matrix((np.ones(len(ids_a)), (ids_a, num_rois_a + ids_b)),
+                                    shape=(num_rois_a + masks_b.shape[0],) * 2)
+    _, labels = connected_components(graph, directed=False)
+    pair_labels = labels[ids_a]
+    pairs_per_group = np.bincount(pair_labels)
+
+    # groups of a single pair need no assignment
+    matched = [np.flatnonzero(pairs_per_group[pair_labels] == 1)]
+    order = np.argsort(pair_labels, kind='mergesort')
+    group_starts = np.searchsorted(pair_labels[order], np.flatnonzero(pairs_per_group > 1))
+    for start in group_starts:
+        group = order[start:start + pairs_per_group[pair_labels[order[start]]]]
+        rows, row_ids = np.unique(ids_a[group], return_inverse=True)
+        cols, col_ids = np.unique(ids_b[group], return_inverse=True)
+        group_ious = np.zeros((len(rows), len(cols)))
+        group_ious[row_ids, col_ids] = ious[group]
+        assigned_rows, assigned_cols = linear_sum_assignment(-group_ious)
+        pair_index = np.full((len(rows), len(cols)), -1, dtype=int)
+        pair_index[row_ids, col_ids] = group
+        assigned = pair_index[assigned_rows, assigned_cols]
+        matched.append(assigned[assigned >= 0])
+
+    matched = np.concatenate(matched)
+    matched = matched[np.argsort(ids_a[matched], kind='mergesort')]
+    return ids_a[matched], ids_b[matched], ious[matched]
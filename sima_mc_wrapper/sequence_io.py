@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Creates the sima sequences the pipeline reads raw data through.
+
+sima.Sequence.create('TIFF', fpath) reads every page with PIL and converts it on each access. Uncompressed TIFFs
+(ScanImage, FIJI, tifffile) store each page as one block of raw pixels, so instead _Sequence_TIFF_memmap maps the
+file into memory and exposes the pages as a numpy view: frames are read straight from the OS page cache without
+going through a decoder. If all pages are equally spaced in the file (always the case for ImageJ/tifffile stacks
+and for ScanImage files with fixed-size headers) the whole movie is a single strided array (see frames_array),
+otherwise each page gets its own view.
+
+Compressed or tiled TIFFs can't be mapped; create_sequence then falls back to sima's TIFF reader.
+
+Recordings split over several files (e.g. ScanImage's "_00001.tif", "_00002.tif", ... chunks) are presented as one
+continuous movie by _Concatenated_Sequence, which reads each frame from the chunk it belongs to. Motion correction,
+extraction and neuropil correction then run across the chunk boundaries without a concatenated copy on disk.
+
+sima pickles the motion correction displacements ((frames, planes, rows, 2) int16) into the .sima folder's
+sequences.pkl, so every change to the folder (the bidirectional offset, corrected data paths) means loading and
+re-pickling hundreds of MB for long sessions. With fparams['displacement_sidecar'] they are stored in
+"displacements.npy" next to sequences.pkl instead: with_displacement_sidecars wraps the motion corrected sequences
+in a _MotionCorrected_Sidecar_Sequence before the dataset is saved, which writes the file and memory maps it when
+the dataset is loaded. update_displacements then changes them in place and sequences.pkl stays small;
+move_displacements_to_sidecar converts existing folders.
+
+The .sima folder records the sequence classes. A memory-mapped TIFF is saved as sima's own TIFF sequence, so the
+folder stays loadable by plain sima; load_dataset loads it and maps the TIFFs again. Datasets of concatenated chunks
+or with the displacements in a sidecar file can only be loaded (sima.ImagingDataset.load) when this folder is on the
+python path, as is the case for all code in sima_mc_wrapper.
+
+"""
+
+import os
+import pickle
+import re
+from os.path import abspath, basename, isabs, join, relpath
+
+import numpy as np
+import sima
+import tifffile
+from sima.sequence import Sequence, _MotionCorrectedSequence, _WrapperSequence
+
+# ScanImage appends a 5 digit file counter to each chunk of a long recording
+chunk_pattern = re.compile(r'^(.*)_(\d{5})(\.tiff?)$')
+# displacement sidecar file(s) in a .sima folder; one per sequence
+displacements_file = 'displacements.npy'
+
+
+def tiff_page_views(path):
+    """
+    Maps the pages of an uncompressed TIFF without reading them.
+
+    Returns
+    -------
+    pages : np array (read-only memmap view) of shape (num_pages, rows, columns) if the pages are equally spaced
+        in the file, otherwise a list of 2D views (one per page)
+
+    Raises ValueError if the pages are compressed, tiled or differ in shape or data type.
+    """
+
+    with tifffile.TiffFile(path) as tif:
+        first_page = tif.pages[0]
+        dtype = np.dtype(tif.byteorder + first_page.dtype.char)
+        page_shape = first_page.shape
+        offsets = []
+        for page in tif.pages:
+            if page.shape != page_shape or page.dtype != first_page.dtype:
+                raise ValueError('TIFF pages differ in shape or data type')
+            # is_contiguous is None unless the page is stored as one uncompressed block
+            if page.is_contiguous is None:
+                raise ValueError('TIFF pages are compressed or tiled')
+            offsets.append(page.is_contiguous[0])
+
+    if len(page_shape) != 2:
+        raise ValueError('Only single-sample (grayscale) TIFF pages can be memory mapped')
+
+    file_map = np.memmap(path, dtype='uint8', mode='r')
+    page_bytes = int(np.prod(page_shape)) * dtype.itemsize
+    row_strides = (page_shape[1] * dtype.itemsize, dtype.itemsize)
+
+    steps = np.diff(offsets)
+    if len(offsets) == 1 or np.all(steps == steps[0]):
+        page_stride = int(steps[0]) if len(offsets) > 1 else page_bytes
+        return np.ndarray(shape=(len(offsets),) + page_shape, dtype=dtype, buffer=file_map, offset=offsets[0],
+                          strides=(page_stride,) + row_strides)
+
+    return [np.ndarray(shape=page_shape, dtype=dtype, buffer=file_map, offset=offset, strides=row_strides)
+            for offset in offsets]
+
+
+class _Sequence_TIFF_memmap(Sequence):
+
+    """
+    sima sequence of a memory-mapped multi-page TIFF, with the same page interleaving as sima's TIFF reader
+    (page = (frame * num_planes + plane) * num_channels + channel). Create with create_sequence.
+    """
+
+    def __init__(self, path, num_planes=1, num_channels=1):
+        self._path = abspath(path)
+        self._num_planes = num_planes
+        self._num_channels = num_channels
+        self._pages = tiff_page_views(self._path)
+        self._pages_per_frame = num_planes * num_channels
+        if len(self._pages) % self._pages_per_frame:
+            raise ValueError('Number of TIFF pages is not a multiple of num_planes * num_channels')
+
+    def __len__(self):
+        return len(self._pages) // self._pages_per_frame
+
+    def _get_frame(self, t):
+        start = t * self._pages_per_frame
+        if isinstance(self._pages, np.ndarray):
+            pages = self._pages[start:start + self._pages_per_frame]
+        else:
+            pages = np.array(self._pages[start:start + self._pages_per_frame])
+        # (planes * channels, y, x) -> (planes, y, x, channels); sima sequences return float frames
+        frame = pages.reshape((self._num_planes, self._num_channels) + pages.shape[1:]).transpose(0, 2, 3, 1)
+        return frame.astype(float)
+
+    @property
+    def frames_array(self):
+        """(frames, planes, channels, y, x) view of the movie in its stored dtype, or None if the pages are not
+        equally spaced in the file"""
+        if not isinstance(self._pages, np.ndarray):
+            return None
+        return self._pages.reshape((len(self), self._num_planes, self._num_channels) + self._pages.shape[1:])
+
+    def _todict(self, savedir=None):
+        # saved as sima's own TIFF sequence, so the .sima folder can be loaded without this module; load_dataset maps
+        # the file again
+        d = {'__class__': sima.sequence._Sequence_TIFF_Interleaved,
+             'num_planes': self._num_planes,
+             'num_channels': self._num_channels,
+             'len_': len(self)}
+        if savedir is None:
+            d.update({'path': abspath(self._path)})
+        else:
+            d.update({'_abspath': abspath(self._path),
+                      '_relpath': relpath(self._path, savedir)})
+        return d
+
+
+class _Concatenated_Sequence(Sequence):
+
+    """sima sequence that presents several sequences with the same frame shape as one, one after another in time"""
+
+    def __init__(self, sequences):
+        frame_shape = sequences[0].shape[1:]
+        for seq in sequences[1:]:
+            if seq.shape[1:] != frame_shape:
+                raise ValueError('Sequences being concatenated must have the same number of planes, rows, columns '
+                                 'and channels')
+        self._sequences = sequences
+        self._frame_shape = frame_shape
+        # first frame of each sequence in the concatenated movie
+        self._starts = np.cumsum([0] + [len(seq) for seq in sequences])
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self._frame_shape
+
+    def __iter__(self):
+        # iterate each sequence in turn so sequential readers (e.g. sima's TIFF reader) keep their fast path
+        for seq in self._sequences:
+            for frame in seq:
+                yield frame
+
+    def _get_frame(self, t):
+        if t < 0:
+            t += len(self)
+        seq_idx = np.searchsorted(self._starts, t, side='right') - 1
+        return self._sequences[seq_idx]._get_frame(t - self._starts[seq_idx])
+
+    def _todict(self, savedir=None):
+        return {
+            '__class__': self.__class__,
+            'sequences': [seq._todict(savedir) for seq in self._sequences],
+        }
+
+    @classmethod
+    def _from_dict(cls, d, savedir=None):
+        sequences = []
+        for seq_dict in d.pop('sequences'):
+            seq_class = seq_dict.pop('__class__')
+            sequences.append(seq_class._from_dict(seq_dict, savedir))
+        return cls(sequences)
+
+
+class _MotionCorrected_Sidecar_Sequence(_MotionCorrectedSequence):
+
+    """
+    sima motion corrected sequence whose displacements are a memory-mapped .npy file in the .sima folder.
+
+    Saving the dataset (sima.ImagingDataset(sequences, savedir) or ImagingDataset.save) writes the displacements to
+    fname in the .sima folder instead of pickling them, unless they were loaded from that file; see
+    with_displacement_sidecars.
+    """
+
+    def __init__(self, base, displacements, extent, fname=displacements_file, path=None):
+        # sima's __init__ checks and copies the displacements as int, which would read the whole file; the
+        # displacements are either validated by sima (with_displacement_sidecars) or loaded from a saved dataset
+        _WrapperSequence.__init__(self, base)
+        self.displacements = displacements
+        self._frame_shape_zyx = tuple(extent)
+        self._displacements_fname = fname
+        self._displacements_path = path  # file the displacements were loaded from
+
+    def _todict(self, savedir=None):
+        d = {'__class__': self.__class__,
+             'base': self._base._todict(savedir),
+             'extent': self._frame_shape[:3]}
+        if savedir is None:
+            if self._displacements_path is None:
+                raise ValueError('Displacements that were never saved need a savedir')
+            d['displacements_file'] = abspath(self._displacements_path)
+        else:
+            path = join(savedir, self._displacements_fname)
+            if self._displacements_path is None or abspath(path) != abspath(self._displacements_path):
+                np.save(path, np.asarray(self.displacements, dtype='int16'))
+            d['displacements_file'] = self._displacements_fname
+        return d
+
+    @classmethod
+    def _from_dict(cls, d, savedir=None):
+        base_dict = d.pop('base')
+        base = base_dict.pop('__class__')._from_dict(base_dict, savedir)
+        path = d['displacements_file']
+        if savedir is not None and not isabs(path):
+            path = join(savedir, path)
+        return cls(base, np.load(path, mmap_mode='r'), d['extent'], basename(path), path)
+
+
+def _sidecar_fname(idx):
+    # sidecar file of the idx-th sequence of a dataset
+    return displacements_file if idx == 0 else displacements_file.replace('.npy', '_%d.npy' % idx)
+
+
+def _with_displacement_sidecar(sequence, fname):
+    if isinstance(sequence, _MotionCorrected_Sidecar_Sequence):
+        return sequence
+    if isinstance(sequence, _MotionCorrectedSequence):
+        return _MotionCorrected_Sidecar_Sequence(sequence._base, sequence.displacements.astype('int16'),
+                                                 sequence._frame_shape_zyx, fname)
+    if isinstance(sequence, _WrapperSequence):
+        sequence._base = _with_displacement_sidecar(sequence._base, fname)
+    return sequence
+
+
+def with_displacement_sidecars(sequences):
+    """
+    Motion corrected sequences (e.g. of mc_approach.correct(sequences, None)) with the displacements moved to
+    _MotionCorrected_Sidecar_Sequence, so that saving them in a dataset writes the displacements to .npy files
+    instead of sequences.pkl:
+
+        dataset = sima.ImagingDataset(sequence_io.with_displacement_sidecars(dataset.sequences), savedir)
+    """
+
+    return [_with_displacement_sidecar(seq, _sidecar_fname(idx)) for idx, seq in enumerate(sequences)]
+
+
+def _motion_corrected_dicts(sequence_dicts):
+    # the motion corrected sequence of each pickled sequence, below any wrapping sequences (e.g. sima's trimming)
+    for seq_dict in sequence_dicts:
+        while not issubclass(seq_dict['__class__'], _MotionCorrectedSequence):
+            seq_dict = seq_dict['base']
+        yield seq_dict
+
+
+def move_displacements_to_sidecar(sima_dir):
+    """
+    Moves the displacements out of a .sima folder's sequences.pkl into .npy files (see displacements_file) that are
+    memory mapped when the dataset is loaded. This rewrites sequences.pkl once; it does nothing for folders that
+    already use sidecar files.
+
+    Returns
+    -------
+    converted : bool
+        whether sequences.pkl was rewritten
+    """
+
+    sequence_file = join(sima_dir, 'sequences.pkl')
+    with open(sequence_file, 'rb') as f:
+        sequence_dicts = pickle.load(f)
+
+    converted = _displacements_to_sidecar(sequence_dicts, sima_dir)
+    if converted:
+        with open(sequence_file, 'wb') as f:
+            pickle.dump(sequence_dicts, f, pickle.HIGHEST_PROTOCOL)
+    return converted
+
+
+def _displacements_to_sidecar(sequence_dicts, sima_dir):
+    # saves the displacements of loaded sequences.pkl contents to sidecar files and removes them from the dicts
+    converted = False
+    for idx, mc_dict in enumerate(_motion_corrected_dicts(sequence_dicts)):
+        if 'displacements' not in mc_dict:
+            continue
+        fname = _sidecar_fname(idx)
+        np.save(join(sima_dir, fname), np.asarray(mc_dict.pop('displacements'), dtype='int16'))
+        mc_dict['__class__'] = _MotionCorrected_Sidecar_Sequence
+        mc_dict['displacements_file'] = fname
+        converted = True
+    return converted
+
+
+def update_displacements(sima_dir, update):
+    """
+    Changes the displacements of a .sima folder in place.
+
+    Parameters
+    ----------
+    sima_dir : string
+    update : function
+        called with the (frames, planes, rows, 2) displacements of each sequence, which it modifies in place; for
+        sidecar files (move_displacements_to_sidecar) these are writable memory maps, so only the changed values are
+        written, otherwise sequences.pkl is loaded and re-pickled
+
+    The displacements must stay non-negative. If they grow, the extent of the motion corrected frames grows by as
+    much (sima places the rows without bounds checks), which rewrites sequences.pkl; it is small for sidecar files.
+    """
+
+    sequence_file = join(sima_dir, 'sequences.pkl')
+    with open(sequence_file, 'rb') as f:
+        sequence_dicts = pickle.load(f)
+
+    rewrite = False
+    for mc_dict in _motion_corrected_dicts(sequence_dicts):
+        if 'displacements' in mc_dict:
+            displacements = mc_dict['displacements']
+            rewrite = True
+        else:
+            displacements = np.load(join(sima_dir, mc_dict['displacements_file']), mmap_mode='r+')
+
+        disp_dim = displacements.shape[-1]
+        max_before = displacements.reshape(-1, disp_dim).max(axis=0)
+        update(displacements)
+        growth = np.maximum(displacements.reshape(-1, disp_dim).max(axis=0) - max_before, 0)
+        if np.any(growth):
+            extent = np.array(mc_dict['extent'])
+            extent[len(extent) - disp_dim:] += growth
+            mc_dict['extent'] = tuple(int(size) for size in extent)
+            rewrite = True
+
+        if isinstance(displacements, np.memmap):
+            displacements.flush()
+        del displacements
+
+    if rewrite:
+        with open(sequence_file, 'wb') as f:
+            pickle.dump(sequence_dicts, f, pickle.HIGHEST_PROTOCOL)
+
+
+def create_sequence(fpath, tiff_reader='memmap', num_planes=1, num_channels=1):
+    """
+    Parameters
+    ----------
+    fpath : string or list of strings
+        raw data file (.tif, .tiff or .h5); a list of files is concatenated in the given order into one sequence
+    tiff_reader : string
+        'memmap' to memory map uncompressed TIFFs (falls back to sima's reader if the file can't be mapped) or
+        'sima' to always use sima's TIFF reader
+    num_planes, num_channels : int
+        for TIFFs: number of interleaved planes and channels (pages are ordered frame, plane, channel);
+        for h5 files the imaging dataset is (time, planes, y, x, channels) with the singleton dimensions left out
+
+    Returns
+    -------
+    sima sequence
+    """
+
+    if isinstance(fpath, (list, tuple)):
+        if len(fpath) == 1:
+            return create_sequence(fpath[0], tiff_reader, num_planes, num_channels)
+        return _Concatenated_Sequence([create_sequence(chunk_path, tiff_reader, num_planes, num_channels)
+                                       for chunk_path in fpath])
+
+    fext = os.path.splitext(fpath)[1]
+    if fext == '.tif' or fext == '.tiff':
+        if tiff_reader == 'memmap':
+            try:
+                return _Sequence_TIFF_memmap(fpath, num_planes, num_channels)
+            except ValueError as err:
+                print('Reading {} with sima\'s TIFF reader: {}'.format(fpath, err))
+        return sima.Sequence.create('TIFF', fpath, num_planes=num_planes, num_channels=num_channels)
+    elif fext == '.h5':
+        dim_order = 't' + ('z' if num_planes > 1 else '') + 'yx' + ('c' if num_channels > 1 else '')
+        return sima.Sequence.create('HDF5', fpath, dim_order)
+    else:
+        raise Exception('Inappropriate file extension')
+
+
+def group_chunks(fnames):
+    """
+    Groups ScanImage-style chunk files ("<name>_00001.tif", "<name>_00002.tif", ...) of the same recording.
+
+    Returns
+    -------
+    sessions : list of (session fname, list of chunk fnames) tuples
+        the session fname is the common name plus the extension ("<name>.tif") and chunks are sorted by their number;
+        files that aren't chunks of a multi-file recording are returned as (fname, [fname])
+    """
+
+    groups = {}
+    for fname in fnames:
+        match = chunk_pattern.match(fname)
+        key = (match.group(1), match.group(3)) if match else (fname, None)
+        groups.setdefault(key, []).append(fname)
+
+    sessions = []
+    for (name, fext), group in sorted(groups.items()):
+        if fext is None or len(group) == 1:
+            sessions.extend((fname, [fname]) for fname in group)
+        else:
+            sessions.append((name + fext, sorted(group, key=lambda fname: int(chunk_pattern.match(fname).group(2)))))
+    return sessions
+
+
+def frame_source(sequence, plane=0, channel=0):
+    # one plane and channel of a sequence for streaming blocks of frames (e.g. projections.iter_frame_blocks); a view
+    # of the memory map for memory-mapped TIFFs, otherwise a sima sequence that is read frame by frame
+    frames_array = getattr(sequence, 'frames_array', None)
+    if frames_array is None:
+        return sequence[:, plane, :, :, channel]
+    return frames_array[:, plane, channel]
+
+
+def _memmap_tiffs(sequence):
+    # replaces the sima TIFF sequences in a (wrapped or concatenated) sequence with memory-mapped ones where possible
+    if isinstance(sequence, sima.sequence._Sequence_TIFF_Interleaved):
+        try:
+            return _Sequence_TIFF_memmap(sequence._path, sequence._num_planes, sequence._num_channels)
+        except ValueError:
+            return sequence
+    if isinstance(sequence, _Concatenated_Sequence):
+        sequence._sequences = [_memmap_tiffs(seq) for seq in sequence._sequences]
+    elif isinstance(sequence, _WrapperSequence):
+        sequence._base = _memmap_tiffs(sequence._base)
+    return sequence
+
+
+def load_dataset(sima_dir, tiff_reader='memmap'):
+    """
+    Loads a .sima folder (sima.ImagingDataset.load) and, for tiff_reader 'memmap', reads its uncompressed TIFFs
+    through memory maps (see create_sequence); the folder itself stays loadable by plain sima.
+    """
+
+    dataset = sima.ImagingDataset.load(sima_dir)
+    if tiff_reader == 'memmap':
+        dataset.sequences = [_memmap_tiffs(seq) for seq in dataset.sequences]
+    return dataset
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import os
-import sima
 from sima.ROI import ROIList
 import numpy as np
+import sequence_io
 
 
 def extract(fpath):
@@ -18,10 +18,13 @@ def extract(fpath):
 
     rois = ROIList.load(os.path.join(fdir, fname + '_RoiSet.zip'),
                         fmt='ImageJ')  # load ROIs as sima polygon objects (list)
-    dataset = sima.ImagingDataset.load(os.path.join(fdir, fname + '_mc.sima'))  # reload motion-corrected dataset
+    dataset = sequence_io.load_dataset(os.path.join(fdir, fname + '_mc.sima'))  # reload motion-corrected dataset
     dataset.add_ROIs(rois, 'from_ImageJ')
-    signals = dataset.extract(rois)
-    extracted_signals = np.asarray(signals['raw'])  # turn signals list into an np array
+    # sima extracts one channel per call; the saved array is (channels, rois, frames)
+    extracted_signals = np.array([np.asarray(dataset.extract(rois, signal_channel=channel)['raw'][0])
+                                  for channel in range(dataset.frame_shape[-1])])
     np.save(os.path.join(fdir, fname + '_extractedsignals.npy'), extracted_signals)
 
-    print('Done with extracting roi signals from %s' % fdir)
\ No newline at end of file
+    print('Done with extracting roi signals from %s' % fdir)
+
+    return extracted_signals
\ No newline at end of file
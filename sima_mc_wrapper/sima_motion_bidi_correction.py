@@ -7,11 +7,18 @@ import h5py
 import sys
 from sima import sequence
 import bidi_offset_correction
+import fft_registration
+from collections import OrderedDict
 from contextlib import contextmanager
+from itertools import product
+from warnings import warn
 import matplotlib
 import matplotlib.pyplot as plt
 import tifffile as tiff
 import utils
+import projections
+import sequence_io
+import stage_metrics
 
 # important for text to be detecting when importing saved figures into illustrator
 matplotlib.rcParams['pdf.fonttype'] = 42
@@ -40,9 +47,9 @@ def save_mean_imgs(save_dir, data_raw, data_mc):
     if not os.path.exists(save_dir):
         os.mkdir(save_dir)
 
-    # compute mean images
-    raw_mean = np.mean(np.squeeze(data_raw), axis=0)
-    mc_mean = np.mean(np.squeeze(data_mc), axis=0)
+    # compute mean images; data can be arrays, h5py datasets or sima sequences and is streamed in blocks of frames
+    raw_mean = projections.mean_image(data_raw)
+    mc_mean = projections.mean_image(data_mc)
 
     # calculate min and max array values across datasets to make color limits consistent
     clims = [np.min([np.min(raw_mean), np.min(mc_mean)]),
@@ -57,96 +64,211 @@ def save_mean_imgs(save_dir, data_raw, data_mc):
     plt.savefig(os.path.join(save_dir, 'raw_mc_imgs.pdf'))
 
 
-def save_projections(save_dir, data_mc):
+def save_projections(save_dir, data_mc, store_path=None, correlation=False, percentiles=None):
 
-    max_img = utils.uint8_arr(np.max(data_mc, axis=0))
-    mean_img = utils.uint8_arr(np.mean(data_mc, axis=0))
-    std_img = utils.uint8_arr(np.std(data_mc, axis=0))
+    # data_mc: (frames, y, x) or (frames, planes, y, x, channels); images are saved without singleton plane/channel
+    # dimensions, channels last
 
-    tiff.imwrite(os.path.join(save_dir, 'mean_img.tif'), mean_img)
-    tiff.imwrite(os.path.join(save_dir, 'max_img.tif'), max_img)
-    tiff.imwrite(os.path.join(save_dir, 'std_img.tif'), std_img)
+    # the correlation image pairs neighbours along the last two axes, so the channels are moved ahead of (y, x)
+    # for the computation (a view) and back to the end of each image afterwards
+    if data_mc.ndim == 5:
+        _, num_planes, num_rows, num_cols, num_channels = data_mc.shape
+        data_mc = np.moveaxis(data_mc, -1, 2)
 
+    # max, mean and std (plus the optional correlation and percentile images) in a single pass over the data;
+    # see projections.ProjectionAccumulator
+    proj_imgs = projections.compute_projections(data_mc, correlation=correlation, percentiles=percentiles)
 
-def full_process(fpath, max_disp, save_displacement=False):
+    if data_mc.ndim == 5 and num_channels > 1:
+        for name, img in proj_imgs.items():
+            img = np.moveaxis(img.reshape(num_planes, num_channels, num_rows, num_cols), 1, -1)
+            proj_imgs[name] = np.squeeze(img, axis=0) if num_planes == 1 else img
+
+    for name, img in proj_imgs.items():
+        tiff.imwrite(os.path.join(save_dir, name + '.tif'), utils.uint8_arr(img))
+
+    # full precision projections for downstream steps; see projections.py
+    if store_path is not None:
+        projections.save_projection_store(store_path, proj_imgs)
+
+
+def get_displacements(sequence):
+    """
+    Returns the (frames, planes, rows, 2) row-wise (y, x) displacements of a motion-corrected sima sequence (as
+    created by MotionEstimationStrategy.correct: the sequence wraps the raw data in a _MotionCorrectedSequence,
+    possibly behind a trimming index). Displacements are non-negative; a row is placed at its displacement in the
+    corrected frame (before trimming).
+    """
+
+    while not hasattr(sequence, 'displacements'):
+        sequence = sequence._base
+    return sequence.displacements
+
+
+def displacement_summaries(displacements):
+    """
+    Compact (int16) per-frame summaries of row-wise motion correction displacements, as stored in "_sima_mc.h5".
+
+    Parameters
+    ----------
+    displacements : np array
+        (frames, planes, rows, 2) from get_displacements
+
+    Returns
+    -------
+    OrderedDict of int16 arrays
+        'displacements' : (frames, planes, rows, 2) all row displacements
+        'frame_displacements' : (frames, planes, 2) mean (y, x) displacement of the rows of each frame
+        'row_displacement_min', 'row_displacement_max' : (frames, planes, 2) range of the row displacements within
+            each frame; equal to frame_displacements for rigid motion correction
+    """
+
+    displacements = np.asarray(displacements)
+    summaries = OrderedDict()
+    summaries['displacements'] = displacements.astype('int16')
+    summaries['frame_displacements'] = np.round(displacements.mean(axis=2)).astype('int16')
+    summaries['row_displacement_min'] = displacements.min(axis=2).astype('int16')
+    summaries['row_displacement_max'] = displacements.max(axis=2).astype('int16')
+    return summaries
+
+
+def displacement_composite(displacements):
+    # composite x + y offset of each frame (first plane), from the displacements averaged over rows
+    disp_meanpix = np.mean(displacements[:, 0], axis=1)
+    return np.sqrt(np.square(disp_meanpix[:, 0]) + np.square(disp_meanpix[:, 1]))
+
+
+def apply_bidi_offset(sima_dir, bidi_offset):
+    """
+    Shifts the odd rows of the .sima folder's displacements in x by the bidirectional offset; in place for
+    displacements in a sidecar file (see sequence_io.update_displacements).
+
+    sima requires non-negative displacements, so a negative offset larger than the smallest odd row displacement
+    raises a ValueError and leaves the displacements unchanged.
+    """
+
+    def shift_odd_rows(displacements):
+        if bidi_offset < 0 and displacements[:, :, 1::2, 1].min() + bidi_offset < 0:
+            raise ValueError('Bidirectional offset %d would make displacements negative' % bidi_offset)
+        displacements[:, :, 1::2, 1] += bidi_offset
+    sequence_io.update_displacements(sima_dir, shift_odd_rows)
+
+
+def full_process(fpath, max_disp, save_displacement=False, metrics=None, corr_img=False, percentile_imgs=None,
+                 tiff_reader='memmap', chunks=None, channel_names=None, num_planes=1, mc_method='hmm',
+                 displacement_sidecar=False):
     print('Performing SIMA motion correction')
     print('~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~')
     fdir  = os.path.split(fpath)[0]
     fname = os.path.splitext(os.path.split(fpath)[1])[0]
-    fext  = os.path.splitext(os.path.split(fpath)[1])[1]
     save_dir = os.path.join(fdir, fname + '_output_images')
 
-    if fext == '.tif' or fext == '.tiff':
-        # sequence: object that contains record of whole dataset; data not stored into memory all at once
-        sequences = [sima.Sequence.create('TIFF', fpath)]
-    elif fext == '.h5':
-        sequences = [sima.Sequence.create('HDF5', fpath, 'tyx')]
-    else:
-        raise Exception('Inappropriate file extension')
+    # stage timings are recorded in a throwaway object if the caller doesn't want them
+    if metrics is None:
+        metrics = stage_metrics.StageMetrics()
+
+    # sequence: object that contains record of whole dataset; data not stored into memory all at once
+    # uncompressed tifs are memory mapped and recordings split into several files (chunks; list of raw file paths)
+    # are read as one continuous movie (see sequence_io.py)
+    # channel_names: one name per interleaved channel (default: a single 'GCaMP' channel)
+    if channel_names is None:
+        channel_names = ['GCaMP']
+    sequences = [sequence_io.create_sequence(chunks or fpath, tiff_reader, num_planes, len(channel_names))]
 
     if not os.path.exists(os.path.join(fdir, fname + '_mc.sima')):
 
-        # define motion correction method
-        # n_processes can only handle =1! Bug in their code where >1 runs into an error
-        # max_displacement: The maximum allowed displacement magnitudes in pixels in [y,x]
-        mc_approach = sima.motion.HiddenMarkov2D(granularity='row', max_displacement=max_disp, n_processes=1, verbose=True)
-
-        # apply motion correction to data
-        dataset = mc_approach.correct(sequences, os.path.join(fdir, fname + '_mc.sima'),
-                                      channel_names=['GCaMP'])
-        # dataset dimensions are frame, plane, row(y), column (x), channel
-
-        # use sima's fill_gaps function to interpolate missing data from motion correction
-        # dtype can be changed to int16 since none of values are floats
-        data_mc = np.empty(dataset[0]._sequences[0].shape, dtype='int16')
-        filled_data = sequence._fill_gaps(iter(dataset[0]._sequences[0]), iter(dataset[0]._sequences[0]))
-        for f_idx, frame in enumerate(filled_data):
-            data_mc[f_idx, ...] = frame
-        data_mc = np.squeeze(data_mc)
-
-        if save_displacement is True:
-            # show motion displacements after motion correction
-            mcDisp_approach = sima.motion.HiddenMarkov2D(granularity='row', max_displacement=max_disp, n_processes=1,
+        with metrics.stage('motion_correction') as record:
+            # define motion correction method
+            # max_displacement: The maximum allowed displacement magnitudes in pixels in [y,x]
+            if mc_method == 'hmm':
+                # n_processes can only handle =1! Bug in their code where >1 runs into an error
+                mc_approach = sima.motion.HiddenMarkov2D(granularity='row', max_displacement=max_disp, n_processes=1,
                                                          verbose=True)
-            displacements = mcDisp_approach.estimate(dataset)
-
-            # save the resulting displacement file
-            # only useful if you want to see the values of displacement calculated by SIMA to perform the motion correction
-            displacement_file = open(os.path.join(fdir, fname + '_mc.sima/displacement.pkl'), "wb")
-            pickle.dump(displacements, displacement_file)
-            displacement_file.close()
-
-            # process and save np array of composite displacement
-            data_dims = displacements[0].shape
-            disp_np = np.squeeze(np.array(displacements[0]))
-            disp_meanpix = np.mean(disp_np, axis=1)  # avg across lines (y axis)
-
-            sima_disp = np.sqrt(
-                np.square(disp_meanpix[:, 0]) + np.square(disp_meanpix[:, 1]))  # calculate composite x + y offsets
-            np.save(os.path.join(fdir, 'displacements\\displacements_sima.npy'), sima_disp)
-
-        # perform bidirection offset correction
-        my_bidi_corr_obj = bidi_offset_correction.bidi_offset_correction(data_mc)  # initialize data to object
-        my_bidi_corr_obj.compute_mean_image()  # compute mean image across time
-        my_bidi_corr_obj.determine_bidi_offset()  # calculated bidirectional offset via fft cross-correlation
-        data_corrected, bidi_offset = my_bidi_corr_obj.correct_bidi_frames()  # apply bidi offset to data
-
-        # save motion-corrected, bidi offset corrected dataset
-        sima_mc_bidi_outpath = os.path.join(fdir, fname + '_sima_mc.h5')
-        h5_write_bidi_corr = h5py.File(sima_mc_bidi_outpath, 'w')
-        h5_write_bidi_corr.create_dataset('imaging', data=data_corrected)
-        h5_write_bidi_corr.close()
-
-        # save raw and mean images as figure
-        save_mean_imgs(save_dir, np.array(sequences), data_corrected)
-        # calculate and save projection images
-        save_projections(save_dir, data_corrected)
-
-        # sima by itself doesn't perform bidi corrections, so do so here:
-        sequence_file = os.path.join(fdir, fname + '_mc.sima/sequences.pkl')
-        sequence_data = pickle.load(open(sequence_file, "rb"))
-        sequence_data[0]['base']['displacements'][:, 0, 1::2, 1] += bidi_offset
-        with open(sequence_file, 'wb') as handle:
-            pickle.dump(sequence_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            elif mc_method in ['rigid', 'piecewise_rigid']:
+                # FFT phase correlation to a template; much faster, for sessions with modest motion
+                mc_approach = fft_registration.FFTMotionCorrection(max_displacement=max_disp, method=mc_method)
+            else:
+                raise ValueError("mc_method must be 'hmm', 'rigid' or 'piecewise_rigid'")
+
+            # apply motion correction to data
+            sima_dir = os.path.join(fdir, fname + '_mc.sima')
+            if displacement_sidecar:
+                # the displacements are saved to a memory-mapped file next to sequences.pkl instead of being pickled
+                # into it, so later updates (bidi offset below, calculate_neuropil.correct_sima_paths) don't
+                # re-pickle them (see sequence_io.py)
+                dataset = mc_approach.correct(sequences, None, channel_names=channel_names)
+                dataset = sima.ImagingDataset(sequence_io.with_displacement_sidecars(dataset.sequences), sima_dir,
+                                              channel_names=channel_names)
+            else:
+                dataset = mc_approach.correct(sequences, sima_dir, channel_names=channel_names)
+            # dataset dimensions are frame, plane, row(y), column (x), channel
+
+            # use sima's fill_gaps function to interpolate missing data from motion correction
+            # dtype can be changed to int16 since none of values are floats
+            data_mc = np.empty(dataset[0]._sequences[0].shape, dtype='int16')
+            filled_data = sequence._fill_gaps(iter(dataset[0]._sequences[0]), iter(dataset[0]._sequences[0]))
+            for f_idx, frame in enumerate(filled_data):
+                data_mc[f_idx, ...] = frame
+            record['num_frames'] = data_mc.shape[0]
+
+        num_frames = data_mc.shape[0]
+
+        with metrics.stage('displacement', num_frames):
+            # the displacements sima applied in the correction above; no second estimation pass is needed
+            displacements = get_displacements(dataset.sequences[0])
+            displacement_arrays = displacement_summaries(displacements)
+
+            if save_displacement is True:
+                # only useful if you want to see the values of displacement calculated by SIMA to perform the motion
+                # correction; the same values are stored in the "_sima_mc.h5" file
+                with open(os.path.join(fdir, fname + '_mc.sima', 'displacement.pkl'), 'wb') as displacement_file:
+                    pickle.dump([displacements], displacement_file)
+
+                # composite x + y offset of each frame
+                disp_dir = os.path.join(fdir, 'displacements')
+                if not os.path.exists(disp_dir):
+                    os.mkdir(disp_dir)
+                np.save(os.path.join(disp_dir, 'displacements_sima.npy'), displacement_composite(displacements))
+
+        with metrics.stage('bidi', num_frames):
+            # perform bidirection offset correction
+            # the offset is a property of the scanner, so it is estimated on the first plane and channel and applied to
+            # all of them
+            my_bidi_corr_obj = bidi_offset_correction.bidi_offset_correction(data_mc[:, 0, :, :, 0])  # initialize data to object
+            my_bidi_corr_obj.compute_mean_image()  # compute mean image across time
+            my_bidi_corr_obj.determine_bidi_offset()  # calculated bidirectional offset via fft cross-correlation
+            bidi_offset = my_bidi_corr_obj.bidi_offset
+            if bidi_offset == 0:
+                data_corrected = data_mc
+            else:
+                data_corrected = np.empty_like(data_mc)
+                for plane, channel in product(range(data_mc.shape[1]), range(data_mc.shape[-1])):
+                    my_bidi_corr_obj.data = data_mc[:, plane, :, :, channel]
+                    data_corrected[:, plane, :, :, channel] = my_bidi_corr_obj.correct_bidi_frames()[0]  # apply bidi offset to data
+
+        with metrics.stage('h5_write', num_frames):
+            # save motion-corrected, bidi offset corrected dataset
+            sima_mc_bidi_outpath = os.path.join(fdir, fname + '_sima_mc.h5')
+            h5_write_bidi_corr = h5py.File(sima_mc_bidi_outpath, 'w')
+            # (frames, y, x) for single plane and channel data
+            h5_write_bidi_corr.create_dataset('imaging', data=np.squeeze(data_corrected))
+            # motion correction displacements (int16, see displacement_summaries)
+            for name, arr in displacement_arrays.items():
+                h5_write_bidi_corr.create_dataset(name, data=arr)
+            h5_write_bidi_corr.close()
 
+        with metrics.stage('projections', num_frames):
+            # save raw and mean images as figure
+            save_mean_imgs(save_dir, sequence_io.frame_source(sequences[0]), data_corrected[:, 0, :, :, 0])
+            # calculate and save projection images
+            save_projections(save_dir, data_corrected, projections.projection_store_path(fdir, fname),
+                             correlation=corr_img, percentiles=percentile_imgs)
 
+        with metrics.stage('bidi_sequence_update'):
+            # sima by itself doesn't perform bidi corrections, so do so here:
+            if bidi_offset != 0:
+                try:
+                    apply_bidi_offset(os.path.join(fdir, fname + '_mc.sima'), bidi_offset)
+                except ValueError as err:
+                    # the "_sima_mc.h5" movie is corrected either way; only the .sima folder lacks the offset
+                    warn('{}; the .sima dataset is saved without the bidirectional offset correction'.format(err))
@@ -4,9 +4,13 @@ import os
 import sima_motion_bidi_correction
 import sima_extract_roi_sig
 import calculate_neuropil
+import stage_metrics
+import sequence_io
 import sima
+import numpy as np
 import sys
 import json
+from collections import OrderedDict
 from datetime import datetime
 
 
@@ -20,30 +24,114 @@ def check_exist_dir(path):
     return path
 
 
-def check_create_sima_dataset(fpath):
+def check_create_sima_dataset(fpath, tiff_reader='memmap', chunks=None, num_planes=1, channel_names=None):
     fdir = os.path.split(fpath)[0]
     fname = os.path.split(fpath)[1]
     fbasename = os.path.splitext(fname)[0]
-    fext = os.path.splitext(fname)[1]
 
     sima_folder_path = os.path.join(fdir, fbasename + '_mc.sima')
 
     if not os.path.exists(sima_folder_path):
 
-        # create a sima sequence with the data
-        if fext == '.tif' or fext == '.tiff':
-            sequences = [sima.Sequence.create('TIFF', fpath)]
-        elif fext == '.h5':
-            sequences = [sima.Sequence.create('HDF5', fpath, 'tyx')]
+        # create a sima sequence with the data; uncompressed tifs are memory mapped (see sequence_io.py)
+        # chunks: list of raw file paths of a recording split over several files, read as one movie
+        num_channels = 1 if channel_names is None else len(channel_names)
+        sequences = [sequence_io.create_sequence(chunks or fpath, tiff_reader, num_planes, num_channels)]
         # creates sima imaging dataset, but more importantly saves a .sima folder required for downstream processing
-        sima.ImagingDataset(sequences, sima_folder_path);
+        sima.ImagingDataset(sequences, sima_folder_path, channel_names=channel_names);
 
 def save_json_dict(savedir, fname, dict_):
     savepath = os.path.join(savedir, fname + '.json')
     with open(savepath, 'w') as fp:
         json.dump(dict_, fp)
 
-def process(fparams):
+def _single_view(analyzed_data):
+    # the QC figures are 2D: multi-plane sessions are shown as projections over planes (mean image averaged, masks
+    # and deadzones combined) and multi-channel sessions by their first channel
+    masks = analyzed_data['masks']
+    deadzones = np.asarray(analyzed_data['h5weights']['deadzones_aroundrois'])
+    if masks.ndim == 4:
+        masks = np.any(masks, axis=1)
+        deadzones = np.prod(deadzones, axis=0)
+    num_planes = analyzed_data['masks'].shape[1] if analyzed_data['masks'].ndim == 4 else 1
+    mean_img = analyzed_data['mean_img'].reshape((num_planes,) + masks.shape[1:] + (-1,))
+    mean_img = np.mean(mean_img[..., 0], axis=0)
+
+    signals = {}
+    for key in ['extract_signals', 'npil_corr_sig', 'npil_sig']:
+        # (rois, time), or (channels, rois, time) for multi-channel data
+        signals[key] = analyzed_data[key] if analyzed_data[key].ndim == 2 else analyzed_data[key][0]
+
+    return mean_img, masks, deadzones, signals
+
+
+def plot_session(fparams, metrics=None):
+    """
+    Renders the QC figures of an analyzed session from its saved outputs (see calculate_neuropil.load_analyzed_data).
+
+    fparams['plots'] sets how much is plotted: 'none', 'summary' (ROI masks and deadzones on the mean image) or
+    'full' (summary plus the per-ROI neuropil weight and signal figures). Multi-plane and multi-channel sessions
+    are plotted as a projection over planes and for the first channel.
+
+    If metrics is None (plotting run after process, e.g. from the main_parallel plot queue), the timing of the
+    plotting stage is added to the stage_metrics of the session's json file.
+    """
+
+    fbasename = os.path.splitext(fparams['fname'])[0]
+    plots = fparams.get('plots', 'full')
+    if plots == 'none':
+        return
+    if plots not in ['summary', 'full']:
+        raise ValueError("fparams['plots'] must be 'none', 'summary' or 'full'")
+
+    update_json = metrics is None
+    if update_json:
+        profile = fparams.get('profile', False)
+        profile_dir = os.path.join(fparams['fdir'], fbasename + '_profiles') if profile else None
+        metrics = stage_metrics.StageMetrics(profile=profile, profile_dir=profile_dir,
+                                             top_n=fparams.get('profile_top_n', 30))
+
+    plot_output = fparams.get('plot_output', 'per_roi')
+    plot_workers = fparams.get('plot_workers', 4)
+
+    # make mean img output directory if it doesn't exist
+    img_save_dir = check_exist_dir(os.path.join(fparams['fdir'], fbasename + '_output_images'))
+
+    with metrics.stage('plotting'):
+        with calculate_neuropil.load_analyzed_data(fparams['fdir'], fparams['fname']) as analyzed_data:
+            mean_img, masks, deadzones, signals = _single_view(analyzed_data)
+            calculate_neuropil.plot_ROI_masks(img_save_dir, mean_img, masks)
+            calculate_neuropil.plot_deadzones(img_save_dir, mean_img, deadzones)
+
+            if plots == 'full':
+                # make neuropil weight output plot directory if it doesn't exist
+                npil_weight_save_dir = check_exist_dir(os.path.join(img_save_dir, 'npil_weights'))
+                # make signal plot output directory if it doesn't exist
+                signal_save_dir = check_exist_dir(os.path.join(img_save_dir, 'corr_signal'))
+
+                calculate_neuropil.plot_npil_weights(npil_weight_save_dir, mean_img,
+                                                     analyzed_data['h5weights']['spatialweights'],
+                                                     output=plot_output, n_workers=plot_workers)
+                calculate_neuropil.plot_corrected_sigs(signal_save_dir, signals['extract_signals'],
+                                                       signals['npil_corr_sig'], signals['npil_sig'],
+                                                       fparams, output=plot_output, n_workers=plot_workers)
+
+    if update_json:
+        json_path = os.path.join(fparams['fdir'], fbasename + '.json')
+        if os.path.exists(json_path):
+            with open(json_path, 'r') as fp:
+                saved_fparams = json.load(fp, object_pairs_hook=OrderedDict)
+        else:
+            saved_fparams = dict(fparams)
+        saved_fparams.setdefault('stage_metrics', OrderedDict()).update(metrics.to_dict())
+        save_json_dict(fparams['fdir'], fbasename, saved_fparams)
+
+
+def process(fparams, plot_inline=True):
+    """
+    Runs the requested processing steps on one session. With plot_inline=False the QC figures are not rendered;
+    call plot_session(fparams) on the returned fparams (defaults filled in) afterwards.
+    """
 
     fpath = os.path.join(fparams['fdir'], fparams['fname'])  # note fname contains file extension
     fbasename = os.path.splitext(fparams['fname'])[0]
@@ -58,41 +146,71 @@ def process(fparams):
     if "npil_correct" not in fparams:
         fparams['npil_correct'] = True
 
+    if "chunks" not in fparams:
+        fparams['chunks'] = [fparams['fname']]
+    # raw data files of the session; fname only names the outputs when the recording is split into several files
+    chunk_paths = [os.path.join(fparams['fdir'], chunk) for chunk in fparams['chunks']]
+    if "num_planes" not in fparams:
+        fparams['num_planes'] = 1
+    if "channel_names" not in fparams:
+        fparams['channel_names'] = ['GCaMP']
+    if "tiff_reader" not in fparams:
+        fparams['tiff_reader'] = 'memmap'
+    if "mc_method" not in fparams:
+        fparams['mc_method'] = 'hmm'
+    if "displacement_sidecar" not in fparams:
+        fparams['displacement_sidecar'] = False
+
+    if "profile" not in fparams:
+        fparams['profile'] = False
+    if "plots" not in fparams:
+        fparams['plots'] = 'full'
+    if "plot_output" not in fparams:
+        fparams['plot_output'] = 'per_roi'
+    if "plot_workers" not in fparams:
+        fparams['plot_workers'] = 4
+
+    # wall/cpu time, memory, io and throughput of each processing stage; saved in the json file below
+    # if requested, each stage is also profiled and the reports are written to the "_profiles" folder
+    profile_dir = os.path.join(fparams['fdir'], fbasename + '_profiles') if fparams['profile'] else None
+    metrics = stage_metrics.StageMetrics(profile=fparams['profile'], profile_dir=profile_dir,
+                                         top_n=fparams.get('profile_top_n', 30))
+
     # run motion correction
     if fparams['motion_correct']:
-        sima_motion_bidi_correction.full_process(fpath, max_disp, save_displacement)
+        sima_motion_bidi_correction.full_process(fpath, max_disp, save_displacement, metrics=metrics,
+                                                 corr_img=fparams.get('corr_img', False),
+                                                 percentile_imgs=fparams.get('percentile_imgs'),
+                                                 tiff_reader=fparams['tiff_reader'], chunks=chunk_paths,
+                                                 channel_names=fparams['channel_names'],
+                                                 num_planes=fparams['num_planes'], mc_method=fparams['mc_method'],
+                                                 displacement_sidecar=fparams['displacement_sidecar'])
     else:
-        check_create_sima_dataset(fpath)
+        with metrics.stage('sima_dataset'):
+            check_create_sima_dataset(fpath, fparams['tiff_reader'], chunk_paths, fparams['num_planes'],
+                                      fparams['channel_names'])
 
     # perform signal extraction
     if fparams['signal_extract']:
-        sima_extract_roi_sig.extract(fpath)
+        with metrics.stage('extraction') as record:
+            extracted_signals = sima_extract_roi_sig.extract(fpath)
+            record['num_frames'] = extracted_signals.shape[-1]
 
     # perform neuropil extraction and correction
     if fparams['npil_correct']:
 
-        # make mean img output directory if it doesn't exist
-        img_save_dir = check_exist_dir(os.path.join(fparams['fdir'], fbasename + '_output_images'))
-        # make neuropil weight output plot directory if it doesn't exist
-        npil_weight_save_dir = check_exist_dir(os.path.join(img_save_dir, 'npil_weights'))
-        # make signal plot output directory if it doesn't exist
-        signal_save_dir = check_exist_dir(os.path.join(img_save_dir, 'corr_signal'))
-
         # perform full neuropil correction
-        calculate_neuropil.calculate_neuropil_signals_for_session(fpath, fparams)
-
-        # plot and save figures from neuropil correction
-        analyzed_data = calculate_neuropil.load_analyzed_data(fparams['fdir'], fparams['fname'])
-        calculate_neuropil.plot_ROI_masks(img_save_dir, analyzed_data['mean_img'],
-                                          analyzed_data['masks'])
-        calculate_neuropil.plot_deadzones(img_save_dir, analyzed_data['mean_img'],
-                                          analyzed_data['h5weights']['deadzones_aroundrois'])
-        calculate_neuropil.plot_npil_weights(npil_weight_save_dir, analyzed_data['mean_img'],
-                                             analyzed_data['h5weights']['spatialweights'])
-        calculate_neuropil.plot_corrected_sigs(signal_save_dir, analyzed_data['extract_signals'],
-                                               analyzed_data['npil_corr_sig'], analyzed_data['npil_sig'], fparams)
+        with metrics.stage('neuropil_correction'):
+            calculate_neuropil.calculate_neuropil_signals_for_session(fpath, fparams, metrics=metrics)
 
+        # plot and save figures from neuropil correction; main_parallel instead queues the session for a separate
+        # low-priority plotting process so the compute worker can move on to the next session
+        if plot_inline:
+            plot_session(fparams, metrics=metrics)
 
     # datetime object containing current date and time
     fparams['date_time'] = str(datetime.now())
-    save_json_dict(fparams['fdir'], fbasename, fparams)
\ No newline at end of file
+    fparams['stage_metrics'] = metrics.to_dict()
+    save_json_dict(fparams['fdir'], fbasename, fparams)
+
+    return fparams
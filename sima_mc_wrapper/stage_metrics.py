@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Lightweight per-stage instrumentation for the preprocessing pipeline. Each stage records its wall time, CPU time,
+peak resident memory, bytes read/written and, when the number of frames is known, the frame throughput.
+The records are plain dictionaries so they can be stored directly in the per-session json file (see
+single_file_process.save_json_dict).
+
+How to use:
+
+    metrics = stage_metrics.StageMetrics()
+    with metrics.stage('motion_correction') as record:
+        ... do work ...
+        record['num_frames'] = num_frames  # optional; enables the frames_per_sec entry
+
+    metrics.to_dict()  # ordered dictionary of stage name -> record
+
+Profiling:
+
+    metrics = stage_metrics.StageMetrics(profile='cprofile', profile_dir=some_dir)
+
+will also profile every stage and write "<stage>.prof" (load with pstats or snakeviz) and "<stage>_top.txt"
+(top_n functions sorted by cumulative time) into profile_dir. profile='sampling' uses the pyinstrument sampling
+profiler if it is installed (writes "<stage>_sampling.txt" and "<stage>_sampling.html") and falls back to cProfile
+otherwise. Stages nested inside an already profiled stage are not profiled separately; their calls show up in the
+profile of the outer stage.
+
+Notes
+-----
+peak_rss_mb is the high-water mark of the process at the end of the stage (the OS only exposes the lifetime peak),
+so in a pool worker that has already processed another session it may reflect that earlier session.
+io_read_bytes/io_write_bytes are only available on linux (/proc/self/io) or when psutil is installed; otherwise
+they are stored as None.
+
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource  # not available on windows
+    have_resource = True
+except ImportError:
+    have_resource = False
+
+try:
+    import psutil
+    have_psutil = True
+except ImportError:
+    have_psutil = False
+
+try:
+    import pyinstrument
+    have_pyinstrument = True
+except ImportError:
+    have_pyinstrument = False
+
+
+def cpu_seconds():
+    # user + system time of this process
+    times = os.times()
+    return times[0] + times[1]
+
+
+def peak_rss_mb():
+
+    if have_resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, macOS reports bytes
+        if sys.platform == 'darwin':
+            return peak / 1024.0 ** 2
+        return peak / 1024.0
+    elif have_psutil:
+        mem_info = psutil.Process().memory_info()
+        # windows keeps the peak working set; elsewhere fall back to the current rss
+        return getattr(mem_info, 'peak_wset', mem_info.rss) / 1024.0 ** 2
+
+    return None
+
+
+def io_bytes():
+    """Returns the (read, written) byte counters of this process, or (None, None) if they can't be queried"""
+
+    if have_psutil:
+        try:
+            counters = psutil.Process().io_counters()
+            return counters.read_bytes, counters.write_bytes
+        except (AttributeError, NotImplementedError, psutil.Error):
+            pass
+
+    proc_io = '/proc/self/io'
+    if os.path.exists(proc_io):
+        counters = {}
+        with open(proc_io, 'r') as f:
+            for line in f:
+                key, val = line.split(':')
+                counters[key.strip()] = int(val)
+        return counters.get('read_bytes'), counters.get('write_bytes')
+
+    return None, None
+
+
+class StageProfiler(object):
+
+    def __init__(self, method, profile_dir, name, top_n=30):
+        self.profile_dir = profile_dir
+        self.name = name
+        self.top_n = top_n
+        if method == 'sampling' and not have_pyinstrument:
+            print('pyinstrument not installed; profiling stage {} with cProfile instead'.format(name))
+            method = 'cprofile'
+        self.method = method
+
+    def start(self):
+        if self.method == 'sampling':
+            self.profiler = pyinstrument.Profiler()
+            self.profiler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        base_path = os.path.join(self.profile_dir, self.name)
+
+        if self.method == 'sampling':
+            self.profiler.stop()
+            with open(base_path + '_sampling.txt', 'w') as f:
+                f.write(self.profiler.output_text())
+            with open(base_path + '_sampling.html', 'w') as f:
+                f.write(self.profiler.output_html())
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(base_path + '.prof')
+            with open(base_path + '_top.txt', 'w') as f:
+                stats = pstats.Stats(self.profiler, stream=f)
+                stats.sort_stats('cumulative').print_stats(self.top_n)
+
+
+class StageMetrics(object):
+
+    def __init__(self, profile=None, profile_dir=None, top_n=30):
+        """
+        Parameters
+        ----------
+        profile : None, False, True, 'cprofile' or 'sampling'
+            profiler to wrap each stage in; True is the same as 'cprofile'
+        profile_dir : str
+            folder the profiler output is written to; created if it doesn't exist
+        top_n : int
+            number of functions listed in the text summary of each cProfile'd stage
+        """
+
+        self.stages = OrderedDict()
+        self.profile = 'cprofile' if profile is True else profile
+        self.profile_dir = profile_dir
+        self.top_n = top_n
+        self._profiling = False  # only one profiler can be active at a time
+
+        if self.profile and self.profile_dir is None:
+            raise ValueError('profile_dir is required when profiling')
+        if self.profile and not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+    @contextmanager
+    def stage(self, name, num_frames=None):
+
+        record = OrderedDict()
+        record['num_frames'] = num_frames
+
+        profiler = None
+        if self.profile and not self._profiling:
+            profiler = StageProfiler(self.profile, self.profile_dir, name, self.top_n)
+            self._profiling = True
+            profiler.start()
+
+        start_wall = time.time()
+        start_cpu = cpu_seconds()
+        start_read, start_write = io_bytes()
+
+        try:
+            yield record
+        finally:
+            wall_time = time.time() - start_wall
+            end_read, end_write = io_bytes()
+
+            record['wall_sec'] = wall_time
+            record['cpu_sec'] = cpu_seconds() - start_cpu
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['io_read_bytes'] = None if start_read is None else end_read - start_read
+            record['io_write_bytes'] = None if start_write is None else end_write - start_write
+            if record['num_frames'] and wall_time > 0:
+                record['frames_per_sec'] = record['num_frames'] / wall_time
+            else:
+                record['frames_per_sec'] = None
+
+            self.stages[name] = record
+
+            # writing the profile happens after the measurements so it doesn't count towards the stage
+            if profiler is not None:
+                profiler.stop()
+                self._profiling = False
+
+    def to_dict(self):
+        return OrderedDict(self.stages)
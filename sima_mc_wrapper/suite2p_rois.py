@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Reads suite2p ROIs as sparse pixel masks, for running the neuropil and signal extraction steps on suite2p sessions.
+
+suite2p saves each ROI in stat.npy as its pixel coordinates ('ypix', 'xpix'), pixel weights ('lam') and median pixel
+('med', as [y, x]); iscell.npy flags which ROIs are classified as cells and ops.npy holds the frame shape ('Ly', 'Lx').
+load_suite2p_rois builds the masks straight from these pixel lists, as a scipy.sparse (num_rois, y * x) matrix, and
+takes the centroids from 'med'. There is no detour through polygons: vectorizing suite2p masks into polygons (e.g.
+with rasterio.features.shapes) and rasterizing them back is slow and changes the masks at their edges.
+
+The sparse masks plug into calculate_neuropil.calculate_spatialweights_around_roi (with im_shape) and extract all ROI
+traces of a block of frames with one product: masks.dot(block.reshape(num_frames, -1).T).
+
+How to use:
+
+    masks, roi_centroids, im_shape, roi_ids = suite2p_rois.load_suite2p_rois(suite2p_rois.suite2p_plane_dir(fdir))
+
+"""
+
+import os
+
+import numpy as np
+import scipy.sparse
+
+
+def suite2p_plane_dir(session_folder, plane=0):
+    # suite2p's output folder for one plane of a session
+    return os.path.join(session_folder, 'suite2p', 'plane%d' % plane)
+
+
+def sparse_masks_from_stat(stat, im_shape, use_lam=False):
+    """
+    Sparse masks of suite2p ROIs.
+
+    Parameters
+    ----------
+    stat : sequence of dict
+        entries of suite2p's stat.npy
+    im_shape : tuple
+        (y, x) frame shape
+    use_lam : bool
+        use suite2p's pixel weights ('lam') instead of binary masks
+
+    Returns
+    -------
+    masks : scipy.sparse.csr_matrix (num_rois, y * x)
+        float32 with the pixel weights, or bool masks if use_lam is False
+    """
+
+    if len(stat) == 0:
+        return scipy.sparse.csr_matrix((0, im_shape[0] * im_shape[1]), dtype='float32' if use_lam else bool)
+
+    rows = np.concatenate([np.full(len(roi['ypix']), idx, dtype=int) for idx, roi in enumerate(stat)])
+    pixels = np.concatenate([np.ravel_multi_index((roi['ypix'], roi['xpix']), im_shape) for roi in stat])
+    if use_lam:
+        data = np.concatenate([roi['lam'] for roi in stat]).astype('float32')
+    else:
+        data = np.ones(len(pixels), dtype=bool)
+    masks = scipy.sparse.csr_matrix((data, (rows, pixels)), shape=(len(stat), im_shape[0] * im_shape[1]))
+    masks.sum_duplicates()
+    return masks
+
+
+def load_suite2p_rois(plane_dir, cells_only=True, use_lam=False):
+    """
+    Loads the ROIs of a suite2p plane folder (stat.npy, iscell.npy, ops.npy).
+
+    Parameters
+    ----------
+    plane_dir : string
+        e.g. session_folder/suite2p/plane0; see suite2p_plane_dir
+    cells_only : bool
+        keep only ROIs classified as cells in iscell.npy
+    use_lam : bool
+        see sparse_masks_from_stat
+
+    Returns
+    -------
+    masks : scipy.sparse.csr_matrix (num_rois, y * x)
+    roi_centroids : np array (num_rois, 2)
+        (x, y) order, as calculate_neuropil.calculate_roi_centroids
+    im_shape : tuple
+        (y, x)
+    roi_ids : np array
+        index of each ROI in stat.npy
+    """
+
+    stat = np.load(os.path.join(plane_dir, 'stat.npy'), allow_pickle=True)
+    ops = np.load(os.path.join(plane_dir, 'ops.npy'), allow_pickle=True).item()
+    im_shape = (int(ops['Ly']), int(ops['Lx']))
+
+    if cells_only:
+        iscell = np.load(os.path.join(plane_dir, 'iscell.npy'), allow_pickle=True)
+        roi_ids = np.flatnonzero(iscell[:, 0] == 1)
+    else:
+        roi_ids = np.arange(len(stat))
+
+    stat = [stat[roi_id] for roi_id in roi_ids]
+    masks = sparse_masks_from_stat(stat, im_shape, use_lam)
+    roi_centroids = np.array([roi['med'][::-1] for roi in stat], dtype=float).reshape(-1, 2)
+    return masks, roi_centroids, im_shape, roi_ids
+
+
+def dense_masks(masks, im_shape):
+    # (num_rois, y, x) bool masks, e.g. for plotting or code that expects calculate_neuropil.calculate_roi_masks output
+    return masks.toarray().reshape((-1,) + tuple(im_shape)).astype(bool)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Generates synthetic two-photon movies with known ground truth (motion, bidirectional offset, ROI and neuropil
+signals) for benchmarks and tests that can't rely on real recordings.
+
+The movie is made of disk-shaped somata on a dim background, a Gaussian-blurred neuropil field with its own
+fluctuating trace, Poisson-like shot noise, and:
+
+    - rigid motion: a bounded random walk of whole-frame (dy, dx) shifts
+    - row motion: an additional small x jitter for every row (mimics the line-by-line motion SIMA corrects)
+    - a bidirectional scanning offset: odd rows shifted in x by a fixed number of pixels
+
+How to use:
+
+    synth = synthetic_data.make_synthetic_movie(num_frames=200, num_rows=128, num_cols=128)
+    synth['movie']  # int16 array (frames, rows, columns)
+
+    # or write a tif + ImageJ RoiSet zip that the pipeline can run on directly
+    synthetic_data.make_synthetic_session(fdir, 'synth_session', num_frames=200)
+
+"""
+
+import os
+import struct
+import zipfile
+
+import numpy as np
+from scipy import ndimage
+
+
+def _calcium_traces(num_traces, num_frames, rate, tau, rng):
+    # sparse spiking convolved with an exponential decay kernel
+    spikes = rng.binomial(1, rate, size=(num_traces, num_frames)).astype('float32')
+    kernel = np.exp(-np.arange(int(tau * 5)) / float(tau)).astype('float32')
+    traces = np.array([np.convolve(spk, kernel)[:num_frames] for spk in spikes])
+    return traces
+
+
+def _disk_polygon(center_y, center_x, radius, num_vertices=16):
+    # polygon vertices in (x, y) order, as drawn in ImageJ
+    angles = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+    return np.column_stack([center_x + radius * np.cos(angles), center_y + radius * np.sin(angles)])
+
+
+def make_synthetic_movie(num_frames=200, num_rows=128, num_cols=128, num_rois=10, roi_radius=5,
+                         neuropil_sigma=20, max_shift=(4, 4), row_jitter=1, bidi_offset=2,
+                         baseline=200, roi_gain=400, neuropil_gain=150, noise_sd=10, seed=0):
+    """
+    Parameters
+    ----------
+    num_frames, num_rows, num_cols : int
+        (T, Y, X) size of the output movie
+    num_rois : int
+        number of disk-shaped somata placed on a jittered grid
+    neuropil_sigma : float
+        sigma (pixels) of the Gaussian blur that produces the smooth neuropil field
+    max_shift : tuple of two ints
+        bound of the rigid (dy, dx) random walk
+    row_jitter : int
+        max absolute x shift added independently to every row
+    bidi_offset : int
+        offset (pixels) between even and odd rows; this is the value bidi_offset_correction should recover
+
+    Returns
+    -------
+    synth : dict
+        movie (int16, T x Y x X), shifts (T x 2, rigid dy/dx), row_shifts (T x Y), bidi_offset,
+        roi_centroids (x, y order like calculate_neuropil), roi_polygons (list of (n, 3) x/y/z arrays),
+        roi_masks (n x Y x X bool), roi_traces, neuropil_trace, mean_img (motion-free mean image)
+    """
+
+    rng = np.random.RandomState(seed)
+    pad_y, pad_x = max_shift[0] + 1, max_shift[1] + row_jitter + abs(bidi_offset) + 1
+    canvas_shape = (num_rows + 2 * pad_y, num_cols + 2 * pad_x)
+
+    # place somata on a jittered grid so they don't overlap
+    grid_size = int(np.ceil(np.sqrt(num_rois)))
+    spacing_y = num_rows / float(grid_size + 1)
+    spacing_x = num_cols / float(grid_size + 1)
+    centers = []
+    for idx in range(num_rois):
+        cy = spacing_y * (idx // grid_size + 1) + rng.uniform(-0.2, 0.2) * spacing_y
+        cx = spacing_x * (idx % grid_size + 1) + rng.uniform(-0.2, 0.2) * spacing_x
+        centers.append((cy, cx))
+
+    yy, xx = np.mgrid[:num_rows, :num_cols]
+    roi_masks = np.array([(yy - cy) ** 2 + (xx - cx) ** 2 <= roi_radius ** 2 for cy, cx in centers])
+
+    # smooth neuropil field that covers the whole fov
+    neuropil_field = ndimage.gaussian_filter(rng.rand(num_rows, num_cols), neuropil_sigma)
+    neuropil_field = (neuropil_field - neuropil_field.min()) / np.ptp(neuropil_field)
+
+    roi_traces = _calcium_traces(num_rois, num_frames, rate=0.02, tau=8, rng=rng)
+    neuropil_trace = 1 + ndimage.gaussian_filter1d(rng.randn(num_frames), 10) * 3
+
+    # motion-free movie
+    footprint = roi_masks.reshape(num_rois, -1).astype('float32')
+    clean = baseline + neuropil_gain * neuropil_trace[:, None, None] * neuropil_field[None]
+    clean = clean + roi_gain * np.dot(1 + roi_traces.T, footprint).reshape(num_frames, num_rows, num_cols)
+    clean = clean + noise_sd * rng.randn(num_frames, num_rows, num_cols)
+    mean_img = clean.mean(axis=0)
+
+    # rigid random walk plus per-row jitter
+    steps = rng.randint(-1, 2, size=(num_frames, 2))
+    shifts = np.zeros((num_frames, 2), dtype=int)
+    for t in range(1, num_frames):
+        shifts[t] = np.clip(shifts[t - 1] + steps[t], -np.array(max_shift), np.array(max_shift))
+    row_shifts = rng.randint(-row_jitter, row_jitter + 1, size=(num_frames, num_rows))
+
+    movie = np.empty((num_frames, num_rows, num_cols), dtype='int16')
+    canvas = np.empty(canvas_shape)
+    for t in range(num_frames):
+        canvas[...] = np.pad(clean[t], ((pad_y, pad_y), (pad_x, pad_x)), mode='edge')
+        top = pad_y + shifts[t, 0]
+        frame = canvas[top:top + num_rows]
+        for row in range(num_rows):
+            left = pad_x + shifts[t, 1] + row_shifts[t, row]
+            # odd rows are scanned in the opposite direction; shift them to the left by the bidi offset
+            if row % 2 == 1:
+                left += bidi_offset
+            movie[t, row] = frame[row, left:left + num_cols]
+
+    roi_polygons = [np.column_stack([_disk_polygon(cy, cx, roi_radius), np.zeros(16)]) for cy, cx in centers]
+    roi_centroids = [(cx + 1, cy + 1) for cy, cx in centers]  # calculate_neuropil uses 1-indexed x,y coordinates
+
+    return {'movie': movie, 'shifts': shifts, 'row_shifts': row_shifts, 'bidi_offset': bidi_offset,
+            'roi_centroids': roi_centroids, 'roi_polygons': roi_polygons, 'roi_masks': roi_masks,
+            'roi_traces': roi_traces, 'neuropil_trace': neuropil_trace, 'mean_img': mean_img}
+
+
+def _imagej_polygon_roi(polygon):
+    # binary layout of an ImageJ polygon roi (big endian, 64 byte header followed by relative coordinates)
+    xs = np.round(polygon[:, 0]).astype(int)
+    ys = np.round(polygon[:, 1]).astype(int)
+    top, left, bottom, right = ys.min(), xs.min(), ys.max(), xs.max()
+    header = struct.pack('>4shbbhhhhh4f', b'Iout', 227, 0, 0, top, left, bottom, right, len(xs), 0, 0, 0, 0)
+    header += b'\x00' * (56 - len(header))
+    # position field: 1-indexed plane of multi-plane images, taken from the polygon's z coordinate
+    header += struct.pack('>ii', int(polygon[0, 2]) + 1, 0)
+    coords = struct.pack('>%dh' % len(xs), *(xs - left)) + struct.pack('>%dh' % len(ys), *(ys - top))
+    return header + coords
+
+
+def write_imagej_roi_zip(path, roi_polygons):
+    # writes an "_RoiSet.zip" in the format FIJI saves, readable by sima.ROI.ROIList.load(path, fmt='ImageJ')
+    with zipfile.ZipFile(path, 'w') as zf:
+        for idx, polygon in enumerate(roi_polygons):
+            zf.writestr('%04d.roi' % idx, _imagej_polygon_roi(polygon))
+
+
+def make_synthetic_session(fdir, fname, ext='.tif', **movie_kwargs):
+    """
+    Writes a raw movie (tif or h5) and a matching "_RoiSet.zip" into fdir, i.e. everything
+    single_file_process.process needs. Returns the ground truth dictionary from make_synthetic_movie
+    with an extra 'fpath' entry.
+    """
+
+    import tifffile as tiff
+    import h5py
+
+    if not os.path.exists(fdir):
+        os.makedirs(fdir)
+
+    synth = make_synthetic_movie(**movie_kwargs)
+    fpath = os.path.join(fdir, fname + ext)
+    if ext in ['.tif', '.tiff']:
+        tiff.imwrite(fpath, synth['movie'])
+    elif ext == '.h5':
+        with h5py.File(fpath, 'w') as h5:
+            h5.create_dataset('imaging', data=synth['movie'])
+    else:
+        raise Exception('Inappropriate file extension')
+
+    write_imagej_roi_zip(os.path.join(fdir, fname + '_RoiSet.zip'), synth['roi_polygons'])
+    synth['fpath'] = fpath
+
+    return synth
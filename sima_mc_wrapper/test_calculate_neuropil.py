@@ -0,0 +1,222 @@
+import multiprocessing as mp
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import h5py
+import matplotlib.image
+import numpy as np
+
+import calculate_neuropil
+import projections
+import synthetic_data
+
+
+def _record_pid(task):
+    # rendering task for _run_tasks that records which process ran it
+    save_dir, task_idx = task
+    with open(os.path.join(save_dir, 'task_{}.txt'.format(task_idx)), 'w') as f:
+        f.write(str(os.getpid()))
+
+
+def _run_tasks_in_daemon(save_dir):
+    calculate_neuropil._run_tasks(_record_pid, [(save_dir, idx) for idx in range(4)], n_workers=4)
+    with open(os.path.join(save_dir, 'daemon.txt'), 'w') as f:
+        f.write(str(os.getpid()))
+
+
+def _task_pids(save_dir):
+    return [int(open(os.path.join(save_dir, 'task_{}.txt'.format(idx))).read()) for idx in range(4)]
+
+
+class TestMultiPlaneNeuropil(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_masks_and_weights_per_plane(self):
+        synth = synthetic_data.make_synthetic_movie(num_frames=5, num_rows=48, num_cols=48, num_rois=4)
+        polygons = [polygon.copy() for polygon in synth['roi_polygons']]
+        for polygon in polygons[2:]:
+            polygon[:, 2] = 1
+
+        masks = calculate_neuropil.calculate_roi_masks(polygons, (2, 48, 48))
+        assert masks.shape == (4, 2, 48, 48)
+        np.testing.assert_array_equal(np.any(masks, axis=(2, 3)), [[1, 0], [1, 0], [0, 1], [0, 1]])
+
+        # single-plane masks keep the (num_rois, y, x) shape
+        assert calculate_neuropil.calculate_roi_masks(synth['roi_polygons'], (48, 48)).shape == (4, 48, 48)
+
+        calculate_neuropil.calculate_spatialweights_around_roi(self.fdir, masks, synth['roi_centroids'], 50, 5,
+                                                               'synth')
+        with h5py.File(os.path.join(self.fdir, 'synth_spatialweights_5_50.h5'), 'r') as h5:
+            np.testing.assert_array_equal(h5['roi_planes'][()], [0, 0, 1, 1])
+            assert h5['deadzones_aroundrois'].shape == (2, 48, 48)
+            weights = h5['spatialweights'][()]
+        # ROIs only exclude pixels of other ROIs on their own plane
+        assert np.all(weights[0][masks[1, 0]] == 0)
+        assert np.all(weights[0][masks[2, 1]] > 0)
+
+
+class TestSessionResults(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.outputs = {'masks': rng.rand(3, 16, 16) > 0.8,
+                        'mean_img': rng.rand(16, 16).astype('float32'),
+                        'extract_signals': rng.rand(3, 20),
+                        'npil_sig': rng.rand(3, 20),
+                        'npil_corr_sig': rng.rand(3, 20)}
+        np.save(os.path.join(self.fdir, 'synth_sima_masks.npy'), self.outputs['masks'])
+        projections.save_projection_store(projections.projection_store_path(self.fdir, 'synth'),
+                                          {'mean_img': self.outputs['mean_img']})
+        # extracted signals are saved with a leading sequence dimension, which is squeezed on load
+        np.save(os.path.join(self.fdir, 'synth_extractedsignals.npy'), self.outputs['extract_signals'][None])
+        np.save(os.path.join(self.fdir, 'synth_neuropilsignals.npy'), self.outputs['npil_sig'])
+        np.save(os.path.join(self.fdir, 'synth_neuropil_corrected_signals.npy'), self.outputs['npil_corr_sig'])
+        with h5py.File(os.path.join(self.fdir, 'synth_spatialweights_5_50.h5'), 'w') as h5:
+            h5.create_dataset('spatialweights', data=np.ones((3, 16, 16)))
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_keys_and_lazy_loading(self):
+        with calculate_neuropil.load_analyzed_data(self.fdir, 'synth.tif') as analyzed_data:
+            assert analyzed_data.keys() == sorted(list(self.outputs) + ['h5weights'])
+            # nothing is loaded until it is accessed
+            assert analyzed_data._cache == {}
+            for key, expected in self.outputs.items():
+                np.testing.assert_array_equal(analyzed_data[key], expected)
+            assert isinstance(analyzed_data.npil_sig, np.memmap)
+            # loaded once, then cached
+            assert analyzed_data['masks'] is analyzed_data.masks
+            self.assertRaises(KeyError, lambda: analyzed_data['traces'])
+            self.assertRaises(AttributeError, lambda: analyzed_data.traces)
+
+            h5weights = analyzed_data['h5weights']
+            assert h5weights['spatialweights'].shape == (3, 16, 16)
+        # the h5 file is closed on exit
+        assert not h5weights.id.valid
+        assert analyzed_data._cache == {}
+
+    def test_missing_output(self):
+        os.remove(os.path.join(self.fdir, 'synth_neuropil_corrected_signals.npy'))
+        with calculate_neuropil.SessionResults(self.fdir, 'synth.tif') as analyzed_data:
+            # only the missing output fails, and only when it is accessed
+            np.testing.assert_array_equal(analyzed_data['npil_sig'], self.outputs['npil_sig'])
+            self.assertRaises(IOError, lambda: analyzed_data['npil_corr_sig'])
+
+
+class TestPlots(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.mean_img = rng.rand(32, 32)
+        self.weights = rng.rand(3, 32, 32)
+        self.signals = [rng.rand(3, 50) + 1 for _ in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def _out_dir(self, name):
+        out_dir = os.path.join(self.fdir, name)
+        os.mkdir(out_dir)
+        return out_dir
+
+    def _pdf_pages(self, path):
+        with open(path, 'rb') as f:
+            return len(re.findall(br'/Type\s*/Page\b', f.read()))
+
+    def test_output_modes(self):
+        h5_path = os.path.join(self.fdir, 'synth_spatialweights_5_50.h5')
+        with h5py.File(h5_path, 'w') as h5:
+            h5.create_dataset('spatialweights', data=self.weights)
+
+        # per_roi: a png and pdf per ROI, from an array or read by the workers from the h5 file
+        with h5py.File(h5_path, 'r') as h5:
+            for weights in [self.weights, h5['spatialweights']]:
+                out_dir = self._out_dir('per_roi_{}'.format(type(weights).__name__))
+                calculate_neuropil.plot_npil_weights(out_dir, self.mean_img, weights)
+                assert sorted(os.listdir(out_dir)) == ['roi_{}_npil_weight.{}'.format(idx, ext)
+                                                       for idx in range(3) for ext in ['pdf', 'png']]
+        out_dir = self._out_dir('per_roi_signals')
+        calculate_neuropil.plot_corrected_sigs(out_dir, *self.signals, fparams={})
+        assert sorted(os.listdir(out_dir)) == ['roi_{}_signal.{}'.format(idx, ext)
+                                               for idx in range(3) for ext in ['pdf', 'png']]
+
+        # multipage: one pdf with a page per ROI
+        out_dir = self._out_dir('multipage')
+        calculate_neuropil.plot_npil_weights(out_dir, self.mean_img, self.weights, output='multipage')
+        calculate_neuropil.plot_corrected_sigs(out_dir, *self.signals, fparams={'fs': 10}, output='multipage')
+        assert sorted(os.listdir(out_dir)) == ['corrected_signals.pdf', 'npil_weights.pdf']
+        for name in os.listdir(out_dir):
+            assert self._pdf_pages(os.path.join(out_dir, name)) == 3
+
+        # contact_sheet: one png with a 2 x 2 grid of panels for 3 ROIs (2 x 2 and 4 x 1.5 inch panels, 100 dpi)
+        out_dir = self._out_dir('contact_sheet')
+        calculate_neuropil.plot_npil_weights(out_dir, self.mean_img, self.weights, output='contact_sheet')
+        calculate_neuropil.plot_corrected_sigs(out_dir, *self.signals, fparams={}, output='contact_sheet')
+        assert matplotlib.image.imread(os.path.join(out_dir, 'npil_weights_contact_sheet.png')).shape[:2] == (400, 400)
+        assert matplotlib.image.imread(os.path.join(out_dir, 'corrected_signals_contact_sheet.png')).shape[:2] == \
+            (300, 800)
+
+        self.assertRaises(ValueError, calculate_neuropil.plot_npil_weights, out_dir, self.mean_img, self.weights,
+                          output='gallery')
+
+    def test_workers_render_the_same_files(self):
+        np.save(os.path.join(self.fdir, 'inputs.npy'), np.concatenate([self.mean_img[None], self.weights]))
+        np.save(os.path.join(self.fdir, 'signals.npy'), np.array(self.signals))
+        # with 3 workers in a fresh interpreter, which hasn't drawn any text, so python 2 renders in a pool as well
+        script = '\n'.join([
+            'import os, sys',
+            'import numpy as np',
+            'import calculate_neuropil',
+            'fdir, out_dir = sys.argv[1:]',
+            'assert not calculate_neuropil._holds_font_files()',
+            'inputs = np.load(os.path.join(fdir, "inputs.npy"))',
+            'calculate_neuropil.plot_npil_weights(out_dir, inputs[0], inputs[1:], n_workers=3)',
+            'calculate_neuropil.plot_corrected_sigs(out_dir, *np.load(os.path.join(fdir, "signals.npy")), '
+            'fparams={}, n_workers=3)'])
+        outputs = []
+        for n_workers in [1, 3]:
+            out_dir = self._out_dir('workers_{}'.format(n_workers))
+            if n_workers == 1:
+                calculate_neuropil.plot_npil_weights(out_dir, self.mean_img, self.weights, n_workers=n_workers)
+                calculate_neuropil.plot_corrected_sigs(out_dir, *self.signals, fparams={}, n_workers=n_workers)
+            else:
+                subprocess.check_call([sys.executable, '-c', script, self.fdir, out_dir], close_fds=True,
+                                      cwd=os.path.dirname(os.path.abspath(calculate_neuropil.__file__)))
+            names = sorted(os.listdir(out_dir))
+            outputs.append(dict((name, open(os.path.join(out_dir, name), 'rb').read())
+                                for name in names if name.endswith('.png')))
+            assert len(names) == 12
+        assert outputs[0] == outputs[1]
+
+    def test_render_processes(self):
+        # separate processes unless python 2 would have to fork a process that holds open font files
+        out_dir = self._out_dir('pool')
+        calculate_neuropil._run_tasks(_record_pid, [(out_dir, idx) for idx in range(4)], n_workers=4)
+        uses_pool = hasattr(mp, 'get_context') or not calculate_neuropil._holds_font_files()
+        assert (os.getpid() not in _task_pids(out_dir)) == uses_pool
+
+        # workers of the batch_process pool are daemonic; they render the tasks one after another themselves
+        out_dir = self._out_dir('daemon')
+        worker = mp.Process(target=_run_tasks_in_daemon, args=(out_dir,))
+        worker.daemon = True
+        worker.start()
+        worker.join()
+        daemon_pid = int(open(os.path.join(out_dir, 'daemon.txt')).read())
+        assert _task_pids(out_dir) == [daemon_pid] * 4
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+import numpy as np
+import sima
+
+import bidi_offset_correction
+import fft_registration
+import synthetic_data
+
+
+class TestFFTRegistration(unittest.TestCase):
+
+    def setUp(self):
+        self.synth = synthetic_data.make_synthetic_movie(num_frames=120, num_rows=128, num_cols=128, row_jitter=0)
+
+    def test_rigid_shifts(self):
+        frames = bidi_offset_correction.correct_bidi_rows(self.synth['movie'], self.synth['bidi_offset'])
+        engine = fft_registration.PhaseCorrelationEngine(fft_registration.make_template(frames, (8, 8)), (8, 8),
+                                                         num_strips=4)
+        shifts = engine.estimate_shifts(frames)
+        # the synthetic shifts move the field of view, so the content moves the other way; the shifts match up to
+        # the position of the template
+        offsets = shifts + self.synth['shifts']
+        assert np.all(offsets == offsets[0])
+
+        # the synthetic motion is rigid, so the strips follow the frame
+        row_shifts = engine.estimate_row_shifts(frames, shifts)
+        assert row_shifts.shape == (120, 128, 2)
+        assert np.mean(row_shifts == shifts[:, None]) > 0.95
+
+    def test_motion_correction_strategy(self):
+        sequence = sima.Sequence.create('ndarray', self.synth['movie'][:, None, :, :, None].astype(float))
+        dataset = sima.ImagingDataset([sequence], None)
+        for method in ['rigid', 'piecewise_rigid']:
+            mc_approach = fft_registration.FFTMotionCorrection(max_displacement=[8, 8], method=method, batch_size=50,
+                                                               n_threads=2, verbose=False)
+            displacements = mc_approach.estimate(dataset)[0]
+            # sima's row-wise format, made non-negative; each row is moved back by the field of view shift
+            assert displacements.shape == (120, 1, 128, 2) and displacements.min() == 0
+            if method == 'rigid':
+                offsets = displacements[:, 0, 0] - self.synth['shifts']
+                assert np.all(offsets == offsets[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
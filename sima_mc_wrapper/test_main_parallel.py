@@ -0,0 +1,50 @@
+import unittest
+
+try:
+    from Queue import Queue  # python 2
+except ImportError:
+    from queue import Queue
+
+import main_parallel
+import single_file_process
+
+
+class TestPlotQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.plot_session = single_file_process.plot_session
+        self.lower_process_priority = main_parallel.lower_process_priority
+        self.plotted = []
+
+        def plot_session(fparams):
+            self.plotted.append(fparams['fname'])
+            if fparams['fname'] == 'broken.tif':
+                raise IOError('missing outputs')
+        single_file_process.plot_session = plot_session
+        main_parallel.lower_process_priority = lambda: None
+
+    def tearDown(self):
+        single_file_process.plot_session = self.plot_session
+        main_parallel.lower_process_priority = self.lower_process_priority
+
+    def test_worker_plots_until_sentinel(self):
+        plot_queue = Queue()
+        for fname in ['a.tif', 'broken.tif', 'b.tif']:
+            plot_queue.put({'fname': fname})
+        plot_queue.put(None)
+        plot_queue.put({'fname': 'after_sentinel.tif'})
+
+        main_parallel.plot_queue_worker(plot_queue)
+        # a failing session doesn't stop the plots of the others, and the worker returns at the sentinel
+        assert self.plotted == ['a.tif', 'broken.tif', 'b.tif']
+        assert plot_queue.get_nowait() == {'fname': 'after_sentinel.tif'}
+
+    def test_needs_plots(self):
+        assert main_parallel.needs_plots({'npil_correct': True, 'plots': 'full'})
+        assert main_parallel.needs_plots({'npil_correct': True, 'plots': 'summary'})
+        assert not main_parallel.needs_plots({'npil_correct': True, 'plots': 'none'})
+        assert not main_parallel.needs_plots({'npil_correct': False, 'plots': 'full'})
+
+
+if __name__ == "__main__":
+    unittest.main()
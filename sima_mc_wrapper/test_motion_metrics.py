@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+import motion_metrics
+
+
+class TestMotionMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+        self.movie = np.random.RandomState(0).randint(0, 1000, (53, 12, 10)).astype('int16')
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_frame_correlations_match_corrcoef(self):
+        ref_img = self.movie.mean(axis=0)
+        expected = [np.corrcoef(frame.ravel(), ref_img.ravel())[0, 1] for frame in self.movie]
+        np.testing.assert_allclose(motion_metrics.frame_correlations(self.movie, ref_img, block_size=10), expected,
+                                   atol=1e-5)
+
+    def test_crispness(self):
+        img = self.movie[0].astype(float)
+        dy, dx = np.gradient(img)
+        assert np.isclose(motion_metrics.crispness(img), np.sqrt(np.sum(dy ** 2 + dx ** 2)))
+        # blurring lowers the crispness
+        assert motion_metrics.crispness(self.movie.mean(axis=0)) < motion_metrics.crispness(img)
+
+        block_crisp = motion_metrics.block_crispness(self.movie, block_size=20)
+        assert block_crisp.shape == (3,)
+        assert np.isclose(block_crisp[-1], motion_metrics.crispness(self.movie[40:].mean(axis=0)))
+
+    def test_correlation_to_mean_streams_h5(self):
+        fpath = os.path.join(self.fdir, 'movie_sima_mc.h5')
+        with h5py.File(fpath, 'w') as h5:
+            h5.create_dataset('displacements', data=np.zeros((53, 2), 'int16'))
+            h5.create_dataset('imaging', data=self.movie)
+
+        results = motion_metrics.correlation_to_mean(OrderedDict([('raw', self.movie), ('sima', fpath)]),
+                                                     block_size=20)
+        assert list(results.keys()) == ['raw', 'sima']
+        np.testing.assert_allclose(results['sima']['mean_img'], self.movie.mean(axis=0), rtol=1e-5)
+        np.testing.assert_allclose(results['sima']['frame_corr'], results['raw']['frame_corr'])
+
+    def test_compare_datasets_crops_and_scales(self):
+        fpath = os.path.join(self.fdir, 'movie_suite2p_mc.h5')
+        with h5py.File(fpath, 'w') as h5:
+            h5.create_dataset('data', data=(self.movie[:, None, 1:-1, 1:-1] // 2))
+
+        sources = OrderedDict([('raw', self.movie), ('suite2p', motion_metrics.LazyMovie(fpath, scale=2))])
+        results = motion_metrics.compare_datasets(sources, block_size=20)
+        expected_raw = motion_metrics.crop_center(self.movie, 8, 10)
+        np.testing.assert_allclose(results['raw']['mean_img'], expected_raw.mean(axis=0))
+        np.testing.assert_allclose(results['suite2p']['mean_img'], (expected_raw // 2 * 2).mean(axis=0))
+        np.testing.assert_allclose(results['raw']['frame_corr'],
+                                   motion_metrics.frame_correlations(expected_raw, block_size=7), atol=1e-6)
+        assert results['suite2p']['block_crispness'].shape == (3,)
+
+    @unittest.skipIf(not motion_metrics.have_cv2, 'requires opencv')
+    def test_optical_flow_stats(self):
+        movie = np.zeros((6, 60, 60), 'float32')
+        movie[:, 20:40, 20:40] = 100
+        movie[3:] = np.roll(movie[3:], 2, axis=2)  # second half moved right
+        flow_stats, flow_metric = motion_metrics.optical_flow_stats(movie, movie[0], block_size=4, resize_fact=0.5,
+                                                                    winsize=15, n_threads=2, field_stride=3)
+        assert flow_stats.shape == (6, len(motion_metrics.FLOW_STATS))
+        mean_dx = flow_stats[:, motion_metrics.FLOW_STATS.index('mean_dx')]
+        assert np.all(mean_dx[3:] > mean_dx[:3])
+        np.testing.assert_array_equal(flow_metric.extra_results()['flow_field_frames'], [0, 3])
+
+    @unittest.skipIf(not motion_metrics.have_cv2, 'requires opencv')
+    def test_klt_drift(self):
+        clean = np.random.RandomState(1).rand(70, 70).astype('float32')
+        movie = np.array([np.roll(clean, shift, axis=0) for shift in [0, 0, 3, 3, 3]])
+        drift = motion_metrics.klt_drift(movie[:, 5:-5, 5:-5], movie[0, 5:-5, 5:-5], block_size=2, frame_stride=2,
+                                         max_corners=20, quality_level=0.01, n_threads=2)
+        assert drift.shape == (5, len(motion_metrics.KLT_STATS))
+        # frames 1 and 3 are skipped by the stride
+        assert np.all(np.isnan(drift[[1, 3], 0])) and np.all(drift[[1, 3], 3] == 0)
+        np.testing.assert_allclose(drift[[0, 2, 4], 0], [0, 3, 3], atol=0.2)
+        np.testing.assert_allclose(drift[[0, 2, 4], 1], 0, atol=0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+import neuropil_engine
+import suite2p_rois
+import synthetic_data
+
+
+class TestNeuropilEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_movie_sources_and_traces(self):
+        synth = synthetic_data.make_synthetic_session(self.fdir, 'synth', num_frames=30, num_rows=48, num_cols=48,
+                                                      num_rois=4)
+        h5_synth = synthetic_data.make_synthetic_session(self.fdir, 'synth', ext='.h5', num_frames=30, num_rows=48,
+                                                         num_cols=48, num_rois=4)
+        roi_masks, roi_centroids, im_shape = neuropil_engine.rois_from_imagej(self.fdir + '/synth_RoiSet.zip',
+                                                                              (48, 48))
+        assert roi_masks.shape == (4, 48, 48)
+
+        # memory-mapped TIFF and h5 (read through sima) give the same (frames, planes, y, x, channels) blocks
+        for fpath, movie in [(synth['fpath'], synth['movie']), (h5_synth['fpath'], h5_synth['movie'])]:
+            blocks = list(neuropil_engine.iter_movie_blocks(neuropil_engine.movie_from_file(fpath), block_size=8))
+            assert [block.shape for block in blocks] == [(8, 1, 48, 48, 1)] * 3 + [(6, 1, 48, 48, 1)]
+            np.testing.assert_array_equal(np.concatenate(blocks)[:, 0, :, :, 0], movie)
+
+        # ROI means, from dense and from sparse masks
+        expected = np.array([synth['movie'][:, mask].mean(axis=1) for mask in roi_masks])
+        sparse_masks = suite2p_rois.sparse_masks_from_stat(
+            [dict(zip(['ypix', 'xpix'], np.nonzero(mask))) for mask in roi_masks], (48, 48))
+        for masks in [roi_masks, sparse_masks]:
+            blocks = neuropil_engine.iter_movie_blocks(neuropil_engine.movie_from_file(synth['fpath']), block_size=7)
+            traces = neuropil_engine.weighted_traces(blocks, masks)
+            np.testing.assert_allclose(traces[0], expected, rtol=1e-5)
+
+    def test_weights_per_plane_and_channel(self):
+        roi_masks = np.zeros((3, 2, 20, 20), dtype=bool)
+        roi_masks[0, 0, 2:5, 2:5] = roi_masks[1, 0, 12:15, 12:15] = roi_masks[2, 1, 8:11, 8:11] = True
+        roi_centroids = [(4, 4), (14, 14), (10, 10)]
+        roi_planes, deadzones, allowed = neuropil_engine.neuropil_exclusion(roi_masks, roi_centroids, 3)
+        np.testing.assert_array_equal(roi_planes, [0, 0, 1])
+        assert deadzones[0, 3, 3] == 0 and deadzones[1, 3, 3] == 1 and deadzones[1, 9, 9] == 0
+        assert not allowed[0, 13, 13] and allowed[1, 13, 13]
+
+        weights = np.array([neuropil_engine.roi_spatialweights(centroid, 10, allowed[plane])
+                            for centroid, plane in zip(roi_centroids, roi_planes)])
+        movie = np.random.RandomState(0).rand(5, 2, 20, 20, 2).astype('float32')
+        traces = neuropil_engine.weighted_traces([movie[:3], movie[3:]], weights, roi_planes)
+        assert traces.shape == (2, 3, 5)
+        expected = np.einsum('yx,tyxc->ct', weights[2], movie[:, 1]) / weights[2].sum()
+        np.testing.assert_allclose(traces[:, 2], expected, rtol=1e-5)
+
+        # ROIs of a plane that aren't contiguous, from an array and read from an h5 dataset
+        order = [0, 2, 1]
+        h5_path = os.path.join(self.fdir, 'weights.h5')
+        with h5py.File(h5_path, 'w') as h5:
+            h5.create_dataset('spatialweights', data=weights[order])
+        with h5py.File(h5_path, 'r') as h5:
+            for source in [weights[order], h5['spatialweights']]:
+                np.testing.assert_allclose(neuropil_engine.weighted_traces([movie], source, roi_planes[order]),
+                                           traces[:, order], rtol=1e-6)
+
+    def test_contiguous_weights_are_not_copied(self):
+        weights = np.random.RandomState(0).rand(4, 6, 6).astype('float32')
+        rows = neuropil_engine._roi_rows(weights, np.arange(4))
+        assert rows.shape == (4, 36) and np.shares_memory(rows, weights)
+        rows = neuropil_engine._roi_rows(weights, np.array([1, 3]))
+        np.testing.assert_array_equal(rows, weights[[1, 3]].reshape(2, -1))
+        assert neuropil_engine._roi_rows(weights, np.array([], dtype=int)).shape == (0, 36)
+
+
+if __name__ == "__main__":
+    unittest.main()
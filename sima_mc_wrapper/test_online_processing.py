@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tifffile
+
+import bidi_offset_correction
+import calculate_neuropil
+import online_processing
+import synthetic_data
+
+
+class TestOnlineProcessing(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_bidi_rows_match_batch_correction(self):
+        movie = np.random.RandomState(0).rand(2, 10, 12).astype('float32')
+        for offset in [3, -2]:
+            bidi_obj = bidi_offset_correction.bidi_offset_correction(movie)
+            bidi_obj.bidi_offset = offset
+            expected = bidi_obj.correct_bidi_frames()[0]
+            np.testing.assert_array_equal(bidi_offset_correction.correct_bidi_rows(movie, offset), expected)
+
+    def test_stream_registers_and_extracts(self):
+        synth = synthetic_data.make_synthetic_session(self.fdir, 'synth', num_frames=150, num_rows=96, num_cols=96,
+                                                      num_rois=9, row_jitter=0)
+        masks = calculate_neuropil.calculate_roi_masks(synth['roi_polygons'], (96, 96))
+        calculate_neuropil.calculate_spatialweights_around_roi(self.fdir, masks, synth['roi_centroids'], 50, 15,
+                                                               'synth')
+        np.save(os.path.join(self.fdir, 'synth_sima_masks.npy'), masks)
+        processor = online_processing.OnlineProcessor.from_session(self.fdir, 'synth', n_init_frames=50,
+                                                                   max_shift=(8, 8))
+
+        source = online_processing.tail_tiff(synth['fpath'], timeout=0.1)
+        records = list(processor.run(source, save_path=os.path.join(self.fdir, 'synth_online.h5')))
+        assert len(records) == 150
+        assert processor.bidi_offset == synth['bidi_offset']
+
+        # the shifts are relative to the template, so they match the true motion up to a constant
+        shifts = np.array([record['shift'] for record in records]) + synth['shifts']
+        assert np.mean(np.all(shifts == np.median(shifts, axis=0), axis=1)) > 0.95
+
+        # after registration the raw traces are the ROI's own trace plus neuropil (and noise)
+        raw = np.array([record['raw'] for record in records]).T
+        for roi_raw, roi_trace in zip(raw, synth['roi_traces']):
+            regressors = np.column_stack([np.ones(150), roi_trace, synth['neuropil_trace']])
+            residual = np.linalg.lstsq(regressors, roi_raw, rcond=None)[1][0]
+            assert 1 - residual / np.sum(np.square(roi_raw - roi_raw.mean())) > 0.99
+
+    def test_tiff_poll_cost_stays_flat(self):
+        movie = (np.random.RandomState(0).rand(6040, 16, 16) * 1000).astype('int16')
+        path = os.path.join(self.fdir, 'growing.tif')
+        tail = online_processing._TiffTail(path)
+        # tail_tiff retries while the file doesn't exist yet
+        self.assertRaises((IOError, OSError), tail.read_new_pages)
+
+        # count the reads and IFD parses of each poll
+        counts = {'reads': 0, 'bytes': 0, 'ifds': 0}
+        read, parse_ifd = tail._read, tail._parse_ifd
+
+        def counted_read(offset, num_bytes):
+            counts['reads'] += 1
+            counts['bytes'] += num_bytes
+            return read(offset, num_bytes)
+
+        def counted_parse_ifd(ifd_offset, file_size):
+            counts['ifds'] += 1
+            return parse_ifd(ifd_offset, file_size)
+        tail._read, tail._parse_ifd = counted_read, counted_parse_ifd
+
+        def append(start, stop):
+            with tifffile.TiffWriter(path, append=True) as tif:
+                for frame in movie[start:stop]:
+                    tif.save(frame, contiguous=False)
+
+        def counted_poll(start, stop):
+            for key in counts:
+                counts[key] = 0
+            pages = tail.read_new_pages()
+            np.testing.assert_array_equal(np.array(pages), movie[start:stop])
+            return dict(counts)
+
+        # a short recording, then a long one; polling a few new pages costs the same at the end of both
+        append(0, 20)
+        counted_poll(0, 20)
+        append(20, 40)
+        short_poll = counted_poll(20, 40)
+        append(40, 6020)
+        counted_poll(40, 6020)
+        append(6020, 6040)
+        long_poll = counted_poll(6020, 6040)
+        assert long_poll == short_poll
+        # the pages are predicted from the fixed stride, without parsing their IFDs
+        assert short_poll['ifds'] == 0
+        # an empty poll only checks for a next page
+        counts['reads'] = 0
+        assert tail.read_new_pages() == [] and counts['reads'] == 1
+        tail.close()
+
+    def test_tiff_descriptions_of_different_length(self):
+        # pages with the same number of tags whose descriptions (as in ScanImage) change length, which moves the
+        # pixel data of the later pages; the pixel values read as the tag count, so a misplaced read can't be told
+        # apart by the tag count
+        path = os.path.join(self.fdir, 'descriptions.tif')
+        movie = np.empty((8, 8, 8), dtype='uint16')
+        with tifffile.TiffWriter(path) as tif:
+            for idx, length in enumerate([10, 10, 10, 10, 30, 30, 30, 30]):
+                movie[idx] = idx
+                tif.save(movie[idx], description='d' * length, contiguous=False)
+        with tifffile.TiffFile(path) as tif:
+            num_tags = len(tif.pages[0].tags)
+            assert all(len(page.tags) == num_tags for page in tif.pages)
+            movie[:, :, 1:] = num_tags
+        with tifffile.TiffWriter(path) as tif:
+            for idx, length in enumerate([10, 10, 10, 10, 30, 30, 30, 30]):
+                tif.save(movie[idx], description='d' * length, contiguous=False)
+
+        tail = online_processing._TiffTail(path)
+        np.testing.assert_array_equal(np.array(tail.read_new_pages()), movie)
+        tail.close()
+
+    def test_skips_registration_when_behind(self):
+        synth = synthetic_data.make_synthetic_movie(num_frames=20, num_rows=64, num_cols=64, num_rois=4)
+        processor = online_processing.OnlineProcessor(synth['roi_masks'], np.ones((4, 64, 64)),
+                                                      template=synth['mean_img'], bidi_offset=0, max_latency=0.5)
+        record = processor.process_frame(synth['movie'][0])
+        assert record['registered']
+        record = processor.process_frame(synth['movie'][1], arrival_time=record['frame_idx'])
+        assert not record['registered'] and processor.num_skipped == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+import projections
+
+
+class TestProjectionAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.movie = (rng.randn(157, 16, 20) * 50 + 1000).astype('int16')
+        # a patch of pixels sharing one time course, so its local correlation is high
+        self.movie[:, 4:8, 4:8] += (rng.randn(157) * 200).astype('int16')[:, None, None]
+        self.fdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_matches_numpy(self):
+        proj_imgs = projections.compute_projections(self.movie, block_size=40, percentiles=[10],
+                                                    reservoir_size=200)
+        movie = self.movie.astype('float64')
+        np.testing.assert_allclose(proj_imgs['max_img'], movie.max(axis=0))
+        np.testing.assert_allclose(proj_imgs['mean_img'], movie.mean(axis=0), rtol=1e-6)
+        np.testing.assert_allclose(proj_imgs['std_img'], movie.std(axis=0), rtol=1e-5)
+        # the reservoir holds every frame when it is larger than the movie
+        np.testing.assert_allclose(proj_imgs['percentile10_img'], np.percentile(movie, 10, axis=0), rtol=1e-6)
+
+    def test_h5_source_and_correlation(self):
+        h5_path = os.path.join(self.fdir, 'movie.h5')
+        with h5py.File(h5_path, 'w') as h5:
+            h5.create_dataset('imaging', data=self.movie)
+        with h5py.File(h5_path, 'r') as h5:
+            proj_imgs = projections.compute_projections(h5['imaging'], block_size=50, correlation=True)
+
+        np.testing.assert_allclose(proj_imgs['mean_img'], self.movie.mean(axis=0), rtol=1e-6)
+        corr_img = proj_imgs['corr_img']
+        assert corr_img[5, 5] > 0.8
+        assert abs(np.median(corr_img[10:, 10:])) < 0.2
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+import calculate_neuropil
+import roi_comparison
+import synthetic_data
+
+
+class TestROIComparison(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+        self.synth = synthetic_data.make_synthetic_movie(num_frames=60, num_rows=48, num_cols=48, num_rois=5)
+        self.masks = calculate_neuropil.calculate_roi_masks(self.synth['roi_polygons'], (48, 48))
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_traces_match_pixel_means(self):
+        movie = self.synth['movie'].astype('int16')
+        h5_path = os.path.join(self.fdir, 'movie.h5')
+        with h5py.File(h5_path, 'w') as h5:
+            h5.create_dataset('imaging', data=movie[:, None, :, :, None])
+
+        expected = np.array([np.mean(movie[:, mask], axis=1) for mask in self.masks])
+        for source in [movie, h5_path]:
+            traces = roi_comparison.roi_traces(source, self.masks, block_size=25)
+            assert traces.shape == (5, 60)
+            np.testing.assert_allclose(traces, expected, rtol=1e-5)
+
+    def test_correlations_match_corrcoef(self):
+        rng = np.random.RandomState(0)
+        traces_a = rng.randn(6, 80)
+        traces_b = traces_a[::-1] + rng.randn(6, 80)
+        expected = np.corrcoef(traces_a, traces_b)[:6, 6:]
+
+        np.testing.assert_allclose(roi_comparison.correlation_matrix(traces_a, traces_b), expected)
+        ids_a, ids_b = [0, 2, 5], [5, 3, 0]
+        np.testing.assert_allclose(roi_comparison.matched_correlations(traces_a, traces_b, ids_a, ids_b),
+                                   expected[ids_a, ids_b])
+
+    def test_match_rois(self):
+        # the same ROIs shifted by a pixel, in reverse order, plus an ROI that matches nothing
+        masks_b = np.roll(self.masks, 1, axis=2)[::-1]
+        masks_b = np.concatenate([masks_b, np.zeros((1, 48, 48), dtype=bool)])
+        masks_b[-1, :3, :3] = True
+
+        ids_a, ids_b, ious = roi_comparison.match_rois(roi_comparison.sparse_masks(self.masks), masks_b, (48, 48))
+        np.testing.assert_array_equal(ids_a, np.arange(5))
+        np.testing.assert_array_equal(ids_b, np.arange(5)[::-1])
+        assert np.all(ious > 0.5) and np.all(ious < 1)
+
+        # no overlap left above the threshold
+        ids_a, ids_b, ious = roi_comparison.match_rois(self.masks, masks_b, min_iou=0.99)
+        assert len(ids_a) == len(ids_b) == len(ious) == 0
+
+    def test_candidate_pairs_with_large_rois(self):
+        # ROIs of very different sizes, a large one in each set, and an empty ROI; compared with all pairs
+        rng = np.random.RandomState(0)
+        corners = rng.uniform(0, 500, (2, 300, 2))
+        sizes = rng.uniform(3, 15, (2, 300, 2))
+        boxes_a, boxes_b = np.concatenate([corners, corners + sizes], axis=2)
+        boxes_a[0] = [0, 0, 200, 200]
+        boxes_b[-1] = [250, 100, 450, 480]
+        boxes_b[5] = np.nan
+
+        ids_a, ids_b = roi_comparison.candidate_pairs(boxes_a, boxes_b)
+        with np.errstate(invalid='ignore'):
+            expected = np.all((boxes_a[:, None, :2] <= boxes_b[None, :, 2:]) &
+                              (boxes_b[None, :, :2] <= boxes_a[:, None, 2:]), axis=2)
+        assert len(ids_a) == expected.sum()
+        assert np.all(expected[ids_a, ids_b])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import sima
+import tifffile
+
+import fft_registration
+import sequence_io
+import sima_motion_bidi_correction
+import synthetic_data
+
+
+class TestTiffMemmapSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+        self.movie = (np.random.RandomState(0).rand(12, 24, 32) * 1000).astype('int16')
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_matches_sima_reader(self):
+        # one tif written as a stack (contiguous pages), one page by page with a header in between
+        stack_path = os.path.join(self.fdir, 'stack.tif')
+        tifffile.imwrite(stack_path, self.movie)
+        pages_path = os.path.join(self.fdir, 'pages.tif')
+        with tifffile.TiffWriter(pages_path) as tif:
+            for frame in self.movie:
+                tif.save(frame, contiguous=False, description='frame')
+
+        for path in [stack_path, pages_path]:
+            seq = sequence_io.create_sequence(path)
+            assert isinstance(seq, sequence_io._Sequence_TIFF_memmap)
+            np.testing.assert_array_equal(np.array(seq), np.array(sima.Sequence.create('TIFF', path)))
+            np.testing.assert_array_equal(np.squeeze(sequence_io.frame_source(seq)), self.movie)
+
+    def test_dataset_reload(self):
+        path = os.path.join(self.fdir, 'stack.tif')
+        tifffile.imwrite(path, self.movie)
+        sima_dir = os.path.join(self.fdir, 'stack_mc.sima')
+        sima.ImagingDataset([sequence_io.create_sequence(path)], sima_dir)
+
+        # saved as sima's own TIFF sequence, so plain sima can load the folder
+        dataset = sima.ImagingDataset.load(sima_dir)
+        assert isinstance(dataset.sequences[0], sima.sequence._Sequence_TIFF_Interleaved)
+        np.testing.assert_array_equal(np.squeeze(np.array(dataset.sequences[0])), self.movie)
+
+        dataset = sequence_io.load_dataset(sima_dir)
+        assert isinstance(dataset.sequences[0], sequence_io._Sequence_TIFF_memmap)
+        np.testing.assert_array_equal(np.squeeze(np.array(dataset.sequences[0])), self.movie)
+
+    def test_concatenated_chunks(self):
+        paths = []
+        for idx, (start, stop) in enumerate([(0, 5), (5, 12)]):
+            paths.append(os.path.join(self.fdir, 'rec_%05d.tif' % (idx + 1)))
+            tifffile.imwrite(paths[-1], self.movie[start:stop])
+
+        sima_dir = os.path.join(self.fdir, 'rec_mc.sima')
+        sima.ImagingDataset([sequence_io.create_sequence(paths)], sima_dir)
+        seq = sima.ImagingDataset.load(sima_dir).sequences[0]
+        assert len(seq) == len(self.movie)
+        np.testing.assert_array_equal(np.squeeze(np.array(seq)), self.movie)
+        np.testing.assert_array_equal(np.squeeze(seq._get_frame(7)), self.movie[7])
+
+    def test_group_chunks(self):
+        sessions = sequence_io.group_chunks(['a_00002.tif', 'a_00001.tif', 'b.tif', 'c_00001.tif'])
+        assert sessions == [('a.tif', ['a_00001.tif', 'a_00002.tif']), ('b.tif', ['b.tif']),
+                            ('c_00001.tif', ['c_00001.tif'])]
+
+
+class TestDisplacementSidecar(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+        synth = synthetic_data.make_synthetic_movie(num_frames=30, num_rows=48, num_cols=48, num_rois=3, row_jitter=0)
+        self.sequence = sima.Sequence.create('ndarray', synth['movie'][:, None, :, :, None].astype(float))
+        self.mc_approach = fft_registration.FFTMotionCorrection(max_displacement=[8, 8], n_threads=1, verbose=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_sidecar_at_creation(self):
+        legacy_dir = os.path.join(self.fdir, 'legacy_mc.sima')
+        legacy = self.mc_approach.correct([self.sequence], legacy_dir).sequences[0]
+
+        # the displacements are written to the sidecar file when the dataset is saved; sequences.pkl stays small
+        sima_dir = os.path.join(self.fdir, 'synth_mc.sima')
+        dataset = self.mc_approach.correct([self.sequence], None)
+        sima.ImagingDataset(sequence_io.with_displacement_sidecars(dataset.sequences), sima_dir)
+        assert os.path.exists(os.path.join(sima_dir, sequence_io.displacements_file))
+        assert os.path.getsize(os.path.join(sima_dir, 'sequences.pkl')) < \
+            os.path.getsize(os.path.join(legacy_dir, 'sequences.pkl'))
+        assert not sequence_io.move_displacements_to_sidecar(sima_dir)
+
+        sidecar = sima.ImagingDataset.load(sima_dir).sequences[0]
+        assert isinstance(sidecar._base, sequence_io._MotionCorrected_Sidecar_Sequence)
+        assert isinstance(sidecar._base.displacements, np.memmap)
+        np.testing.assert_array_equal(sidecar._base.displacements, legacy._base.displacements)
+        np.testing.assert_array_equal(np.array(sidecar), np.array(legacy))
+
+        # existing folders are converted once
+        assert sequence_io.move_displacements_to_sidecar(legacy_dir)
+        np.testing.assert_array_equal(np.array(sima.ImagingDataset.load(legacy_dir).sequences[0]), np.array(legacy))
+
+    def test_bidi_offset_update(self):
+        sima_dir = os.path.join(self.fdir, 'synth_mc.sima')
+        dataset = self.mc_approach.correct([self.sequence], None)
+        sima.ImagingDataset(sequence_io.with_displacement_sidecars(dataset.sequences), sima_dir)
+        original = sima.ImagingDataset.load(sima_dir).sequences[0]._base.displacements.copy()
+
+        # in place in the sidecar file
+        sima_motion_bidi_correction.apply_bidi_offset(sima_dir, 2)
+        shifted = sima.ImagingDataset.load(sima_dir).sequences[0]._base.displacements
+        np.testing.assert_array_equal(shifted[:, :, 1::2, 1], original[:, :, 1::2, 1] + 2)
+        np.testing.assert_array_equal(shifted[:, :, ::2], original[:, :, ::2])
+        sima_motion_bidi_correction.apply_bidi_offset(sima_dir, -2)
+
+        # an offset that would make displacements negative (sima can't place such rows) is refused and nothing
+        # is written
+        negative_offset = -int(original[:, :, 1::2, 1].min()) - 1
+        self.assertRaises(ValueError, sima_motion_bidi_correction.apply_bidi_offset, sima_dir, negative_offset)
+        np.testing.assert_array_equal(sima.ImagingDataset.load(sima_dir).sequences[0]._base.displacements, original)
+
+
+if __name__ == "__main__":
+    unittest.main()
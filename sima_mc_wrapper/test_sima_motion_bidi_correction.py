@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import sima
+
+import fft_registration
+import projections
+import sima_motion_bidi_correction
+import synthetic_data
+
+
+class TestDisplacements(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_displacements_from_corrected_dataset(self):
+        synth = synthetic_data.make_synthetic_movie(num_frames=40, num_rows=64, num_cols=64, num_rois=4, row_jitter=0)
+        sequence = sima.Sequence.create('ndarray', synth['movie'][:, None, :, :, None].astype(float))
+        mc_approach = fft_registration.FFTMotionCorrection(max_displacement=[8, 8], n_threads=1, verbose=False)
+        dataset = mc_approach.correct([sequence], os.path.join(self.fdir, 'synth_mc.sima'))
+
+        displacements = sima_motion_bidi_correction.get_displacements(dataset.sequences[0])
+        assert displacements.shape == (40, 1, 64, 2)
+
+        summaries = sima_motion_bidi_correction.displacement_summaries(displacements)
+        assert all(arr.dtype == np.int16 for arr in summaries.values())
+        offsets = summaries['frame_displacements'][:, 0] - synth['shifts']
+        assert np.all(offsets == offsets[0])
+        # rigid correction: all rows of a frame have the same displacement
+        np.testing.assert_array_equal(summaries['row_displacement_min'], summaries['row_displacement_max'])
+
+    def test_two_channel_projections(self):
+        # channel 0 has a patch of pixels sharing one time course, channel 1 is noise
+        rng = np.random.RandomState(0)
+        data = (rng.randn(120, 1, 16, 20, 2) * 50 + 1000).astype('int16')
+        data[:, 0, 4:8, 4:8, 0] += (rng.randn(120) * 200).astype('int16')[:, None, None]
+        store_path = os.path.join(self.fdir, 'movie_projections.h5')
+        sima_motion_bidi_correction.save_projections(self.fdir, data, store_path, correlation=True)
+
+        with h5py.File(store_path, 'r') as h5:
+            proj_imgs = dict((name, h5[name][()]) for name in h5)
+        # channels last, as calculate_neuropil expects
+        np.testing.assert_allclose(proj_imgs['mean_img'], data[:, 0].mean(axis=0), rtol=1e-6)
+        # the correlation image of each channel is computed over (y, x) only
+        for channel in range(2):
+            expected = projections.compute_projections(data[:, 0, :, :, channel], correlation=True)['corr_img']
+            np.testing.assert_allclose(proj_imgs['corr_img'][:, :, channel], expected, rtol=1e-5, atol=1e-6)
+        assert proj_imgs['corr_img'][5, 5, 0] > 0.8
+        assert abs(np.median(proj_imgs['corr_img'][:, :, 1])) < 0.2
+
+
+if __name__ == "__main__":
+    unittest.main()
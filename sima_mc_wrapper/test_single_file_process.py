@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import matplotlib.pyplot as plt
+# motion correction saves its mean image figure with pyplot; switch it to Agg even if another test imported it
+plt.switch_backend('Agg')
+
+import single_file_process
+import synthetic_data
+
+
+class TestProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+        synthetic_data.make_synthetic_session(self.fdir, 'synth', num_frames=60, num_rows=64, num_cols=64,
+                                              num_rois=4)
+        self.fparams = {'fdir': self.fdir, 'fname': 'synth.tif', 'max_disp': [8, 8], 'save_displacement': False,
+                        'mc_method': 'rigid', 'plot_output': 'contact_sheet', 'plot_workers': 1}
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def _qc_files(self):
+        img_dir = os.path.join(self.fdir, 'synth_output_images')
+        return sorted(os.path.relpath(os.path.join(path, name), img_dir)
+                      for path, _, names in os.walk(img_dir) for name in names
+                      if name.startswith(('cell_masks', 'deadzone_masks', 'npil_weights', 'corrected_signals')))
+
+    def test_plots_after_process(self):
+        fparams = single_file_process.process(self.fparams, plot_inline=False)
+        # the fparams with the defaults filled in, as saved in the json file
+        assert fparams is self.fparams
+        assert fparams['plots'] == 'full' and fparams['npil_correct']
+        with open(os.path.join(self.fdir, 'synth.json')) as f:
+            assert 'plotting' not in json.load(f)['stage_metrics']
+        assert self._qc_files() == []
+
+        # nothing is plotted for 'none'
+        single_file_process.plot_session(dict(fparams, plots='none'))
+        assert self._qc_files() == []
+
+        single_file_process.plot_session(fparams)
+        assert self._qc_files() == ['cell_masks.pdf', 'cell_masks.png',
+                                    os.path.join('corr_signal', 'corrected_signals_contact_sheet.png'),
+                                    'deadzone_masks.pdf', 'deadzone_masks.png',
+                                    os.path.join('npil_weights', 'npil_weights_contact_sheet.png')]
+        # the plotting stage is added to the session's metrics
+        with open(os.path.join(self.fdir, 'synth.json')) as f:
+            assert 'plotting' in json.load(f)['stage_metrics']
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+import stage_metrics
+
+
+class TestStageMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_records(self):
+        metrics = stage_metrics.StageMetrics()
+        with metrics.stage('load', num_frames=100):
+            time.sleep(0.02)
+        with metrics.stage('write') as record:
+            np.save(os.path.join(self.fdir, 'data.npy'), np.zeros(10 ** 6))
+            record['num_frames'] = 50
+
+        stages = metrics.to_dict()
+        assert list(stages) == ['load', 'write']
+        for record in stages.values():
+            assert list(record) == ['num_frames', 'wall_sec', 'cpu_sec', 'peak_rss_mb', 'io_read_bytes',
+                                    'io_write_bytes', 'frames_per_sec']
+            assert record['wall_sec'] > 0 and record['cpu_sec'] >= 0
+        assert stages['load']['wall_sec'] >= 0.02
+        assert stages['load']['frames_per_sec'] == 100 / stages['load']['wall_sec']
+        # frames set on the record inside the stage count as well
+        assert stages['write']['frames_per_sec'] == 50 / stages['write']['wall_sec']
+        # stored in the session json as is
+        assert json.loads(json.dumps(stages))['write']['num_frames'] == 50
+
+    def test_stage_without_frames_and_failing_stage(self):
+        metrics = stage_metrics.StageMetrics()
+        with metrics.stage('setup'):
+            pass
+
+        def failing_stage():
+            with metrics.stage('fails', num_frames=10):
+                raise RuntimeError('stage failed')
+        self.assertRaises(RuntimeError, failing_stage)
+
+        assert metrics.to_dict()['setup']['frames_per_sec'] is None
+        # a stage that raises is still recorded
+        assert metrics.to_dict()['fails']['wall_sec'] >= 0
+
+
+class TestStageProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+        self.have_pyinstrument = stage_metrics.have_pyinstrument
+
+    def tearDown(self):
+        stage_metrics.have_pyinstrument = self.have_pyinstrument
+        shutil.rmtree(self.fdir)
+
+    def test_cprofile_outputs(self):
+        profile_dir = os.path.join(self.fdir, 'profiles')
+        metrics = stage_metrics.StageMetrics(profile=True, profile_dir=profile_dir, top_n=5)
+        with metrics.stage('outer'):
+            np.sort(np.random.rand(1000))
+            # nested stages show up in the outer stage's profile only
+            with metrics.stage('inner'):
+                pass
+        with metrics.stage('second'):
+            pass
+
+        assert sorted(os.listdir(profile_dir)) == ['outer.prof', 'outer_top.txt', 'second.prof', 'second_top.txt']
+        with open(os.path.join(profile_dir, 'outer_top.txt')) as f:
+            assert 'cumulative' in f.read()
+        # all stages are still recorded, the nested one first as it ends first
+        assert list(metrics.to_dict()) == ['inner', 'outer', 'second']
+
+    def test_sampling_falls_back_to_cprofile(self):
+        stage_metrics.have_pyinstrument = False
+        profiler = stage_metrics.StageProfiler('sampling', self.fdir, 'stage')
+        assert profiler.method == 'cprofile'
+        profiler.start()
+        profiler.stop()
+        assert sorted(os.listdir(self.fdir)) == ['stage.prof', 'stage_top.txt']
+
+    def test_profile_dir_required(self):
+        self.assertRaises(ValueError, stage_metrics.StageMetrics, profile='cprofile')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+import calculate_neuropil
+import suite2p_rois
+import synthetic_data
+
+
+class TestSuite2pROIs(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_sparse_masks_match_dense_masks(self):
+        synth = synthetic_data.make_synthetic_movie(num_frames=5, num_rows=48, num_cols=48, num_rois=4)
+        dense = calculate_neuropil.calculate_roi_masks(synth['roi_polygons'], (48, 48))
+
+        # suite2p session with the synthetic ROIs and one ROI that is not a cell
+        stat = []
+        for mask in list(dense) + [np.eye(48, dtype=bool)]:
+            ypix, xpix = np.nonzero(mask)
+            stat.append({'ypix': ypix, 'xpix': xpix, 'lam': np.ones(len(ypix)) / len(ypix),
+                         'med': [int(np.median(ypix)), int(np.median(xpix))]})
+        plane_dir = suite2p_rois.suite2p_plane_dir(self.fdir)
+        os.makedirs(plane_dir)
+        np.save(os.path.join(plane_dir, 'stat.npy'), np.array(stat))
+        np.save(os.path.join(plane_dir, 'ops.npy'), np.array({'Ly': 48, 'Lx': 48}))
+        np.save(os.path.join(plane_dir, 'iscell.npy'), np.array([[1, 0.9]] * 4 + [[0, 0.1]]))
+
+        masks, roi_centroids, im_shape, roi_ids = suite2p_rois.load_suite2p_rois(plane_dir)
+        assert im_shape == (48, 48) and masks.shape == (4, 48 * 48)
+        np.testing.assert_array_equal(roi_ids, np.arange(4))
+        np.testing.assert_array_equal(suite2p_rois.dense_masks(masks, im_shape), dense)
+        # centroids in (x, y) order
+        np.testing.assert_array_equal(roi_centroids, [roi['med'][::-1] for roi in stat[:4]])
+
+        # spatial weights from the sparse masks are the same as from the dense masks
+        calculate_neuropil.calculate_spatialweights_around_roi(self.fdir, masks, roi_centroids, 50, 5, 'sparse',
+                                                               im_shape=im_shape)
+        calculate_neuropil.calculate_spatialweights_around_roi(self.fdir, dense, roi_centroids, 50, 5, 'dense')
+        with h5py.File(os.path.join(self.fdir, 'sparse_spatialweights_5_50.h5'), 'r') as h5_sparse, \
+                h5py.File(os.path.join(self.fdir, 'dense_spatialweights_5_50.h5'), 'r') as h5_dense:
+            np.testing.assert_array_equal(h5_sparse['spatialweights'][()], h5_dense['spatialweights'][()])
+            np.testing.assert_array_equal(h5_sparse['deadzones_aroundrois'][()], h5_dense['deadzones_aroundrois'][()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from sima.ROI import ROIList
+
+import bidi_offset_correction
+import synthetic_data
+
+
+class TestSyntheticData(unittest.TestCase):
+
+    def setUp(self):
+        self.fdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fdir)
+
+    def test_bidi_offset_recovered(self):
+        for offset in [-2, 3]:
+            synth = synthetic_data.make_synthetic_movie(num_frames=30, num_rows=64, num_cols=64, num_rois=4,
+                                                        max_shift=(0, 0), row_jitter=0, bidi_offset=offset)
+            bidi_obj = bidi_offset_correction.bidi_offset_correction(synth['movie'])
+            bidi_obj.compute_mean_image().determine_bidi_offset()
+            assert bidi_obj.bidi_offset == offset
+
+    def test_roi_zip_roundtrip(self):
+        synth = synthetic_data.make_synthetic_session(self.fdir, 'synth', num_frames=10, num_rows=64, num_cols=64,
+                                                      num_rois=4)
+        rois = ROIList.load(os.path.join(self.fdir, 'synth_RoiSet.zip'), fmt='ImageJ')
+
+        assert len(rois) == 4
+        assert os.path.exists(synth['fpath'])
+        for roi, polygon in zip(rois, synth['roi_polygons']):
+            # vertices are stored as integer pixel coordinates
+            centroid = roi.polygons[0].centroid.coords[0]
+            np.testing.assert_allclose(centroid, np.mean(polygon[:, :2], axis=0), atol=0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+import numpy as np
+
+import utils
+
+
+class TestUint8Arr(unittest.TestCase):
+
+    def test_lookup_table_matches_float_scaling(self):
+        rng = np.random.RandomState(0)
+        movie = rng.randint(-200, 3000, size=(30, 16, 16)).astype('int16')
+        low, high = utils.uint8_limits(movie)
+        assert low == movie.min() and high == movie.max()
+
+        expected = np.clip((movie.astype('float64') - low) * 255.0 / (high - low), 0, 255).astype('uint8')
+        out = np.empty(movie.shape, dtype='uint8')
+        result = utils.uint8_arr(movie, out=out, block_size=7)
+        assert result is out
+        assert np.abs(result.astype(int) - expected).max() <= 1
+
+        # the float path gives the same result
+        assert np.abs(utils.uint8_arr(movie.astype('float32')).astype(int) - result).max() <= 1
+
+    def test_percentile_scaling_ignores_hot_pixel(self):
+        img = np.tile(np.linspace(0, 100, 64, dtype='float32'), (64, 1))
+        img[0, 0] = 1e6
+        assert utils.uint8_arr(img)[10].max() == 0
+        assert utils.uint8_arr(img, percentiles=[0, 99])[10].max() == 255
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,19 +3,104 @@ import os
 import tifffile as tiff
 
 
-def uint8_arr(arr):
+def _scale_to_uint8(data, low, scale, buf):
+    # (data - low) * scale clipped to 0 - 255 in a float32 buffer; NaNs become 0
+    np.subtract(data, low, out=buf, casting='unsafe')
+    np.multiply(buf, scale, out=buf)
+    np.clip(buf, 0, 255, out=buf)
+    buf[np.isnan(buf)] = 0
+    return buf
 
-    # convert data to appropriate type
-    # https://stackoverflow.com/questions/25485886/how-to-convert-a-16-bit-to-an-8-bit-image-in-opencv
-    if np.issubdtype(np.uint16, arr.dtype) | np.issubdtype(np.int16, arr.dtype) | np.issubdtype(np.float32, arr.dtype) | np.issubdtype(np.float64, arr.dtype):
 
-        data_out = arr / float(np.max(arr))  # normalize the data to 0 - 1; need to use float to ensure data can have decimals
-        data_out = 255 * data_out  # Now scale by 255
+def _sample_values(arr, max_samples=int(1e7)):
+    # evenly spaced subset of the array (every n-th frame of a movie) for estimating percentiles
+    step = max(1, int(np.ceil(np.prod(arr.shape) / float(max_samples))))
+    if len(arr.shape) > 2 and step > 1:
+        return np.asarray(arr[::step])
+    return np.asarray(arr).ravel()[::step]
 
-    else:
 
-        data_out = arr
+def uint8_limits(arr, percentiles=None, block_size=100):
+    """
+    Returns the (low, high) values mapped to 0 and 255 by uint8_arr: the given percentiles of the data (estimated
+    from at most 1e7 samples), or by default min(0, minimum) and the maximum of the data.
+    """
 
-    return data_out.astype('uint8')
+    if percentiles is not None:
+        low, high = np.nanpercentile(_sample_values(arr), percentiles)
+        return float(low), float(high)
 
+    low, high = np.inf, -np.inf
+    for start in range(0, arr.shape[0], block_size):
+        block = np.asarray(arr[start:start + block_size])
+        low = min(low, np.nanmin(block))
+        high = max(high, np.nanmax(block))
+    # keep zero at zero for positive data (like the original max-only scaling)
+    return float(min(low, 0)), float(high)
 
+
+def uint8_arr(arr, low=None, high=None, percentiles=None, out=None, block_size=100):
+    """
+    Linearly rescales an image or movie to 8 bits: low maps to 0, high to 255 and values outside are clipped.
+
+    The data is processed in blocks of block_size entries along the first axis (frames of a movie, rows of an
+    image) in float32, so no full-size float copy is made; 8- and 16-bit integer data goes through a lookup table
+    instead. This makes it usable on whole movies (numpy arrays, memmaps or h5py datasets) for 8-bit exports.
+
+    Parameters
+    ----------
+    arr : np array or h5py dataset
+    low, high : float or None
+        values mapped to 0 and 255; by default taken from percentiles, or min(0, minimum) and maximum of arr
+    percentiles : None or list of two numbers
+        e.g. [1, 99.9]; percentile scaling keeps a few hot pixels from washing out the image
+    out : np array (uint8) or None
+        buffer with the shape of arr to write the result into
+    block_size : int
+
+    Returns
+    -------
+    out : np array (uint8)
+    """
+
+    dtype = np.dtype(arr.dtype)
+
+    # 8-bit data is returned unchanged unless a scaling was requested
+    if dtype == np.uint8 and low is None and high is None and percentiles is None:
+        if out is None:
+            return np.array(arr)
+        out[...] = arr
+        return out
+
+    if low is None or high is None:
+        data_low, data_high = uint8_limits(arr, percentiles, block_size)
+        low = data_low if low is None else low
+        high = data_high if high is None else high
+    scale = 255.0 / (high - low) if high > low else 0.0
+
+    if out is None:
+        out = np.empty(arr.shape, dtype='uint8')
+
+    if dtype.kind in 'iu' and dtype.itemsize <= 2:
+        # lookup table indexed by the unsigned view of the data (negative int16 values sit in the upper half)
+        unsigned = np.dtype('uint%d' % (8 * dtype.itemsize))
+        lut_values = np.arange(2 ** (8 * dtype.itemsize)).astype(unsigned).view(dtype)
+        lut = _scale_to_uint8(lut_values, low, scale, np.empty(lut_values.shape, dtype='float32')).astype('uint8')
+        for start in range(0, arr.shape[0], block_size):
+            block = np.ascontiguousarray(arr[start:start + block_size])
+            out[start:start + block_size] = lut[block.view(unsigned)]
+        return out
+
+    buf = None
+    for start in range(0, arr.shape[0], block_size):
+        block = np.asarray(arr[start:start + block_size])
+        if buf is None or buf.shape != block.shape:
+            buf = np.empty(block.shape, dtype='float32')
+        out[start:start + block_size] = _scale_to_uint8(block, low, scale, buf)
+
+    return out
+
+
+def save_uint8_tiff(save_path, arr, percentiles=None, block_size=100):
+    # quick-look 8-bit tif of an image or a whole movie (eg. the "_sima_mc.h5" imaging dataset)
+    tiff.imwrite(save_path, uint8_arr(arr, percentiles=percentiles, block_size=block_size))